@@ -1,6 +1,7 @@
 """Config Parser."""
 
 import configparser
+import copy
 from typing import Dict, Tuple
 
 
@@ -32,3 +33,33 @@ def merge(dict_1: Dict, dict_2: Dict) -> Dict:
         for key in set(dict_2) | set(dict_1)
     }
     return dict_data
+
+
+def cameras(config: Dict) -> Dict[str, Dict]:
+    """Return the config of every camera, by camera name.
+
+    Each `[camera:<name>]` section overrides the base config: `--` keys go to
+    `defaultArgs`, `<section>.<key>` keys to that section. Without camera
+    sections the base config is the only camera.
+    """
+    configs = {}
+    for section, values in config.items():
+        if not section.startswith("camera:"):
+            continue
+        name = section.split(":", 1)[1]
+        camera = copy.deepcopy(
+            {s: v for s, v in config.items() if not s.startswith("camera:")}
+        )
+        camera["APP"]["cam_name"] = name
+        for key, value in values.items():
+            if key.startswith("--"):
+                camera["defaultArgs"][key] = value
+            else:
+                target, _, option = key.partition(".")
+                # option names are lowercased by configparser, section names are not
+                section_name = next((s for s in camera if s.lower() == target), target)
+                camera.setdefault(section_name, {})[option] = value
+        configs[name] = camera
+    if not configs:
+        configs[config["APP"]["cam_name"]] = config
+    return configs
@@ -24,5 +24,10 @@ setuptools.setup(
     ],
     packages=["videoio"],
     python_requires=">=3.8",
-    entry_points={"console_scripts": ["videoio = videoio.demo:main"]},
+    entry_points={
+        "console_scripts": [
+            "videoio = videoio.demo:main",
+            "videoio-supervisor = videoio.supervisor:main",
+        ]
+    },
 )
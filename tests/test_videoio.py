@@ -1,9 +1,47 @@
 """Test suite for videoio."""
 
 # import docopt
+import asyncio
+import datetime
+import math
 import os
+import shutil
+import threading
+import time
+from queue import Queue
+from typing import Any, Optional, Tuple
+
+import cv2
+import ffmpeg
+import numpy as np
+import pytest
 
 from docs import config as cfg  # noqa: E402
+from videoio.utils import (
+    aio,
+    frame_codec,
+    helpers,
+    metrics,
+    pixel_format,
+    pyramid,
+    tracing,
+)
+from videoio.utils.change_gate import ChangeGate
+from videoio.utils.dvr_writer import DvrWriter
+from videoio.utils.frame_header import (
+    HEADER,
+    HEARTBEAT,
+    TRACED,
+    frame_meta,
+    unpack,
+)
+from videoio.utils.frame_pool import FramePool
+from videoio.utils.keyframe_reader import KeyframeCapture
+from videoio.utils.pacing import Pacer
+from videoio.utils.passthrough_writer import PassthroughWriter
+from videoio.utils.redis_shmem import RedisShmem, queue_key
+from videoio.utils.shm_ring import ShmRing
+from videoio.utils.video_writer import ffmpegwriter, video_writer
 from videoio.videoio import RedisVideoCapture
 
 config_path = os.path.dirname(os.path.abspath(cfg.__file__))
@@ -94,8 +132,1317 @@ def test_read_write() -> None:
     # wait until the frame buffer is full
     rvc.waitOnFrameBuf()
     # get the frame from the buffer
-    frame, grabbed, timestamp = rvc.read()
+    frame, grabbed, meta = rvc.read()
     # stop the thread
     rvc.stop()
     # check if capture failed
     assert rvc.capture_failed is False
+
+
+def test_put_Q_caps_queue() -> None:
+    """Test that publishing keeps the queue capped at q_size."""
+    shmem = RedisShmem(config)
+    frame = np.zeros((48, 86, 3), dtype=np.uint8)
+    for _ in range(2 * shmem.q_size):
+        shmem.put_Q(frame)
+    shmem.flush()
+    assert shmem.qsize() == shmem.q_size
+    # batching never needs more than one round trip per frame
+    assert shmem.stats()["round_trips_per_frame"] <= 1
+
+
+def test_shm_ring() -> None:
+    """Test the shared memory ring keeps the newest q_size frames in order."""
+    ring = ShmRing(config, producer=True)
+    try:
+        width = int(config["defaultArgs"]["--width"])
+        height = int(config["defaultArgs"]["--height"])
+        for i in range(ring.q_size + 2):
+            ring.put_Q(np.full((height, width, 3), i, dtype=np.uint8))
+        assert ring.qsize() == ring.q_size
+        frame, grabbed, meta = ring.getFrame()
+        assert grabbed
+        assert frame is not None and frame[0, 0, 0] == 2
+        assert meta is not None and meta.seq == 2
+        assert ring.qsize() == ring.q_size - 1
+        del frame
+    finally:
+        ring.close()
+
+
+def test_shm_ring_owner() -> None:
+    """Test only the producer creates and removes the ring; readers wait."""
+    cfg_shm = {section: dict(values) for section, values in config.items()}
+    cfg_shm["APP"]["cam_name"] = "OWNER_CAM"
+    cfg_shm["defaultArgs"].update({"--width": "86", "--height": "48"})
+    with pytest.raises(FileNotFoundError):
+        ShmRing(cfg_shm, timeout=0)
+
+    async def read_early() -> None:
+        reader = aio.AsyncShmRing(cfg_shm)
+        assert reader.ring is None
+        producer = ShmRing(cfg_shm, producer=True)
+        try:
+            producer.put_Q(np.zeros((48, 86, 3), dtype=np.uint8))
+            _, grabbed, meta = await reader.read(timeout=1, copy=True)
+            assert grabbed and meta is not None and meta.seq == 0
+            await reader.close()
+            # a reader closing leaves the ring to the producer
+            ShmRing(cfg_shm, timeout=0).close()
+        finally:
+            producer.close()
+
+    asyncio.run(read_early())
+    with pytest.raises(FileNotFoundError):
+        ShmRing(cfg_shm, timeout=0)
+
+
+def test_shm_ring_overwrite() -> None:
+    """Test readers skip frames overwritten while read, and a reused ring is reset."""
+    cfg_shm = {section: dict(values) for section, values in config.items()}
+    cfg_shm["APP"]["cam_name"] = "TORN_CAM"
+    cfg_shm["defaultArgs"].update({"--width": "86", "--height": "48"})
+    cfg_shm["Analysis"].update(capture_policy="drop-oldest", read_policy="block")
+    ring = ShmRing(cfg_shm, producer=True)
+    reader = ShmRing(cfg_shm)
+    try:
+        for i in range(3):
+            ring.put_Q(np.full((48, 86, 3), i, dtype=np.uint8))
+        read_slot = reader._read_slot
+
+        def lapped(seq: int) -> Any:
+            # the producer laps the reader while it copies frame 0
+            item = read_slot(seq)
+            if seq == 0:
+                for i in range(3, 3 + ring.q_size):
+                    ring.put_Q(np.full((48, 86, 3), i, dtype=np.uint8))
+            return item
+
+        reader._read_slot = lapped  # type: ignore
+        frame, grabbed, meta = reader.getFrame(copy=True)
+        assert grabbed and meta is not None and meta.seq == 3
+        assert frame is not None and frame[0, 0, 0] == 3
+        assert reader.dropped == 1 + 2  # the torn frame, and 1 and 2 overwritten
+        assert read_slot(0) is None
+        # the producer never moves the readers' tail
+        assert reader.qsize() == ring.q_size - 1
+        ring.owner = False  # the producer dies without removing the ring
+    finally:
+        reader.close()
+        ring.close()
+
+    # a new producer with smaller frames starts the reused ring over
+    cfg_shm["defaultArgs"].update({"--width": "40", "--height": "30"})
+    ring = ShmRing(cfg_shm, producer=True)
+    try:
+        assert ring.empty()
+        ring.put_Q(np.full((30, 40, 3), 7, dtype=np.uint8))
+        frame, grabbed, meta = ring.getFrame()
+        assert grabbed and meta is not None and (meta.seq, meta.w) == (0, 40)
+        del frame
+    finally:
+        ring.close()
+
+
+def test_frame_codecs() -> None:
+    """Test every frame codec survives an encode/decode round trip."""
+    frame = np.zeros((48, 86, 3), dtype=np.uint8)
+    frame[10:20, 10:40] = (0, 128, 255)
+    for codec in frame_codec.CODECS.values():
+        encoded = RedisShmem.encodeFrame(frame, codec)
+        decoded = RedisShmem.decodeFrame(encoded)
+        assert decoded.shape == frame.shape
+        if codec != frame_codec.JPEG:
+            assert np.array_equal(decoded, frame)
+    raw = len(RedisShmem.encodeFrame(frame, frame_codec.RAW))
+    assert len(RedisShmem.encodeFrame(frame, frame_codec.LOSSLESS)) < raw
+
+
+def test_stream_fan_out() -> None:
+    """Test that stream consumers each read every frame."""
+    stream_config = {**config, "redis": {**config["redis"], "mode": "stream"}}
+    producer = RedisShmem(stream_config)
+    consumers = [RedisShmem(stream_config, consumer=name) for name in ("a", "b")]
+    frame = np.zeros((48, 86, 3), dtype=np.uint8)
+    producer.put_Q(frame)
+    producer.flush()
+    for consumer in consumers:
+        decoded, grabbed, meta = consumer.getFrame()
+        assert grabbed
+        assert decoded is not None and decoded.shape == frame.shape
+
+
+def test_frame_header() -> None:
+    """Test frame metadata survives the binary header for non-BGR frames."""
+    frame = np.arange(48 * 86, dtype=np.uint16).reshape(48, 86)
+    encoded = RedisShmem.encodeFrame(frame, meta=frame_meta(frame, 7, frame_codec.RAW))
+    decoded, meta = RedisShmem.decodeFrameMeta(encoded)
+    assert np.array_equal(decoded, frame)
+    assert (meta.seq, meta.h, meta.w, meta.channels) == (7, 48, 86, 1)
+    assert meta.dtype == np.uint16
+    assert meta.age_ms() >= 0
+
+
+def test_pixel_formats() -> None:
+    """Test compact pixel formats through the header and the frame buffers."""
+    frame = np.zeros((48, 86, 3), dtype=np.uint8)
+    frame[10:20, 10:40] = (0, 128, 255)
+    i420 = pixel_format.from_bgr(frame, pixel_format.I420)
+    assert i420.shape == (72, 86) and i420.nbytes == frame.nbytes // 2
+    assert np.abs(pixel_format.to_bgr(i420, pixel_format.I420) - frame).max() < 8
+    luma = pixel_format.luma(i420, pixel_format.I420)
+    assert luma.shape == (48, 86) and np.shares_memory(luma, i420)
+    # odd sizes are cropped to even ones
+    assert pixel_format.from_bgr(frame[:47, :85], pixel_format.I420).shape == (69, 84)
+
+    # the header carries the pixel format and the image size
+    meta = frame_meta(i420, 3, frame_codec.RAW, pixfmt=pixel_format.I420)
+    encoded = RedisShmem.encodeFrame(i420, meta=meta)
+    decoded, meta = RedisShmem.decodeFrameMeta(encoded)
+    assert np.array_equal(decoded, i420)
+    assert (meta.h, meta.w, meta.pixfmt) == (48, 86, pixel_format.I420)
+
+    # the buffers store frames as converted by the capture
+    cfg_gray = {section: dict(values) for section, values in config.items()}
+    cfg_gray["APP"]["cam_name"] = "GRAY_CAM"
+    cfg_gray["defaultArgs"].update({"--width": "86", "--height": "48"})
+    cfg_gray["Analysis"]["pixel_format"] = "gray"
+    cfg_gray["redis"]["codec"] = "lossless"
+    shmem = RedisShmem(cfg_gray)
+    gray = pixel_format.from_bgr(frame, pixel_format.GRAY)
+    shmem.put_Q(gray)
+    shmem.flush()
+    decoded, grabbed, meta = shmem.getFrame()
+    assert grabbed and decoded is not None and np.array_equal(decoded, gray)
+    assert meta is not None and meta.pixfmt == pixel_format.GRAY
+    cfg_gray["Analysis"]["pixel_format"] = "i420"
+    ring = ShmRing(cfg_gray, producer=True)
+    try:
+        assert ring.frame_bytes == 86 * 48 * 3 // 2
+        ring.put_Q(i420)
+        decoded, grabbed, meta = ring.getFrame()
+        assert grabbed and decoded is not None and np.array_equal(decoded, i420)
+        assert meta is not None and (meta.h, meta.pixfmt) == (48, pixel_format.I420)
+        del decoded
+    finally:
+        ring.close()
+
+
+def test_change_gate() -> None:
+    """Test the gate publishes changed frames, and a heartbeat of static ones."""
+    gate = ChangeGate(config["gate"])
+    sec = 1_000_000_000
+    frame = np.full((48, 86, 3), 64, dtype=np.uint8)
+    # the first frame is published, the static ones only for the heartbeat
+    assert gate.admit(frame, 1) == (True, 1.0)
+    assert [gate.admit(frame, 1 + i * sec)[0] for i in range(1, 7)] == [
+        False,
+        False,
+        False,
+        False,
+        True,
+        False,
+    ]
+    assert not gate.active(1 + 6 * sec)
+    # a changed region is published and keeps the scene active
+    moved = frame.copy()
+    moved[10:30, 20:50] = 200
+    publish, score = gate.admit(moved, 7 * sec)
+    assert publish and score >= gate.threshold
+    assert gate.active(8 * sec) and not gate.active(11 * sec)
+
+    # the header carries the score
+    meta = frame_meta(frame, 3, frame_codec.RAW, score=0.25, flags=HEARTBEAT)
+    meta, _ = unpack(RedisShmem.encodeFrame(frame, meta=meta))
+    assert meta.score == 0.25 and meta.flags == HEARTBEAT
+    # headers of another version are rejected
+    with pytest.raises(ValueError):
+        unpack(b"VF\x02" + bytes(HEADER.size))
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+def test_ffmpegwriter_pix_fmt(tmp_path: str) -> None:
+    """Test the ffmpeg writer takes compact frames as they are buffered."""
+    frame = np.zeros((48, 86, 3), dtype=np.uint8)
+    for name, pixfmt in pixel_format.PIXEL_FORMATS.items():
+        fileName = os.path.join(tmp_path, f"{name}.mp4")
+        writer = ffmpegwriter(
+            fileName, "libx264", 12, 86, 48, pixel_format.FFMPEG_PIX_FMTS[pixfmt]
+        )
+        for _ in range(6):
+            writer.write(pixel_format.from_bgr(frame, pixfmt))
+        writer.close()
+        stream = cv2.VideoCapture(fileName)
+        frames = 0
+        while stream.read()[0]:
+            frames += 1
+        stream.release()
+        assert frames == 6
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+def test_keyframe_capture(tmp_path: str) -> None:
+    """Test keyframe-only decoding of a local file."""
+    # one second at 30 fps with a keyframe every 10 frames
+    src = os.path.join(tmp_path, "keyframes.mp4")
+    ffmpeg.input("testsrc=size=86x48:rate=30", f="lavfi", t=1).output(
+        src, vcodec="mpeg4", g=10
+    ).run(quiet=True)
+
+    stream = KeyframeCapture(src, (86, 48))
+    pts = []
+    while True:
+        grabbed, frame = stream.read()
+        if not grabbed:
+            break
+        assert frame is not None and frame.shape == (48, 86, 3)
+        pts.append(stream.get(cv2.CAP_PROP_POS_MSEC))
+    stream.release()
+    assert len(pts) == 3
+    assert pts == sorted(pts)
+
+    # a PTS logged too late is skipped, not paired with the next keyframe
+    stream.pts = Queue()
+    stream.frames = stream.pts_read = 0
+    assert math.isnan(stream.frame_pts(timeout=0.01))
+    stream.pts.put(0.0)
+    stream.pts.put(333.0)
+    assert stream.frame_pts(timeout=0.01) == 333.0
+
+    # an RTSP source is given a socket timeout, so a stalled one fails
+    stream = KeyframeCapture("rtsp://127.0.0.1:1/none", (86, 48), 500)
+    args = stream.process.args
+    assert args[args.index("-timeout") + 1] == "500000"
+    assert not stream.grab()
+    stream.release()
+
+
+def test_frame_pool() -> None:
+    """Test pooled raw payloads are reused once the pool is warm."""
+    pool = FramePool(2)
+    frame = np.full((48, 86, 3), 9, dtype=np.uint8)
+    for seq in range(10):
+        meta = frame_meta(frame, seq, frame_codec.RAW)
+        payload = RedisShmem.encodeFrameInto(frame, meta, pool)
+        decoded, decoded_meta = RedisShmem.decodeFrameMeta(bytes(payload))
+        assert np.array_equal(decoded, frame) and decoded_meta.seq == seq
+    assert pool.allocations == 2
+
+
+def test_pacer() -> None:
+    """Test deadlines stay on the grid and overruns are skipped."""
+    pacer = Pacer(100)
+    pacer.start()
+    tic = time.monotonic()
+    for _ in range(20):
+        pacer.wait()
+    assert 0.19 < time.monotonic() - tic < 0.3
+    # overrun by several periods: the missed slots are skipped, not replayed
+    time.sleep(0.055)
+    pacer.wait()
+    assert pacer.missed == 1 and pacer.skipped >= 4
+    tic = time.monotonic()
+    pacer.wait()
+    assert time.monotonic() - tic < 0.011
+
+
+def test_metrics(tmp_path) -> None:  # type: ignore
+    """Test histogram percentiles, rates and the text dump."""
+    reg = metrics.registry("TEST_CAM")
+    hist = reg.histogram("read_ms")
+    for value in range(1, 101):
+        hist.observe(value / 10)
+    assert hist.count == 100 and hist.percentile(0.5) == 5
+    assert hist.percentile(0.99) == 10
+    rate = reg.rate("frames_read")
+    rate.mark(30)
+    assert rate.total == 30 and rate.rate() >= 0
+    reg.counter("frames_dropped").inc(2)
+    reg.gauge("queue_depth").set(7)
+    dump = tmp_path / "metrics.prom"
+    exporter = metrics.MetricsExporter(dump_path=str(dump))
+    exporter.dump()
+    text = dump.read_text()
+    assert 'videoio_frames_dropped{camera="TEST_CAM"} 2' in text
+    assert 'videoio_queue_depth{camera="TEST_CAM"} 7' in text
+    assert 'videoio_read_ms_bucket{camera="TEST_CAM",le="+Inf"} 100' in text
+
+    # several writer threads, and a reader, lose no update
+    reg = metrics.registry("THREADS_CAM")
+
+    def work() -> None:
+        for _ in range(20000):
+            reg.counter("frames_written").inc()
+            reg.rate("bytes_written").mark(2)
+            reg.histogram("clip_drain_ms").observe(1)
+            reg.rate("bytes_written").rate()
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert reg.counter("frames_written").value == 80000
+    assert reg.rate("bytes_written").total == 160000
+    assert reg.histogram("clip_drain_ms").count == 80000
+
+
+def test_tracing() -> None:
+    """Test traced frames carry their grab time and stage latencies add up."""
+    tracer = tracing.Tracer("TRACE_CAM", sample=2, slow_ms=1)
+    grab_ns = time.monotonic_ns()
+    assert tracer.begin(grab_ns) is None
+    trace = tracer.begin(grab_ns)
+    assert trace is not None
+    for stage in tracing.STAGES:
+        trace.stamp(stage)
+    trace.seq = 3
+    tracer.finish(trace)
+    frame = np.zeros((4, 4, 3), dtype=np.uint8)
+    meta = frame_meta(frame, 3, frame_codec.RAW, grab_ns=grab_ns, flags=TRACED)
+    meta, _ = unpack(RedisShmem.encodeFrame(frame, meta=meta))
+    assert meta.mono_ns == grab_ns and meta.flags & TRACED
+    time.sleep(0.002)
+    tracer.read(meta)
+    assert set(tracer.percentiles()) == set(tracing.STAGES) | {"read", "total"}
+    slow = tracer.slow_frames[0]
+    assert slow["seq"] == 3 and slow["total_ms"] >= 2
+    assert (
+        abs(sum(slow[s] for s in tracing.STAGES + ("read",)) - slow["total_ms"]) < 0.1
+    )
+
+
+def test_backpressure_policies() -> None:
+    """Test the capture and read policies drop and count the right frames."""
+    cfg_bp = {section: dict(values) for section, values in config.items()}
+    cfg_bp["APP"]["cam_name"] = "BP_CAM"
+    cfg_bp["redis"].update(mode="list", pub_batch="1", encode_workers="0")
+    cfg_bp["Analysis"].update(capture_policy="drop-newest", read_policy="latest")
+    frame = np.zeros((48, 86, 3), dtype=np.uint8)
+    shmem = RedisShmem(cfg_bp)
+    for _ in range(shmem.q_size + 3):
+        shmem.put_Q(frame)
+    assert shmem.qsize() == shmem.q_size
+    _, grabbed, meta = shmem.getFrame()
+    # drop-newest kept the first q_size frames; latest reads the newest of them
+    assert grabbed and meta is not None and meta.seq == shmem.q_size - 1
+    assert shmem.consumer_stats()["dropped"] == shmem.q_size - 1 and shmem.empty()
+    shmem.close()
+
+    # a latest reader gets the last frame put, even while batching would hold
+    # frames back
+    cfg_bp["redis"]["pub_batch"] = "4"
+    cfg_bp["Analysis"].update(capture_policy="drop-oldest", read_policy="latest")
+    shmem = RedisShmem(cfg_bp)
+    for _ in range(shmem.q_size + 3):
+        shmem.put_Q(frame)
+    _, grabbed, meta = shmem.getFrame()
+    assert grabbed and meta is not None and meta.seq == shmem.q_size + 2
+    shmem.close()
+
+    cfg_bp["Analysis"].update(capture_policy="latest", read_policy="block")
+    ring = ShmRing(cfg_bp, producer=True)
+    try:
+        for i in range(5):
+            ring.put_Q(np.full((48, 86, 3), i, dtype=np.uint8))
+        assert ring.qsize() == 1
+        frame, grabbed, meta = ring.getFrame(copy=True)
+        assert grabbed and meta is not None and meta.seq == 4
+    finally:
+        ring.close()
+
+    cfg_bp["redis"]["mode"] = "stream"
+    cfg_bp["Analysis"]["capture_policy"] = "block"
+    with pytest.raises(ValueError):
+        RedisShmem(cfg_bp)
+
+
+def test_blocked_read_of_a_burst() -> None:
+    """Test a read waiting on an empty queue takes one frame of a burst."""
+    cfg_wake = {section: dict(values) for section, values in config.items()}
+    cfg_wake["APP"]["cam_name"] = "WAKE_CAM"
+    cfg_wake["redis"].update(mode="list", pub_batch="1", encode_workers="0")
+    cfg_wake["Analysis"].update(backend="redis", read_policy="block")
+    db = helpers.connect_redis(
+        cfg_wake["redis"]["host"], int(cfg_wake["redis"]["port"])
+    )
+    key = queue_key(cfg_wake)
+    burst = [
+        RedisShmem.encodeFrame(np.full((48, 86, 3), i, dtype=np.uint8))
+        for i in range(3)
+    ]
+
+    def publish() -> threading.Timer:
+        db.delete(key)
+        timer = threading.Timer(0.2, lambda: db.rpush(key, *burst))
+        timer.start()
+        return timer
+
+    shmem = RedisShmem(cfg_wake)
+    timer = publish()
+    batch = shmem.read_batch(1, timeout=2)
+    timer.join()
+    assert batch is not None and batch.size == 1 and batch.frames[0, 0, 0, 0] == 0
+    assert shmem.qsize() == 2
+    shmem.close()
+
+    async def read_one() -> None:
+        reader = aio.reader(cfg_wake)
+        timer = publish()
+        frame, grabbed, _ = await reader.read(timeout=2)
+        timer.join()
+        assert grabbed and frame is not None and frame[0, 0, 0] == 0
+        assert db.llen(key) == 2
+        await reader.close()
+
+    asyncio.run(read_one())
+    db.delete(key)
+
+
+def test_producer_waits() -> None:
+    """Test the producer's waits wake on put_Q, reads and notify()."""
+    cfg_wait = {section: dict(values) for section, values in config.items()}
+    cfg_wait["APP"]["cam_name"] = "WAIT_CAM"
+    cfg_wait["redis"].update(mode="list", pub_batch="1", encode_workers="0")
+    cfg_wait["Analysis"].update(capture_policy="block", read_policy="block")
+    frame = np.zeros((48, 86, 3), dtype=np.uint8)
+    helpers.connect_redis(
+        cfg_wait["redis"]["host"], int(cfg_wait["redis"]["port"])
+    ).delete(queue_key(cfg_wait))
+    shmem = RedisShmem(cfg_wait, producer=True)
+
+    def waited(wait: Any, trigger: Any) -> Any:
+        timer = threading.Timer(0.2, trigger)
+        start = time.monotonic()
+        timer.start()
+        done = wait()
+        timer.join()
+        return done, time.monotonic() - start
+
+    done, elapsed = waited(
+        lambda: shmem.wait_qsize(1, timeout=5), lambda: shmem.put_Q(frame)
+    )
+    assert done and 0.15 < elapsed < 2
+
+    stopped = threading.Event()
+
+    def stop() -> None:
+        stopped.set()
+        shmem.notify()
+
+    done, elapsed = waited(
+        lambda: shmem.wait_qsize(shmem.q_size + 1, timeout=5, abort=stopped.is_set),
+        stop,
+    )
+    assert not done and elapsed < 2
+
+    while shmem.qsize() < shmem.q_size:
+        shmem.put_Q(frame)
+    done, elapsed = waited(lambda: shmem.wait_space(timeout=5), lambda: shmem.get_Q(1))
+    assert done and elapsed < 2 and shmem.qsize() == shmem.q_size - 1
+    shmem.close()
+
+
+@pytest.mark.parametrize("policy", ["drop-oldest", "block"])
+def test_batched_publish_rate(policy: str) -> None:
+    """Test batching keeps the frame rate of a reader waiting on a full queue."""
+    cfg_rate = {section: dict(values) for section, values in config.items()}
+    cfg_rate["APP"]["cam_name"] = "RATE_CAM"
+    cfg_rate["redis"].update(mode="list", pub_batch="4", encode_workers="0")
+    cfg_rate["Analysis"].update(
+        capture_policy=policy, read_policy="block", fps_van="20", buf_sec="1"
+    )
+    frame = np.zeros((48, 86, 3), dtype=np.uint8)
+    helpers.connect_redis(
+        cfg_rate["redis"]["host"], int(cfg_rate["redis"]["port"])
+    ).delete(queue_key(cfg_rate))
+    producer = RedisShmem(cfg_rate, producer=True)
+    reader = RedisShmem(cfg_rate)
+    stopped = threading.Event()
+
+    def capture() -> None:
+        # a 50 fps camera, paced like the capture loop
+        pacer = Pacer(50)
+        pacer.start()
+        while not stopped.is_set():
+            if producer.capture_policy == "block":
+                producer.wait_space(abort=stopped.is_set)
+            producer.put_Q(frame)
+            pacer.wait()
+
+    thread = threading.Thread(target=capture)
+    thread.start()
+    try:
+        reader.wait_qsize(reader.q_size, timeout=5)
+        # the demo loop: read, wait for a full buffer, pace to FPS_VAN
+        pacer = Pacer(reader.fps_van)
+        pacer.start()
+        seqs = []
+        tic = time.monotonic()
+        while time.monotonic() - tic < 2:
+            _, grabbed, meta = reader.getFrame()
+            if grabbed and meta is not None:
+                seqs.append(meta.seq)
+            reader.wait_qsize(reader.q_size, timeout=1)
+            pacer.wait()
+        assert len(set(seqs)) >= 0.8 * 2 * reader.fps_van
+    finally:
+        stopped.set()
+        producer.notify()
+        thread.join()
+        producer.close()
+        reader.close()
+
+
+def test_read_batch() -> None:
+    """Test batched reads stack frames and metadata in publish order."""
+    cfg_batch = {section: dict(values) for section, values in config.items()}
+    cfg_batch["APP"]["cam_name"] = "BATCH_CAM"
+    cfg_batch["redis"].update(mode="list", pub_batch="1", codec="lossless")
+    cfg_batch["Analysis"].update(backend="redis", read_policy="block")
+    shmem = RedisShmem(cfg_batch)
+    for i in range(10):
+        shmem.put_Q(np.full((48, 86, 3), i, dtype=np.uint8), pts_us=i * 1000)
+    shmem.flush()
+    batch = shmem.read_batch(4, timeout=1)
+    assert batch is not None and batch.frames.shape == (4, 48, 86, 3)
+    assert list(batch.seq) == [0, 1, 2, 3] and list(batch.pts_us) == [
+        0,
+        1000,
+        2000,
+        3000,
+    ]
+    assert all(batch.frames[i, 0, 0, 0] == i for i in range(4))
+    batch = shmem.read_batch(8, timeout=1)
+    assert batch is not None and list(batch.seq) == [4, 5, 6, 7, 8, 9]
+    shmem.close()
+
+    ring = ShmRing(cfg_batch, producer=True)
+    try:
+        for i in range(5):
+            ring.put_Q(np.full((48, 86, 3), i, dtype=np.uint8))
+        batch = ring.read_batch(3)
+        assert batch is not None and list(batch.seq) == [0, 1, 2]
+        assert batch.frames[2, 0, 0, 0] == 2 and ring.qsize() == 2
+    finally:
+        ring.close()
+
+
+def test_async_reader() -> None:
+    """Test awaited reads, batches, timeouts, cancellation and async for."""
+    cfg_aio = {section: dict(values) for section, values in config.items()}
+    cfg_aio["APP"]["cam_name"] = "AIO_CAM"
+    cfg_aio["redis"].update(mode="list", pub_batch="1", encode_workers="0")
+    cfg_aio["Analysis"].update(backend="redis", read_policy="block")
+    shmem = RedisShmem(cfg_aio)
+    for i in range(6):
+        shmem.put_Q(np.full((48, 86, 3), i, dtype=np.uint8))
+
+    async def consume() -> None:
+        reader = aio.reader(cfg_aio)
+        frame, grabbed, meta = await reader.read()
+        assert grabbed and meta is not None and meta.seq == 0
+        batch = await reader.read_batch(3)
+        assert batch is not None and list(batch.seq) == [1, 2, 3]
+        seqs = []
+        async for frame, meta in reader:
+            seqs.append(meta.seq)
+            if len(seqs) == 2:
+                break
+        assert seqs == [4, 5]
+        # an empty queue times out without blocking the loop
+        tic = time.monotonic()
+        _, grabbed, _ = await reader.read(timeout=1)
+        assert not grabbed and time.monotonic() - tic < 2
+        task = asyncio.ensure_future(reader.read(timeout=10))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await reader.close()
+
+    asyncio.run(consume())
+    # the base reader only adds iteration to a concrete read()
+    with pytest.raises(TypeError):
+        aio.AsyncReader()  # type: ignore
+    shmem.close()
+
+
+def test_camera_sections() -> None:
+    """Test per-camera config sections and the restart backoff."""
+    from videoio.utils.helpers import backoff
+
+    cfg_cams = {section: dict(values) for section, values in config.items()}
+    assert list(cfg.cameras(cfg_cams)) == [cfg_cams["APP"]["cam_name"]]
+    cfg_cams["camera:CAM_A"] = {"--src": "a.mp4"}
+    cfg_cams["camera:CAM_B"] = {"analysis.fps_van": "3", "redis.mode": "stream"}
+    cams = cfg.cameras(cfg_cams)
+    assert list(cams) == ["CAM_A", "CAM_B"]
+    assert cams["CAM_A"]["defaultArgs"]["--src"] == "a.mp4"
+    assert cams["CAM_A"]["APP"]["cam_name"] == "CAM_A"
+    assert cams["CAM_B"]["Analysis"]["fps_van"] == "3"
+    assert cams["CAM_B"]["redis"]["mode"] == "stream"
+    # overrides do not leak into the base config or the other cameras
+    assert cams["CAM_A"]["Analysis"]["fps_van"] == config["Analysis"]["fps_van"]
+    assert cfg_cams["defaultArgs"]["--src"] == config["defaultArgs"]["--src"]
+    for attempt in range(10):
+        delay = backoff(attempt, 30)
+        assert min(30, 2**attempt) / 2 <= delay <= min(30, 2**attempt)
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+def test_reconnect(tmp_path: str) -> None:
+    """Test the capture reopens a lost source and keeps its buffer and writer."""
+    src = os.path.join(tmp_path, "reconnect.mp4")
+    ffmpeg.input("testsrc=size=86x48:rate=30", f="lavfi", t=1).output(src).run(
+        quiet=True
+    )
+    cfg_rc = {section: dict(values) for section, values in config.items()}
+    cfg_rc["APP"]["cam_name"] = "RECONNECT_CAM"
+    cfg_rc["defaultArgs"].update({"--src": src, "--decimate": "0", "--verbose": "0"})
+    cfg_rc["Analysis"].update(backend="shm", capture_policy="drop-oldest")
+    cfg_rc["reconnect"] = {"max_backoff": "0.2", "max_retries": "3"}
+    rvc = RedisVideoCapture(cfg_rc)
+    shmem, writer = rvc.shmem, rvc.writer
+    rvc.start()
+    # the end of the file is a lost source: it is reopened from the start
+    deadline = time.monotonic() + 10
+    while not rvc.metrics.histogram("reconnect_ttff_ms").count:
+        assert time.monotonic() < deadline
+        rvc.read()
+    assert rvc.metrics.counter("reconnects").value >= 1
+    assert rvc.shmem is shmem and rvc.writer is writer
+    # once the source is gone for good, the capture fails after max_retries
+    os.remove(src)
+    while not rvc.capture_failed:
+        assert time.monotonic() < deadline
+        rvc.read()
+    rvc.stop()
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+def test_decimation(tmp_path: str) -> None:
+    """Test decimation publishes at FPS_VAN, and is off by default."""
+    src = os.path.join(tmp_path, "decimate.mp4")
+    ffmpeg.input("testsrc=size=86x48:rate=30", f="lavfi", t=2).output(src).run(
+        quiet=True
+    )
+
+    def published(decimate: Optional[str]) -> Tuple[RedisVideoCapture, int]:
+        cfg_dec = {section: dict(values) for section, values in config.items()}
+        cfg_dec["APP"]["cam_name"] = f"DECIMATE_{decimate}_CAM"
+        cfg_dec["defaultArgs"].update({"--src": src, "--verbose": "0"})
+        if decimate is not None:
+            cfg_dec["defaultArgs"]["--decimate"] = decimate
+        cfg_dec["Analysis"].update(backend="shm", capture_policy="drop-oldest")
+        cfg_dec["record"]["rec_dir"] = str(tmp_path)
+        cfg_dec["reconnect"] = {"max_backoff": "0.2", "max_retries": "1"}
+        rvc = RedisVideoCapture(cfg_dec)
+        # the file stays readable, but the capture ends once it cannot reopen it
+        if os.path.exists(src):
+            os.rename(src, src + ".gone")
+        rvc.start()
+        deadline = time.monotonic() + 20
+        while not rvc.capture_failed:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+        count = rvc.shmem.metrics.rate("frames_published").total
+        rvc.stop()
+        os.rename(src + ".gone", src)
+        return rvc, count
+
+    # every frame of the file is published by default, but the first one,
+    # read when the capture is opened
+    rvc, count = published(None)
+    assert not rvc.decimate and count == 59
+    # pooled buffers are reused once warm, and the exporter shows it
+    allocations = rvc.metrics.gauge("allocations_per_frame").value
+    assert 0 < allocations < 1
+    # decimation decodes only the frames due at FPS_VAN, 2 s of which
+    rvc, count = published("1")
+    fps_van = int(config["Analysis"]["fps_van"])
+    assert rvc.decimate and abs(count - 2 * fps_van) <= 2
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+def test_drop_oldest_read_loop(tmp_path: str) -> None:
+    """Test a drop-oldest reader of the demo loop keeps up with the capture."""
+    src = os.path.join(tmp_path, "drop_oldest.mp4")
+    ffmpeg.input("testsrc=size=86x48:rate=25", f="lavfi", t=5).output(src).run(
+        quiet=True
+    )
+    cfg_drop = {section: dict(values) for section, values in config.items()}
+    cfg_drop["APP"]["cam_name"] = "DROP_OLDEST_CAM"
+    cfg_drop["defaultArgs"].update({"--src": src, "--verbose": "0", "--fps_rdg": "25"})
+    cfg_drop["defaultArgs"].update({"--width": "86", "--height": "48"})
+    cfg_drop["Analysis"].update(capture_policy="drop-oldest", read_policy="drop-oldest")
+    cfg_drop["redis"].update(mode="list", pub_batch="1", encode_workers="0")
+    cfg_drop["record"]["rec_dir"] = str(tmp_path)
+    helpers.connect_redis(
+        cfg_drop["redis"]["host"], int(cfg_drop["redis"]["port"])
+    ).delete(queue_key(cfg_drop))
+    rvc = RedisVideoCapture(cfg_drop)
+    rvc.start()
+    try:
+        # the demo loop, unpaced: read, then wait on the frame buffer
+        seqs = []
+        tic = time.monotonic()
+        while time.monotonic() - tic < 2:
+            _, grabbed, meta = rvc.read()
+            if grabbed and meta is not None:
+                seqs.append(meta.seq)
+            rvc.waitOnFrameBuf()
+        # about 25 fps for 2 s, not one frame per Buf_Sec
+        assert len(set(seqs)) >= 30
+    finally:
+        rvc.stop()
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+def test_gated_capture(tmp_path: str) -> None:
+    """Test a gated capture records static frames and waits for one frame."""
+    cfg_gate = {section: dict(values) for section, values in config.items()}
+    cfg_gate["APP"]["cam_name"] = "GATED_CAM"
+    cfg_gate["defaultArgs"].update(
+        {"--src": os.path.join(tmp_path, "none.mp4"), "--verbose": "0"}
+    )
+    cfg_gate["defaultArgs"].update({"--width": "160", "--height": "120"})
+    cfg_gate["Analysis"].update(backend="shm", capture_policy="drop-oldest")
+    cfg_gate["record"].update(rec_dir=str(tmp_path), writer_pool="0")
+    cfg_gate["gate"] = dict(cfg_gate["gate"], enabled="1")
+    rvc = RedisVideoCapture(cfg_gate)
+    try:
+        assert rvc.gate_records
+        frame = np.full((120, 160, 3), 64, dtype=np.uint8)
+        for i in range(5):
+            rvc.pos_msec = 1 + i * 1000 / rvc.writer.fps
+            rvc.update_grabbed(frame)
+        # a static scene publishes its first frame only, and records them all
+        assert rvc.shmem.qsize() == 1
+        rvc.writer.raw_Q.join()
+        assert rvc.writer.qsize() == 5
+        tic = time.monotonic()
+        rvc.waitOnFrameBuf()
+        assert time.monotonic() - tic < 1
+    finally:
+        rvc.stream.release()
+        rvc.writer.close()
+        for buffer in rvc.buffers():
+            buffer.close()
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+@pytest.mark.parametrize("fps", [30, 8])
+def test_gated_recording_duration(tmp_path: str, fps: int) -> None:
+    """Test a gated recording keeps real time at a capture rate != FPS_REC."""
+    cfg_gate = {section: dict(values) for section, values in config.items()}
+    cfg_gate["APP"]["cam_name"] = "GATED_REC_CAM"
+    cfg_gate["defaultArgs"].update(
+        {"--src": os.path.join(tmp_path, "none.mp4"), "--verbose": "0"}
+    )
+    cfg_gate["defaultArgs"].update({"--width": "160", "--height": "120"})
+    cfg_gate["Analysis"].update(backend="shm", capture_policy="drop-oldest")
+    cfg_gate["record"].update(
+        rec_dir=str(tmp_path), writer_pool="0", rec_file_ext="avi", fps_rec="12"
+    )
+    # no frame is dropped for the queue of the recording
+    cfg_gate["record"].update(writer_queue="1000", buf_max_mb="0")
+    cfg_gate["gate"] = dict(cfg_gate["gate"], enabled="1")
+    rvc = RedisVideoCapture(cfg_gate)
+    try:
+        clip = rvc.writer.recStart(datetime.datetime.now(), "gated")
+        frame = np.full((120, 160, 3), 64, dtype=np.uint8)
+        # 3 s of a static scene, captured at `fps`
+        for i in range(3 * fps):
+            rvc.pos_msec = 1 + i * 1000 / fps
+            rvc.update_grabbed(frame)
+            rvc.writer.raw_Q.join()
+        rvc.writer.recStop()
+        assert clip.wait(10)
+        video = cv2.VideoCapture(clip.fileName)
+        duration = video.get(cv2.CAP_PROP_FRAME_COUNT) / video.get(cv2.CAP_PROP_FPS)
+        video.release()
+        assert abs(duration - 3) <= 2 / 12
+    finally:
+        rvc.stream.release()
+        rvc.writer.close()
+        for buffer in rvc.buffers():
+            buffer.close()
+
+
+def test_outputs(tmp_path: str) -> None:
+    """Test extra sizes and crops are published to their own buffers."""
+    src = os.path.join(tmp_path, "outputs.mp4")
+    ffmpeg.input("testsrc=size=320x240:rate=30", f="lavfi", t=1).output(src).run(
+        quiet=True
+    )
+    cfg_out = {section: dict(values) for section, values in config.items()}
+    cfg_out["APP"]["cam_name"] = "OUTPUTS_CAM"
+    cfg_out["defaultArgs"].update(
+        {"--src": src, "--width": "160", "--height": "120", "--verbose": "0"}
+    )
+    cfg_out["Analysis"].update(backend="shm", capture_policy="block")
+    cfg_out["outputs"] = {
+        "thumb": "80x60",
+        "det": "64x64",
+        "roi": "32x16+8+4",
+        "edge": "32x16+300+230",
+        "outside": "32x16+400+0",
+    }
+    with pytest.raises(ValueError):
+        pyramid.outputs({"outputs": {"bad": "64"}})
+
+    rvc = RedisVideoCapture(cfg_out)
+    try:
+        assert sorted(rvc.outputs) == ["det", "edge", "outside", "roi", "thumb"]
+        frame = np.zeros((240, 320, 3), dtype=np.uint8)
+        frame[4:20, 8:40] = 200
+        rvc.update_grabbed(frame)
+        for name, shape in (("thumb", (60, 80, 3)), ("det", (64, 64, 3))):
+            out_cfg = pyramid.output_config(cfg_out, name)
+            assert out_cfg["Analysis"]["capture_policy"] == "drop-oldest"
+            img, grabbed, meta = ShmRing(out_cfg).getFrame()
+            assert grabbed and img is not None and img.shape == shape
+            assert meta is not None and meta.seq == 0
+        roi, _, _ = ShmRing(pyramid.output_config(cfg_out, "roi")).getFrame()
+        assert roi is not None and roi.shape == (16, 32, 3) and (roi == 200).all()
+        # crops are clipped to the decoded frame
+        edge, _, _ = ShmRing(pyramid.output_config(cfg_out, "edge")).getFrame()
+        assert edge is not None and edge.shape == (10, 20, 3)
+        # crops entirely outside it are not published
+        assert rvc.outputs["outside"].empty()
+        assert rvc.metrics.histogram("pyramid_ms").count == 1
+    finally:
+        rvc.stream.release()
+        rvc.writer.close()
+        for buffer in rvc.buffers():
+            buffer.close()
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+def test_passthrough_writer(tmp_path: str) -> None:
+    """Test a stream-copy recording starts on a buffered keyframe."""
+    # three seconds of H.264 at 30 fps with a keyframe every 15 frames
+    src = os.path.join(tmp_path, "passthrough.mp4")
+    ffmpeg.input("testsrc=size=320x240:rate=30", f="lavfi", t=3).output(
+        src, vcodec="libx264", g=15
+    ).run(quiet=True)
+    cfg_pt = {section: dict(values) for section, values in config.items()}
+    cfg_pt["APP"]["cam_name"] = "PASSTHROUGH_CAM"
+    cfg_pt["defaultArgs"].update({"--src": src, "--verbose": "0"})
+    cfg_pt["record"].update(mode="passthrough", rec_dir=str(tmp_path), rec_buf_sec="1")
+    writer = PassthroughWriter(cfg_pt)
+    time.sleep(1.5)
+    assert writer.qsize() >= 2  # half-second GOPs covering the last second
+    writer.recStart(datetime.datetime.now(), "event")
+    time.sleep(0.5)
+    writer.recStop()
+    writer.close()
+
+    # the pre-event buffer and the live packets, at the source resolution
+    assert writer.videoFileName.endswith(".ts")
+    stream = cv2.VideoCapture(writer.videoFileName)
+    frames = 0
+    while True:
+        grabbed, frame = stream.read()
+        if not grabbed:
+            break
+        assert frame.shape == (240, 320, 3)
+        frames += 1
+    stream.release()
+    assert frames >= 45
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+def test_overlapping_passthrough(tmp_path: str) -> None:
+    """Test overlapping passthrough events are recorded to separate files."""
+    src = os.path.join(tmp_path, "overlap.mp4")
+    ffmpeg.input("testsrc=size=320x240:rate=30", f="lavfi", t=3).output(
+        src, vcodec="libx264", g=15
+    ).run(quiet=True)
+    cfg_pt = {section: dict(values) for section, values in config.items()}
+    cfg_pt["APP"]["cam_name"] = "OVERLAP_PT_CAM"
+    cfg_pt["defaultArgs"].update({"--src": src, "--verbose": "0"})
+    cfg_pt["record"].update(mode="passthrough", rec_dir=str(tmp_path), rec_buf_sec="1")
+    writer = PassthroughWriter(cfg_pt)
+    time.sleep(1.5)
+    writer.recStart(datetime.datetime.now(), "first")
+    first = writer.videoFileName
+    time.sleep(0.3)
+    writer.recStart(datetime.datetime.now(), "second")
+    second = writer.videoFileName
+    assert first != second and len(writer.files) == 2
+    time.sleep(0.3)
+    writer.recStop("first")
+    assert writer.recStarted and list(writer.files) == ["second"]
+    time.sleep(0.3)
+    writer.recStop("second")
+    assert not writer.recStarted
+    writer.close()
+
+    # both clips hold the pre-event buffer, then their live packets
+    counts = []
+    for path in (first, second):
+        stream = cv2.VideoCapture(path)
+        frames = 0
+        while stream.read()[0]:
+            frames += 1
+        stream.release()
+        counts.append(frames)
+    assert all(frames >= 45 for frames in counts)
+
+
+@pytest.mark.parametrize("mode", ["encode", "passthrough", "dvr"])
+def test_recording_not_permitted(tmp_path: str, mode: str) -> None:
+    """Test no writer is started without Rec_Permit."""
+    cfg_off = {section: dict(values) for section, values in config.items()}
+    cfg_off["APP"]["cam_name"] = "NO_REC_CAM"
+    cfg_off["defaultArgs"].update(
+        {"--src": os.path.join(tmp_path, "none.mp4"), "--verbose": "0"}
+    )
+    cfg_off["Analysis"].update(backend="shm")
+    cfg_off["record"].update(mode=mode, rec_dir=str(tmp_path), rec_permit="False")
+    rvc = RedisVideoCapture(cfg_off)
+    try:
+        assert not rvc.rec_permit and type(rvc.writer).__name__ == "NullWriter"
+        rvc.writer.update(np.zeros((480, 640, 3), dtype=np.uint8))
+        rvc.writer.recStart(datetime.datetime.now(), "event")
+        rvc.writer.recStop()
+        assert not rvc.writer.recStarted
+        time.sleep(0.5)
+        # nor is a segment ring created
+        assert not os.path.exists(os.path.join(tmp_path, "NO_REC_CAM"))
+    finally:
+        rvc.stream.release()
+        rvc.writer.close()
+        for buffer in rvc.buffers():
+            buffer.close()
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+def test_dvr_writer(tmp_path: str) -> None:
+    """Test event clips cut from the segment ring, and its eviction."""
+    src = os.path.join(tmp_path, "dvr.mp4")
+    ffmpeg.input("testsrc=size=320x240:rate=30", f="lavfi", t=3).output(
+        src, vcodec="libx264", g=15
+    ).run(quiet=True)
+    cfg_dvr = {section: dict(values) for section, values in config.items()}
+    cfg_dvr["APP"]["cam_name"] = "DVR_CAM"
+    cfg_dvr["defaultArgs"].update({"--src": src, "--verbose": "0"})
+    cfg_dvr["record"].update(
+        mode="dvr",
+        rec_dir=str(tmp_path),
+        rec_buf_sec="1",
+        rec_post_sec="0.5",
+        dvr_segment_sec="0.5",
+        dvr_max_mb="0",
+    )
+    writer = DvrWriter(cfg_dvr)
+    time.sleep(1.5)
+    writer.recStart(datetime.datetime.now(), "event")
+    time.sleep(0.3)
+    writer.recStop()
+    assert not os.path.exists(writer.videoFileName)  # waiting for the post-roll
+    time.sleep(0.8)
+    assert os.path.exists(writer.videoFileName)
+    assert writer.metrics.histogram("clip_ms").count == 1
+    writer.close()
+
+    # about 1 s of pre-roll, 0.3 s of event and 0.5 s of post-roll
+    stream = cv2.VideoCapture(writer.videoFileName)
+    frames = 0
+    while stream.read()[0]:
+        frames += 1
+    stream.release()
+    assert 40 <= frames <= 75
+    # segments outlive the writer, and the oldest are evicted by age
+    segments = os.listdir(writer.dvrDir)
+    assert len(segments) >= 3
+    writer.max_age = 1
+    writer.evict(time.time() + 10)
+    assert writer.qsize() == 1 and len(os.listdir(writer.dvrDir)) == 1
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+def test_dvr_writer_caps(tmp_path: str) -> None:
+    """Test the segment ring cap, and a clip that cannot be written."""
+    cfg_dvr = {section: dict(values) for section, values in config.items()}
+    cfg_dvr["APP"]["cam_name"] = "DVR_CAPS_CAM"
+    cfg_dvr["defaultArgs"].update(
+        {"--src": os.path.join(tmp_path, "none.mp4"), "--verbose": "0"}
+    )
+    cfg_dvr["record"].update(mode="dvr", rec_dir=str(tmp_path))
+    writer = DvrWriter(cfg_dvr)
+    try:
+        assert writer.max_bytes == int(config["record"]["dvr_max_mb"]) * 2**20
+        # the ring does not share the encoder's pre-event buffer, nor its cap
+        assert not isinstance(writer, video_writer)
+        assert not hasattr(writer, "buf_max_bytes")
+
+        # a clip that cannot be written is counted and leaves no partial file
+        errors = writer.metrics.counter("writer_errors").value
+        path = os.path.join(tmp_path, "clip.ts")
+        os.makedirs(path)
+        clip = (path, time.time() - 1, time.time())
+        writer.pending.append(clip)
+        writer.make_clip(*clip)
+        assert writer.metrics.counter("writer_errors").value == errors + 1
+        assert not os.path.exists(path + ".tmp") and not writer.pending
+    finally:
+        writer.close()
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+def test_overlapping_recordings(tmp_path: str) -> None:
+    """Test overlapping events are recorded as separate clips."""
+    cfg_rec = {section: dict(values) for section, values in config.items()}
+    cfg_rec["APP"]["cam_name"] = "CLIPS_CAM"
+    cfg_rec["defaultArgs"].update({"--width": "96", "--height": "64"})
+    cfg_rec["record"].update(
+        rec_dir=str(tmp_path),
+        rec_file_ext="mp4",
+        fps_rec="12",
+        rec_buf_sec="1",
+        writer_pool="0",
+        rec_workers="1",
+    )
+    writer = video_writer(cfg_rec)
+    frame = np.full((64, 96, 3), 128, dtype=np.uint8)
+
+    def feed(count: int) -> None:
+        for _ in range(count):
+            writer.update(frame)
+        writer.raw_Q.join()
+
+    feed(12)
+    first = writer.recStart(datetime.datetime.now(), "first")
+    feed(6)
+    second = writer.recStart(datetime.datetime.now(), "second")
+    assert writer.recStart(datetime.datetime.now(), "first") is first
+    feed(6)
+    writer.recStop("first")
+    assert writer.recStarted
+    feed(6)
+    writer.recStop("second")
+    assert not writer.recStarted
+    assert first.wait(10) and second.wait(10)
+    assert writer.metrics.rate("clips_recorded").total == 2
+
+    # each clip has the pre-event buffer and the live frames of its event
+    for clip in (first, second):
+        assert clip.frames_written == 24 and clip.dropped == 0
+        stream = cv2.VideoCapture(clip.fileName)
+        frames = 0
+        while stream.read()[0]:
+            frames += 1
+        stream.release()
+        assert frames == 24
+    writer.close()
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+def test_writer_pool(tmp_path: str) -> None:
+    """Test recordings use pre-spawned writers and keep every frame."""
+    cfg_rec = {section: dict(values) for section, values in config.items()}
+    cfg_rec["APP"]["cam_name"] = "POOL_CAM"
+    cfg_rec["defaultArgs"].update({"--width": "96", "--height": "64"})
+    cfg_rec["record"].update(
+        rec_dir=str(tmp_path),
+        rec_file_ext="mp4",
+        fps_rec="12",
+        rec_buf_sec="1",
+        writer_pool="1",
+    )
+    # temporary files of a previous run are removed, nothing is spawned idle
+    cam_dir = os.path.join(tmp_path, "POOL_CAM")
+    os.makedirs(cam_dir)
+    stale = os.path.join(cam_dir, ".%s.mp4" % ("0" * 32))
+    open(stale, "wb").close()
+    writer = video_writer(cfg_rec)
+    assert not os.path.exists(stale)
+    assert not writer.pool.fillers and not writer.pool.idle
+    frame = np.full((64, 96, 3), 128, dtype=np.uint8)
+    for _ in range(12):
+        writer.update(frame)
+    deadline = time.monotonic() + 5
+    while not writer.pool.idle:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    idle = writer.pool.idle[0]
+    clip = writer.recStart(datetime.datetime.now(), "event")
+    assert clip.writer is idle
+    for _ in range(12):
+        writer.update(frame)
+    writer.recStop()
+    assert clip.wait(10)
+    assert writer.metrics.histogram("rec_first_write_ms").count == 1
+
+    # the pre-event buffer and the live frames, under the final name
+    stream = cv2.VideoCapture(writer.videoFileName)
+    frames = 0
+    while stream.read()[0]:
+        frames += 1
+    stream.release()
+    assert frames == 24
+    # an idle writer that died is replaced, and its temporary file removed
+    deadline = time.monotonic() + 5
+    while not writer.pool.idle:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    dead = writer.pool.idle[0]
+    dead.process.kill()
+    dead.process.wait()
+    open(dead.fileName, "ab").close()
+    fresh = writer.pool.acquire()
+    assert fresh is not dead and not os.path.exists(dead.fileName)
+    fresh.discard()
+    # idle writers and their temporary files are gone after close
+    writer.close()
+    assert not [name for name in os.listdir(cam_dir) if name.startswith(".")]
+
+
+def test_compressed_prebuf(tmp_path: str) -> None:
+    """Test the pre-event buffer holds compressed frames under its byte cap."""
+    cfg_rec = {section: dict(values) for section, values in config.items()}
+    cfg_rec["APP"]["cam_name"] = "PREBUF_CAM"
+    cfg_rec["defaultArgs"].update({"--width": "96", "--height": "64"})
+    cfg_rec["record"].update(
+        rec_dir=str(tmp_path),
+        fps_rec="12",
+        rec_buf_sec="1",
+        writer_pool="0",
+        buf_codec="jpeg",
+        buf_max_mb="0",
+    )
+    writer = video_writer(cfg_rec)
+    frame = np.full((64, 96, 3), 128, dtype=np.uint8)
+    for _ in range(20):
+        writer.update(frame)
+    writer.raw_Q.join()
+    assert writer.qsize() == 12  # Rec_Buf_Sec of frames
+    assert writer.buffered_bytes == sum(len(item) for item in writer.frame_Q)
+    assert writer.buffered_bytes < 12 * frame.nbytes / 4
+    decoded = writer.decodeFrame(writer.frame_Q[0])
+    assert decoded.shape == frame.shape and abs(int(decoded[0, 0, 0]) - 128) <= 2
+
+    # beyond the byte cap the oldest frames are dropped
+    writer.buf_max_bytes = 3 * len(writer.frame_Q[0])
+    writer.update(frame)
+    writer.raw_Q.join()
+    assert writer.qsize() == 3 and writer.buffered_bytes <= writer.buf_max_bytes
+    assert writer.metrics.counter("writer_buffer_evicted").value == 9
+    writer.close()
+    assert not writer.raw_Q.unfinished_tasks
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+def test_prebuf_cap_counts_backlog(tmp_path: str) -> None:
+    """Test the byte cap counts pre-event frames a recording still holds."""
+    cfg_rec = {section: dict(values) for section, values in config.items()}
+    cfg_rec["APP"]["cam_name"] = "BACKLOG_CAM"
+    cfg_rec["defaultArgs"].update({"--width": "96", "--height": "64"})
+    cfg_rec["record"].update(
+        rec_dir=str(tmp_path),
+        fps_rec="12",
+        rec_buf_sec="1",
+        writer_pool="0",
+        buf_codec="raw",
+        writer_queue="100",
+    )
+    writer = video_writer(cfg_rec)
+    frame = np.full((64, 96, 3), 128, dtype=np.uint8)
+
+    def feed(count: int) -> None:
+        for _ in range(count):
+            writer.update(frame)
+            writer.raw_Q.join()
+
+    feed(12)
+    size = len(writer.frame_Q[0])
+    writer.buf_max_bytes = 18 * size
+    # the recording does not write its frames yet
+    writer.schedule = lambda clip: None  # type: ignore
+    clip = writer.recStart(datetime.datetime.now(), "event")
+    feed(24)
+    # its pre-event frames left the buffer, but are still counted
+    assert clip.orphans == len(clip.backlog) == 12
+    held = writer.buffered_bytes + clip.queued_bytes + clip.orphan_bytes
+    assert held <= writer.buf_max_bytes
+    assert writer.metrics.gauge("writer_buffer_bytes").value == held
+    assert clip.dropped > 0
+
+    del writer.schedule
+    with writer.buf_lock:
+        writer.schedule(clip)
+    writer.recStop()
+    assert clip.wait(10)
+    assert clip.orphans == clip.orphan_bytes == 0
+    writer.close()
+
+
+def test_writer_copies_frames(tmp_path: str) -> None:
+    """Test a frame overwritten after update() is buffered as it was given."""
+    cfg_rec = {section: dict(values) for section, values in config.items()}
+    cfg_rec["APP"]["cam_name"] = "COPY_CAM"
+    cfg_rec["defaultArgs"].update({"--width": "96", "--height": "64"})
+    cfg_rec["record"].update(
+        rec_dir=str(tmp_path), fps_rec="12", rec_buf_sec="1", writer_pool="0"
+    )
+    writer = video_writer(cfg_rec)
+    encode = writer.encodeFrame
+    release = threading.Event()
+
+    def held_encode(*args: Any) -> bytes:
+        release.wait(5)
+        return encode(*args)
+
+    writer.encodeFrame = held_encode  # type: ignore
+    # e.g. a zero-copy view of a ring slot, reused for the next frame
+    frame = np.full((64, 96, 3), 128, dtype=np.uint8)
+    writer.update(frame)
+    frame[...] = 0
+    release.set()
+    writer.raw_Q.join()
+    assert np.array_equal(
+        writer.decodeFrame(writer.frame_Q[0]), np.full_like(frame, 128)
+    )
+    writer.close()
+
+
+def test_recstop_under_load(tmp_path: str) -> None:
+    """Test recStop returns while frames arrive faster than they compress."""
+    cfg_rec = {section: dict(values) for section, values in config.items()}
+    cfg_rec["APP"]["cam_name"] = "LOAD_CAM"
+    cfg_rec["defaultArgs"].update({"--width": "96", "--height": "64"})
+    cfg_rec["record"].update(
+        rec_dir=str(tmp_path), fps_rec="12", rec_buf_sec="1", writer_pool="0"
+    )
+    writer = video_writer(cfg_rec)
+    encode = writer.encodeFrame
+
+    def slow_encode(*args: Any) -> bytes:
+        time.sleep(0.01)
+        return encode(*args)
+
+    writer.encodeFrame = slow_encode  # type: ignore
+    frame = np.full((64, 96, 3), 128, dtype=np.uint8)
+    feeding = threading.Event()
+
+    def feed() -> None:
+        while not feeding.is_set():
+            writer.update(frame)
+            time.sleep(0.002)
+
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    try:
+        clip = writer.recStart(datetime.datetime.now(), "event")
+        time.sleep(0.2)
+        tic = time.monotonic()
+        writer.recStop()
+        assert time.monotonic() - tic < 1
+        assert not writer.recStarted and clip.wait(10)
+    finally:
+        feeding.set()
+        feeder.join()
+        writer.close()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+"""Benchmarks for Perfect video Capture module.
+
+Usage:   bench.py codecs [--src=<path>] [--frames=<int>] [--quality=<int>]
+            bench.py keyframes [--src=<path>] [--seconds=<int>]
+            bench.py prebuf [--src=<path>] [--frames=<int>] [--quality=<int>]
+
+            bench.py -h | --help
+
+Options:
+    --src=<path>        Video file or RTSP url (default: --SRC from config.ini)
+    --frames=<int>      Number of frames to measure [default: 100]
+    --quality=<int>     JPEG quality [default: 90]
+    --seconds=<int>     Seconds of video to decode [default: 10]
+
+"""
+
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from collections import deque
+from typing import Callable, Dict, List, Tuple
+
+import cv2
+import numpy as np
+import utils.frame_codec as codecs
+from docopt import docopt
+from utils.keyframe_reader import KeyframeCapture
+from utils.redis_shmem import RedisShmem
+from utils.video_writer import video_writer
+
+lib_path = os.path.abspath(os.path.join(__file__, "..", ".."))
+sys.path.append(lib_path)
+from docs import config as cfg  # noqa: E402
+
+config_path = os.path.dirname(os.path.abspath(cfg.__file__))
+
+
+def read_frames(config: Dict, src: str, count: int) -> List[np.ndarray]:
+    """Read and resize `count` frames from the source."""
+    resolution = int(config["defaultArgs"]["--width"]), int(
+        config["defaultArgs"]["--height"]
+    )
+    stream = cv2.VideoCapture(src, cv2.CAP_FFMPEG)
+    frames: List[np.ndarray] = []
+    while len(frames) < count:
+        grabbed, frame = stream.read()
+        if not grabbed:
+            break
+        frames.append(cv2.resize(frame, resolution))
+    stream.release()
+    if not frames:
+        sys.exit(f"[ERROR] Could not read frames from {src}")
+    return frames
+
+
+def bench_codecs(config: Dict, frames: List[np.ndarray], quality: int) -> None:
+    """Report CPU cost against buffer bytes for every frame codec."""
+    q_size = int(config["Analysis"]["buf_sec"]) * int(config["Analysis"]["fps_van"])
+    raw_size = frames[0].nbytes
+    print(f"{len(frames)} frames of {frames[0].shape}, buffer of {q_size} frames")
+    print(
+        f"{'codec':>10} {'enc ms':>8} {'dec ms':>8} {'KB/frame':>9}"
+        f" {'ratio':>6} {'buffer MB':>10}"
+    )
+    for name, codec in codecs.CODECS.items():
+        tic = time.perf_counter()
+        encoded = [RedisShmem.encodeFrame(f, codec, quality) for f in frames]
+        enc = (time.perf_counter() - tic) / len(frames)
+        tic = time.perf_counter()
+        for item in encoded:
+            RedisShmem.decodeFrame(item)
+        dec = (time.perf_counter() - tic) / len(frames)
+        size = sum(len(item) for item in encoded) / len(encoded)
+        print(
+            f"{name:>10} {enc * 1000:8.2f} {dec * 1000:8.2f} {size / 1024:9.1f}"
+            f" {raw_size / size:6.1f} {size * q_size / 2**20:10.1f}"
+        )
+
+
+def children_cpu() -> float:
+    """Return the CPU seconds used by finished child processes."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def bench_keyframes(config: Dict, src: str, seconds: int) -> None:
+    """Report decode CPU of the normal capture against keyframe-only decoding."""
+    resolution = int(config["defaultArgs"]["--width"]), int(
+        config["defaultArgs"]["--height"]
+    )
+    print(f"{'mode':>10} {'frames':>7} {'cpu s':>7} {'cpu % core':>11}")
+
+    stream = cv2.VideoCapture(src, cv2.CAP_FFMPEG)
+    count = int(seconds * (stream.get(cv2.CAP_PROP_FPS) or 25))
+    frames = 0
+    tic = time.process_time()
+    while frames < count:
+        grabbed, frame = stream.read()
+        if not grabbed:
+            break
+        cv2.resize(frame, resolution)
+        frames += 1
+    cpu = time.process_time() - tic
+    stream.release()
+    print(f"{'normal':>10} {frames:7d} {cpu:7.2f} {100 * cpu / seconds:11.1f}")
+
+    tic, tic_children = time.process_time(), children_cpu()
+    keyframes = KeyframeCapture(src, resolution)
+    frames = 0
+    while keyframes.grab() and keyframes.get(cv2.CAP_PROP_POS_MSEC) < seconds * 1000:
+        frames += 1
+    keyframes.release()
+    cpu = time.process_time() - tic + children_cpu() - tic_children
+    print(f"{'keyframes':>10} {frames:7d} {cpu:7.2f} {100 * cpu / seconds:11.1f}")
+
+
+def fill_buffer(
+    frames: List[np.ndarray], size: int, encode: Callable[[np.ndarray], object]
+) -> Tuple[int, float]:
+    """Fill a pre-event buffer of `size` frames; return its bytes and encode s."""
+    buf: deque = deque(maxlen=size)
+    tracemalloc.start()
+    tic = time.perf_counter()
+    for i in range(size):
+        buf.appendleft(encode(frames[i % len(frames)]))
+    elapsed = time.perf_counter() - tic
+    ram = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return ram, elapsed / size
+
+
+def bench_prebuf(config: Dict, frames: List[np.ndarray], quality: int) -> None:
+    """Report the RAM of the recording pre-event buffer for every buffer codec."""
+    size = int(config["record"]["rec_buf_sec"]) * int(config["record"]["fps_rec"])
+    print(f"{len(frames)} frames of {frames[0].shape}, buffer of {size} frames")
+    print(f"{'buffer':>10} {'enc ms':>8} {'dec ms':>8} {'MB/camera':>10} {'ratio':>6}")
+    deque_ram, enc = fill_buffer(frames, size, np.copy)
+    print(
+        f"{'deque':>10} {enc * 1000:8.2f} {0:8.2f} {deque_ram / 2**20:10.1f} {1:6.1f}"
+    )
+    for name, codec in codecs.CODECS.items():
+        ram, enc = fill_buffer(
+            frames, size, lambda f: video_writer.encodeFrame(f, codec, quality)
+        )
+        encoded = [video_writer.encodeFrame(f, codec, quality) for f in frames]
+        tic = time.perf_counter()
+        for item in encoded:
+            video_writer.decodeFrame(item)
+        dec = (time.perf_counter() - tic) / len(encoded)
+        print(
+            f"{name:>10} {enc * 1000:8.2f} {dec * 1000:8.2f} {ram / 2**20:10.1f}"
+            f" {deque_ram / ram:6.1f}"
+        )
+
+
+def main() -> None:
+    """Implement the main function."""
+    arguments = docopt(__doc__)
+    config, default_args = cfg.read_ini(os.path.join(config_path, "config.ini"))
+    src = arguments["--src"]
+    if src is None:
+        src = default_args["--src"]
+
+    if arguments["codecs"]:
+        frames = read_frames(config, src, int(arguments["--frames"]))
+        bench_codecs(config, frames, int(arguments["--quality"]))
+    elif arguments["keyframes"]:
+        bench_keyframes(config, src, int(arguments["--seconds"]))
+    elif arguments["prebuf"]:
+        frames = read_frames(config, src, int(arguments["--frames"]))
+        bench_prebuf(config, frames, int(arguments["--quality"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,7 @@
 
 Usage:   videoio.py [--src=<RTSP-url>]
                         [--width=<pixel>] [--height=<pixel>]
-                        [--fps_rdg=<int>]
+                        [--fps_rdg=<int>] [--decimate=<int>] [--keyframes=<int>]
                         [--verbose=<int>]
 
             videoio.py -h | --help | --version
@@ -19,9 +19,10 @@ import socket
 import sys
 import time
 
-import utils.helpers as hvio
 from docopt import docopt
 from utils.fps import FPS
+from utils.metrics import exporter_from_config
+from utils.pacing import Pacer
 
 from videoio import RedisVideoCapture  # type: ignore
 
@@ -63,6 +64,8 @@ def main() -> None:
         # start the service
         if verbose == 2:
             print("[INFO] Starting service")
+        exporter = exporter_from_config(config)
+        exporter.start()
 
         while stop_bit:
 
@@ -73,34 +76,36 @@ def main() -> None:
             # start the FPS logger
             fps_log = FPS()
             fps_log.start()
+            pacer = Pacer(cap.fps_van, cap.pace_policy)
+            pacer.start()
 
-            # start the video reader main loop
-            while cap.stream.isOpened():
-                tic = time.time()
-
+            # start the video reader main loop; the capture reconnects by itself
+            while cap.started:
                 # Wait until the shared memory is empty if capture fails.
                 if cap.capture_failed and cap.shmem.empty():
                     break
 
                 # get the frame from the buffer
-                frame, grabbed, timestamp = cap.read()
+                frame, grabbed, meta = cap.read()
 
                 # Wait until the frame buffer is full
                 cap.waitOnFrameBuf()
 
                 # if the frame is grabbed, process it
-                if grabbed:
+                if grabbed and meta is not None:
                     frameID = next(c)  # increment frame ID
                     if verbose == 2:
                         print(
-                            f"{frameID}-th frame grabbed @ {timestamp}"
-                            f" and Q_size: {cap.shmem.qsize()}"
+                            f"{frameID}-th frame (seq {meta.seq}) grabbed @ {meta.timestamp}"
+                            f" age {meta.age_ms():.1f} ms and Q_size: {cap.shmem.qsize()}"
                         )
 
                 # if permited to record
                 if cap.rec_permit:
-                    # fill the buffer of the video writer
-                    cap.writer.update(frame)
+                    # fill the buffer of the video writer (no frame during an outage);
+                    # a gated capture feeds it every frame itself
+                    if grabbed and not cap.gate_records:
+                        cap.writer.update(frame)
 
                     # if we are not recording, start recording
                     if not cap.writer.recStarted and rec_event:
@@ -112,17 +117,19 @@ def main() -> None:
                         cap.writer.recStop()
 
                 # Try to keep FPS consistent
-                if cap.fps_van != 0:
-                    hvio.sleep_fps(tic, cap.fpsTime_van)
+                pacer.wait()
 
                 # update the FPS logger
                 fps_log.update()
                 if verbose == 1:
                     print(f"[INFO] approx. video analitic FPS: {fps_log.fps():.2f}")
 
-                # Some dummy conditions!
-                # recording event
-                if frameID in range(100, 200):
+                # recording event: a change of the scene, if gated
+                if cap.gate is not None:
+                    rec_event = cap.gate.active()
+
+                # Some dummy conditions otherwise!
+                elif frameID in range(100, 200):
                     if not rec_event:
                         rec_event = True
 
@@ -131,7 +138,7 @@ def main() -> None:
                     rec_event = False
 
                 # Loop exiting condition
-                elif frameID >= 300:
+                if frameID >= 300:
                     stop_bit = False
                     break
             # end while
@@ -143,6 +150,7 @@ def main() -> None:
             time.sleep(1)
             cap = None
 
+        exporter.stop()
         print("[INFO] Exiting service")
         time.sleep(3)
         print("By")
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+"""Multi-camera supervisor for Perfect video Capture module.
+
+Usage:   supervisor.py run [--workers=<int>] [--verbose=<int>]
+            supervisor.py status
+
+            supervisor.py -h | --help
+
+Options:
+    --workers=<int>     Number of worker processes (default: [supervisor] Workers)
+    --verbose=<int>     Verbose mode (default: --VERBOSE from config.ini)
+
+"""
+
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional, cast
+
+import utils.helpers as hvio
+import utils.metrics as metrics
+from docopt import docopt
+
+from videoio import RedisVideoCapture  # type: ignore
+
+lib_path = os.path.abspath(os.path.join(__file__, "..", ".."))
+sys.path.append(lib_path)
+from docs import config as cfg  # noqa: E402
+
+config_path = os.path.dirname(os.path.abspath(cfg.__file__))
+
+STATUS_KEY = "namespace:status"
+
+
+class CameraRunner:
+    """Keep the capture of one camera running inside a worker process."""
+
+    def __init__(self, config: Dict, stop: threading.Event, max_backoff: float) -> None:
+        """Initialize the runner."""
+        self.config = config
+        self.name = config["APP"]["cam_name"]
+        self.stop = stop
+        self.max_backoff = max_backoff
+        self.state = "starting"
+        self.restarts = 0
+        self.error = ""
+        self.cap: Optional[RedisVideoCapture] = None
+        self.metrics = metrics.registry(self.name)
+        self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+
+    def run(self) -> None:
+        """Run the capture, restarting it after a failure until stopped."""
+        failures = 0
+        while not self.stop.is_set():
+            try:
+                cap = self.cap = RedisVideoCapture(self.config)
+                cap.start()
+            except Exception as e:  # keep the other cameras of the worker alive
+                self.state, self.error = "failed", repr(e)
+            else:
+                self.state = "running"
+                while not self.stop.wait(1):
+                    if cap.capture_failed or not cap.thread.is_alive():  # type: ignore
+                        break
+                    failures = 0
+                cap.stop()
+                if not self.stop.is_set():
+                    self.state, self.error = "failed", "capture failed"
+            if self.stop.is_set():
+                break
+            self.restarts += 1
+            self.stop.wait(hvio.backoff(failures, self.max_backoff))
+            failures += 1
+        self.state = "stopped"
+
+    def status(self) -> Dict[str, Any]:
+        """Return the status published for the camera."""
+        state = self.state
+        if state == "running" and self.cap is not None and self.cap.reconnecting:
+            state = "reconnecting"
+        return {
+            "pid": os.getpid(),
+            "state": state,
+            "restarts": self.restarts,
+            "error": self.error,
+            "fps": round(self.metrics.rate("frames_read").rate(), 2),
+            "queue_depth": self.metrics.gauge("queue_depth").value,
+            "updated": time.time(),
+        }
+
+
+def run_worker(index: int, configs: List[Dict], supervisor: Dict) -> None:
+    """Run the captures of a worker process, one thread per camera."""
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    max_backoff = float(supervisor.get("max_backoff", 30))
+    runners = [CameraRunner(config, stop, max_backoff) for config in configs]
+    for runner in runners:
+        runner.thread.start()
+
+    # every worker exports the metrics of its own cameras
+    section = configs[0].get("metrics", {})
+    exporter = metrics.MetricsExporter(
+        port=int(section.get("port", 0)) and int(section["port"]) + index,
+        dump_path=section.get("dump_path", "") and f"{section['dump_path']}.{index}",
+        dump_sec=float(section.get("dump_sec", 10)),
+    )
+    exporter.start()
+
+    # one round trip publishes the status of all cameras of the worker
+    db = hvio.connect_redis(
+        configs[0]["redis"]["host"], int(configs[0]["redis"]["port"])
+    )
+    status_sec = float(supervisor.get("status_sec", 1))
+    while True:
+        statuses = {
+            runner.name: json.dumps({"worker": index, **runner.status()})
+            for runner in runners
+        }
+        try:
+            db.hset(STATUS_KEY, mapping=statuses)
+        except Exception:  # status is best effort; redis may be restarting
+            pass
+        if stop.wait(status_sec):
+            break
+    for runner in runners:
+        runner.thread.join()
+    exporter.stop()
+
+
+class Supervisor:
+    """Spread the cameras over worker processes and restart failed workers."""
+
+    def __init__(self, config: Dict, workers: int, verbose: int) -> None:
+        """Assign the cameras to the workers round-robin."""
+        self.config = config
+        self.supervisor = config.get("supervisor", {})
+        self.verbose = verbose
+        cameras = list(cfg.cameras(config).values())
+        for camera in cameras:
+            camera["defaultArgs"]["--verbose"] = str(verbose)
+        workers = max(1, min(workers, len(cameras)))
+        self.assignments = [cameras[i::workers] for i in range(workers)]
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * workers
+        self.restarts = [0] * workers
+        self.stopping = False
+
+    def spawn(self, index: int) -> None:
+        """Start (or restart) a worker process."""
+        process = multiprocessing.Process(
+            target=run_worker,
+            args=(index, self.assignments[index], self.supervisor),
+            name=f"videoio-worker-{index}",
+        )
+        process.start()
+        self.processes[index] = process
+        if self.verbose == 2:
+            names = [camera["APP"]["cam_name"] for camera in self.assignments[index]]
+            print(f"[INFO] Worker {index} (pid {process.pid}) runs {names}")
+
+    def run(self) -> None:
+        """Run the workers until SIGINT or SIGTERM."""
+        signal.signal(signal.SIGTERM, lambda *_: self.shutdown())
+        signal.signal(signal.SIGINT, lambda *_: self.shutdown())
+        max_backoff = float(self.supervisor.get("max_backoff", 30))
+        for index in range(len(self.processes)):
+            self.spawn(index)
+        due = [0.0] * len(self.processes)
+        while not self.stopping:
+            time.sleep(0.5)
+            for index, process in enumerate(self.processes):
+                if self.stopping or process is None or process.is_alive():
+                    continue
+                if due[index] == 0:
+                    delay = hvio.backoff(self.restarts[index], max_backoff)
+                    due[index] = time.monotonic() + delay
+                    print(
+                        f"[WARN] Worker {index} exited with {process.exitcode},"
+                        f" restarting in {delay:.1f} s"
+                    )
+                elif time.monotonic() >= due[index]:
+                    due[index] = 0
+                    self.restarts[index] += 1
+                    self.spawn(index)
+        for process in self.processes:
+            if process is not None:
+                process.join()
+
+    def shutdown(self) -> None:
+        """Stop the workers."""
+        self.stopping = True
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+
+
+def print_status(config: Dict) -> None:
+    """Print the last published status of every camera."""
+    db = hvio.connect_redis(config["redis"]["host"], int(config["redis"]["port"]))
+    for name, value in sorted(db.hgetall(STATUS_KEY).items()):
+        status = json.loads(value)
+        age = time.time() - status.pop("updated")
+        print(f"{cast(bytes, name).decode()}: {status} ({age:.1f} s ago)")
+
+
+def main() -> None:
+    """Implement the main function."""
+    arguments = docopt(__doc__)
+    config, default_args = cfg.read_ini(os.path.join(config_path, "config.ini"))
+    if arguments["status"]:
+        print_status(config)
+        return
+
+    workers = int(
+        arguments["--workers"] or config.get("supervisor", {}).get("workers", 1)
+    )
+    verbose = int(arguments["--verbose"] or default_args["--verbose"])
+    # make the supervisor unique to run on the same machine
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.bind("\0" + config["process"]["processname"] + ":supervisor")
+    except socket.error as msg:
+        print("Supervisor already running.")
+        print(str(msg) + "\n" + "Exiting")
+        sys.exit(0)
+    Supervisor(config, workers, verbose).run()
+
+
+if __name__ == "__main__":
+    main()
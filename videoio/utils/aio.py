@@ -0,0 +1,216 @@
+"""asyncio frame readers over redis.asyncio or the shared memory ring."""
+
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import utils.backpressure as backpressure
+import utils.frame_batch as frame_batch
+import utils.frame_header as header
+import utils.helpers as hvio
+import utils.metrics as metrics
+import utils.redis_reads as redis_reads
+import utils.tracing as tracing
+from redis.asyncio import ConnectionPool  # type: ignore
+from utils.frame_batch import FrameBatch
+from utils.frame_header import FrameMeta
+from utils.frame_pool import FramePool
+from utils.redis_shmem import RedisShmem, queue_key
+from utils.shm_ring import ShmRing
+
+Frame = Tuple[Optional[np.ndarray], bool, Optional[FrameMeta]]
+
+
+class AsyncReader(ABC):
+    """Common `async for` support of the asyncio readers.
+
+    Iterating yields `(frame, meta)` until the reader is closed or `until()`
+    is true; waiting for the next frame never blocks the event loop.
+    """
+
+    def __init__(self, until: Optional[Callable[[], bool]] = None) -> None:
+        """Initialize the iteration state."""
+        self.until = until
+        self.closed = False
+
+    @abstractmethod
+    async def read(self, timeout: float = 1) -> Frame:
+        """Return the next frame, its grabbed flag and its metadata."""
+
+    async def close(self) -> None:
+        """Release the reader."""
+        self.closed = True
+
+    def __aiter__(self) -> "AsyncReader":
+        """Iterate over the frames."""
+        return self
+
+    async def __anext__(self) -> Tuple[np.ndarray, FrameMeta]:
+        """Wait for the next frame."""
+        while not self.closed and not (self.until is not None and self.until()):
+            frame, grabbed, meta = await self.read()
+            if grabbed and frame is not None and meta is not None:
+                return frame, meta
+        await self.close()
+        raise StopAsyncIteration
+
+
+class AsyncRedisShmem(AsyncReader):
+    """Read a camera's frames from Redis without blocking the event loop.
+
+    This is the read side of `RedisShmem` (list and stream modes, read
+    policies) on redis.asyncio. Readers of many cameras can share one
+    connection `pool`; each pending read holds one connection of it.
+    Cancelling a read waiting in `BLPOP` closes its connection; a frame
+    popped at that very moment is lost.
+    """
+
+    def __init__(
+        self,
+        cfg: Dict[str, Dict[str, str]],
+        consumer: Optional[str] = None,
+        pool: Optional[ConnectionPool] = None,
+        until: Optional[Callable[[], bool]] = None,
+    ) -> None:
+        """Initialize the reader; no connection is made before the first read."""
+        super().__init__(until)
+        self.db = hvio.connect_redis_async(
+            cfg["redis"]["host"], int(cfg["redis"]["port"]), pool
+        )
+        self.Q_name = cfg["APP"]["cam_name"]
+        self.stream = cfg["redis"].get("mode", "list") == "stream"
+        self.key = queue_key(cfg)
+        self.head_key = self.key + ":head"
+        self.cursor_key = self.key + ":consumers"
+        self.consumer = consumer or cfg["redis"].get("consumer", "default")
+        self.cursor: Optional[str] = None
+        self.last_seq: Optional[int] = None
+        self.max_lag = int(cfg["redis"].get("max_lag", 0))
+        self.read_policy = backpressure.read_policy(cfg)
+        self.lag = 0
+        self.dropped = 0
+        self.batches = FramePool(2)
+        self.metrics = metrics.registry(self.Q_name)
+        self.tracer = tracing.tracer(cfg)
+
+    async def read(self, timeout: float = 1) -> Frame:
+        """Return the next frame, its grabbed flag and its metadata."""
+        items = await self.fetch(1, timeout)
+        if not items:
+            return None, False, None
+        frame, meta = RedisShmem.decodeFrameMeta(items[0])
+        self.metrics.rate("frames_consumed").mark()
+        self.tracer.read(meta)
+        return frame, True, meta
+
+    async def read_batch(self, n: int, timeout: float = 1) -> Optional[FrameBatch]:
+        """Read up to `n` frames, stacked into one `(k, h, w, c)` array.
+
+        The batch array is reused two calls later. Return None on timeout.
+        """
+        items = []
+        for item in await self.fetch(n, timeout):
+            meta, size = header.unpack(item)
+            items.append((meta, memoryview(item)[size:]))
+        batch, mismatched = frame_batch.decode(items, self.batches, n)
+        if batch is None:
+            return None
+        self.skip(mismatched)
+        self.metrics.rate("frames_consumed").mark(batch.size)
+        for meta in batch.metas:
+            self.tracer.read(meta)
+        return batch
+
+    async def fetch(self, n: int, timeout: float) -> List[bytes]:
+        """Fetch up to `n` encoded frames."""
+        if self.stream:
+            steps = redis_reads.stream_batch(self, n, timeout)
+        else:
+            steps = redis_reads.list_batch(self, n, timeout)
+        return await redis_reads.run_async(self.db, steps)
+
+    def skip(self, count: int) -> None:
+        """Count frames this reader skipped."""
+        self.dropped += count
+        self.metrics.counter("consumer_dropped").inc(count)
+
+    async def close(self) -> None:
+        """Close the Redis connection (returning it to a shared pool)."""
+        if not self.closed:
+            self.closed = True
+            # redis-py 5 renamed close() to aclose()
+            await getattr(self.db, "aclose", self.db.close)()
+
+
+class AsyncShmRing(AsyncReader):
+    """Read a same-host shared memory ring without blocking the event loop.
+
+    The ring has no file descriptor to wait on, so an empty ring is polled
+    with `asyncio.sleep`, at four times the analysis FPS. A reader made
+    before the capture attaches to the ring once the capture creates it.
+    """
+
+    def __init__(
+        self, cfg: Dict[str, Dict[str, str]], until: Optional[Callable[[], bool]] = None
+    ) -> None:
+        """Attach to the camera's ring, if the capture has created it."""
+        super().__init__(until)
+        self.cfg = cfg
+        fps_van = int(cfg["Analysis"]["fps_van"])
+        self.poll = 1.0 / ((fps_van if fps_van != 0 else 12) * 4)
+        self.ring: Optional[ShmRing] = None
+        self.attach()
+
+    def attach(self) -> Optional[ShmRing]:
+        """Return the ring, attaching to it if the capture has created it."""
+        if self.ring is None:
+            try:
+                self.ring = ShmRing(self.cfg, timeout=0)
+            except FileNotFoundError:
+                pass
+        return self.ring
+
+    async def wait(self, get: Callable[[ShmRing], Any], timeout: float) -> Any:
+        """Poll `get` until it returns something or `timeout` seconds pass."""
+        deadline = time.monotonic() + timeout
+        while True:
+            ring = self.attach()
+            result = None if ring is None else get(ring)
+            if result is not None or time.monotonic() >= deadline:
+                return result
+            await asyncio.sleep(self.poll)
+
+    async def read(self, timeout: float = 1, copy: bool = False) -> Frame:
+        """Return the next frame, a zero-copy view into the ring unless `copy`."""
+
+        def get(ring: ShmRing) -> Optional[Frame]:
+            frame = ring.getFrame(timeout=0, copy=copy)
+            return frame if frame[1] else None
+
+        frame = await self.wait(get, timeout)
+        return (None, False, None) if frame is None else frame
+
+    async def read_batch(self, n: int, timeout: float = 1) -> Optional[FrameBatch]:
+        """Read up to `n` frames, stacked into one `(k, h, w, c)` array."""
+        return await self.wait(lambda ring: ring.read_batch(n, timeout=0), timeout)
+
+    async def close(self) -> None:
+        """Detach from the ring."""
+        if not self.closed:
+            self.closed = True
+            if self.ring is not None:
+                self.ring.close()
+
+
+def reader(
+    cfg: Dict[str, Dict[str, str]],
+    consumer: Optional[str] = None,
+    pool: Optional[ConnectionPool] = None,
+    until: Optional[Callable[[], bool]] = None,
+) -> Union[AsyncRedisShmem, AsyncShmRing]:
+    """Return an asyncio reader for the configured frame buffer backend."""
+    if cfg["Analysis"].get("backend", "redis") == "shm":
+        return AsyncShmRing(cfg, until)
+    return AsyncRedisShmem(cfg, consumer, pool, until)
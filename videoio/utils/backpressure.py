@@ -0,0 +1,40 @@
+"""Backpressure policies of the frame buffers."""
+
+from typing import Dict
+
+BLOCK = "block"
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+LATEST = "latest"
+
+# what the capture does with a new frame once the buffer is full
+CAPTURE_POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, LATEST)
+# which frame a reader gets; a reader cannot drop frames not published yet
+READ_POLICIES = (BLOCK, DROP_OLDEST, LATEST)
+
+
+def capture_policy(cfg: Dict[str, Dict[str, str]]) -> str:
+    """Return the configured capture-side policy.
+
+    `block` waits for a reader to make room, `drop-oldest` evicts the oldest
+    frame, `drop-newest` discards the new frame and `latest` keeps only the
+    newest frame in the buffer.
+    """
+    policy = cfg["Analysis"].get("capture_policy", DROP_OLDEST)
+    if policy not in CAPTURE_POLICIES:
+        raise ValueError(f"unknown capture policy {policy!r}")
+    return policy
+
+
+def read_policy(cfg: Dict[str, Dict[str, str]]) -> str:
+    """Return the configured read-side policy.
+
+    `block` reads every frame in order, `drop-oldest` skips to the newest
+    frame once the reader is more than `[redis] Max_Lag` frames behind and
+    `latest` always reads the newest frame. Skipped frames are counted.
+    """
+    max_lag = int(cfg["redis"].get("max_lag", 0))
+    policy = cfg["Analysis"].get("read_policy", DROP_OLDEST if max_lag else BLOCK)
+    if policy not in READ_POLICIES:
+        raise ValueError(f"unknown read policy {policy!r}")
+    return policy
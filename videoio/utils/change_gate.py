@@ -0,0 +1,80 @@
+"""Change detection gate skipping the frames of a static scene."""
+
+import time
+from typing import Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+
+
+class ChangeGate:
+    """Score how much each frame changed against a running background.
+
+    A frame is reduced to a `Scale` pixels wide luma thumbnail and compared
+    with an exponential running average of the previous ones. Its score is
+    the fraction of thumbnail pixels whose luma differs from the background
+    by more than `Pixel_Diff`. Frames scoring at least `Threshold` are
+    published; a static scene only publishes a heartbeat frame every
+    `Heartbeat_Sec` seconds. Each frame costs a sampling resize to the
+    thumbnail and a few vector operations on it.
+    """
+
+    def __init__(self, cfg: Dict[str, str]) -> None:
+        """Initialize the gate from the `[gate]` section of the config."""
+        self.width = int(cfg.get("scale", 64))
+        self.pixel_diff = float(cfg.get("pixel_diff", 20))
+        self.threshold = float(cfg.get("threshold", 0.01))
+        self.alpha = float(cfg.get("alpha", 0.05))
+        self.heartbeat_ns = int(float(cfg.get("heartbeat_sec", 5)) * 1e9)
+        self.hold_ns = int(float(cfg.get("hold_sec", 3)) * 1e9)
+        self.background: Optional[np.ndarray] = None
+        self.diff: Optional[np.ndarray] = None
+        self.last_published_ns = 0
+        self.last_change_ns = 0
+
+    def thumbnail(self, frame: np.ndarray) -> np.ndarray:
+        """Return the float32 luma thumbnail of a BGR or gray frame."""
+        h, w = frame.shape[:2]
+        size = (self.width, max(1, round(h * self.width / w)))
+        if w > 4 * size[0]:
+            # area resizing a full frame costs milliseconds: sample 4x4
+            # pixels per thumbnail pixel first, then average them
+            sampled = (4 * size[0], 4 * size[1])
+            frame = cv2.resize(frame, sampled, interpolation=cv2.INTER_NEAREST)
+        small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return small.astype(np.float32)
+
+    def score(self, frame: np.ndarray) -> float:
+        """Return the changed fraction of `frame` and update the background.
+
+        The first frame, or the first after a change of size, scores 1.
+        """
+        small = self.thumbnail(frame)
+        if self.background is None or self.background.shape != small.shape:
+            self.background = small
+            self.diff = np.empty_like(small)
+            return 1.0
+        diff = cv2.absdiff(small, self.background, dst=self.diff)
+        changed = np.count_nonzero(diff > self.pixel_diff)
+        cv2.accumulateWeighted(small, self.background, self.alpha)
+        return changed / small.size
+
+    def admit(self, frame: np.ndarray, now_ns: int) -> Tuple[bool, float]:
+        """Score a frame; return whether it is to be published, and its score."""
+        score = self.score(frame)
+        if score >= self.threshold:
+            self.last_change_ns = now_ns
+        publish = (
+            score >= self.threshold
+            or now_ns - self.last_published_ns >= self.heartbeat_ns
+        )
+        if publish:
+            self.last_published_ns = now_ns
+        return publish, score
+
+    def active(self, now_ns: int = 0) -> bool:
+        """Return True while the scene changed in the last `Hold_Sec` seconds."""
+        now_ns = now_ns or time.monotonic_ns()
+        return self.last_change_ns > 0 and now_ns - self.last_change_ns < self.hold_ns
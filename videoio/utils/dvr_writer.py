@@ -0,0 +1,245 @@
+"""Continuous recording to an on-disk ring of stream segments (DVR)."""
+
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import BinaryIO, Deque, Dict, List, Optional, Tuple
+
+from utils.passthrough_writer import SourceWriter
+
+# bytes copied at once when cutting a clip
+COPY_CHUNK = 1 << 20
+
+
+class Segment:
+    """A segment file of the ring and the index of its keyframes."""
+
+    __slots__ = ("path", "start", "end", "size", "gops")
+
+    def __init__(self, path: str, start: float) -> None:
+        """Initialize an empty segment starting at wall time `start`."""
+        self.path = path
+        self.start = start
+        self.end = start
+        self.size = 0
+        # (wall time, byte offset) of every keyframe
+        self.gops: List[Tuple[float, int]] = []
+
+    def span(self, start: float, end: float) -> Tuple[int, int]:
+        """Return the byte range of the GOPs covering `[start, end]`."""
+        begin = self.gops[0][1] if self.gops else 0
+        stop = self.size
+        for t, offset in self.gops:
+            if t <= start:
+                begin = offset
+            elif t > end:
+                stop = offset
+                break
+        return begin, stop
+
+
+def copy_range(src: BinaryIO, dst: BinaryIO, begin: int, end: int) -> None:
+    """Copy the bytes `[begin, end)` of `src` to `dst`."""
+    src.seek(begin)
+    remaining = end - begin
+    while remaining > 0:
+        chunk = src.read(min(remaining, COPY_CHUNK))
+        if not chunk:
+            break
+        dst.write(chunk)
+        remaining -= len(chunk)
+
+
+class DvrWriter(SourceWriter):
+    """Record the source stream continuously to a ring of segment files.
+
+    The compressed stream is cut at keyframes into `Dvr_Segment_Sec` long
+    `.ts` segments under `<Rec_Dir>/<camera>/dvr`. The oldest are removed
+    beyond `Dvr_Max_MB` or `Dvr_Max_Age_Sec`, so the pre-roll can be minutes
+    long without using RAM. An event clip covers `Rec_Buf_Sec` before
+    `recStart` to `Rec_Post_Sec` after `recStop`: once the post-roll is on
+    disk, the covering GOPs are copied out of the segments, without decoding.
+    Events with different names may overlap, each with its own clip.
+    Segments left by a previous run are kept and can be part of a clip.
+    """
+
+    def __init__(self, cfg: Dict[str, Dict[str, str]]) -> None:
+        """Open the segment ring, then start recording the source."""
+        record = cfg["record"]
+        self.segment_sec = float(record.get("dvr_segment_sec", 10))
+        self.max_bytes = int(float(record.get("dvr_max_mb", 1024)) * 2**20)
+        self.max_age = float(record.get("dvr_max_age_sec", 0))
+        self.post_sec = float(record.get("rec_post_sec", 0))
+        self.dvrDir = os.path.join(
+            os.path.expanduser(record["rec_dir"]), cfg["APP"]["cam_name"], "dvr"
+        )
+        os.makedirs(self.dvrDir, exist_ok=True)
+        self.segments: Deque[Segment] = deque()
+        self.bytes = 0
+        for name in sorted(os.listdir(self.dvrDir)):
+            stem, ext = os.path.splitext(name)
+            if ext == ".ts" and stem.isdigit():
+                self.adopt(os.path.join(self.dvrDir, name), int(stem) / 1000)
+        self.segment: Optional[Segment] = None
+        self.segment_file: Optional[BinaryIO] = None
+        # file name and start time of the events in progress, by name
+        self.events: Dict[str, Tuple[str, float]] = {}
+        self.pending: List[Tuple[str, float, float]] = []
+        self.timers: List[threading.Timer] = []
+        super().__init__(cfg)
+        with self.lock:
+            self.evict(time.time())
+
+    def adopt(self, path: str, start: float) -> None:
+        """Add a segment of a previous run; it is only indexed as a whole."""
+        segment = Segment(path, start)
+        segment.size = os.path.getsize(path)
+        segment.end = os.path.getmtime(path)
+        segment.gops.append((start, 0))
+        self.segments.append(segment)
+        self.bytes += segment.size
+
+    def qsize(self) -> int:
+        """Return the number of segments in the ring."""
+        return len(self.segments)
+
+    def restart(self) -> None:
+        """Start a new segment with the new source process."""
+        super().restart()
+        self.close_segment()
+
+    def keyframe(self, now: float) -> None:
+        """Index a keyframe, starting a new segment when the current is full."""
+        wall = time.time()
+        segment = self.segment
+        if segment is None or wall - segment.start >= self.segment_sec:
+            segment = self.roll(wall)
+        segment.gops.append((wall, segment.size))
+
+    def packets(self, data: bytes) -> None:
+        """Append packets to the current segment."""
+        if self.segment_file is None or self.segment is None:
+            return
+        try:
+            self.segment_file.write(data)
+        except OSError:
+            # e.g. disk full; the next segment starts after an eviction
+            self.metrics.counter("writer_errors").inc()
+            return
+        self.segment.size += len(data)
+        self.segment.end = time.time()
+        self.bytes += len(data)
+        self.metrics.rate("bytes_written").mark(len(data))
+
+    def roll(self, wall: float) -> Segment:
+        """Close the current segment and open the next one."""
+        self.close_segment()
+        path = os.path.join(self.dvrDir, f"{int(wall * 1000)}.ts")
+        self.segment_file = open(path, "wb")
+        self.segment = Segment(path, wall)
+        self.segments.append(self.segment)
+        self.packets(self.header)
+        self.evict(wall)
+        return self.segment
+
+    def close_segment(self) -> None:
+        """Close the segment being written, if any."""
+        if self.segment_file is not None:
+            self.segment_file.close()
+        self.segment_file = None
+        self.segment = None
+
+    def evict(self, now: float) -> None:
+        """Remove the oldest segments beyond the size and age limits."""
+        while len(self.segments) > 1 and (
+            (self.max_bytes and self.bytes > self.max_bytes)
+            or (self.max_age and self.segments[0].end < now - self.max_age)
+        ):
+            segment = self.segments.popleft()
+            try:
+                os.remove(segment.path)
+            except FileNotFoundError:
+                pass
+            self.bytes -= segment.size
+            self.metrics.counter("dvr_segments_evicted").inc()
+        self.metrics.gauge("dvr_bytes").set(self.bytes)
+
+    def recStart(self, timestamp: datetime, name: str) -> None:
+        """Start an event; its clip includes the `Rec_Buf_Sec` before it."""
+        if name in self.events:
+            return
+        if self.verbose == 2:
+            print(f"[INFO] Starting recording {name}")
+
+        self.videoFileName = self.makeFileName(timestamp, name)
+        self.events[name] = (self.videoFileName, timestamp.timestamp())
+        self.recStarted = True
+
+    def recStop(self, name: Optional[str] = None) -> None:
+        """End the event `name` (default: all); clips are cut after the post-roll."""
+        if self.verbose == 2:
+            print(f"[INFO] Stopping recording {name or ''}")
+
+        names = list(self.events) if name is None else [name]
+        end = time.time() + self.post_sec
+        for path, start in [self.events.pop(n) for n in names if n in self.events]:
+            clip = (path, start - self.bufSec, end)
+            with self.lock:
+                self.pending.append(clip)
+            timer = threading.Timer(self.post_sec, self.make_clip, clip)
+            timer.daemon = True
+            timer.start()
+            self.timers = [t for t in self.timers if t.is_alive()] + [timer]
+        self.recStarted = bool(self.events)
+
+    def make_clip(self, path: str, start: float, end: float) -> None:
+        """Write the GOPs of the ring covering `[start, end]` to `path`."""
+        tic = time.perf_counter()
+        parts = []
+        with self.lock:
+            if (path, start, end) not in self.pending:
+                return
+            self.pending.remove((path, start, end))
+            if self.segment_file is not None:
+                self.segment_file.flush()
+            for segment in self.segments:
+                if segment.end >= start and segment.start <= end:
+                    header = segment.gops[0][1] if segment.gops else 0
+                    parts.append((segment.path, header) + segment.span(start, end))
+
+        # every segment starts with the stream tables, so segments concatenate
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, "wb") as dst:
+                for segment_path, header, begin, stop in parts:
+                    try:
+                        with open(segment_path, "rb") as src:
+                            copy_range(src, dst, 0, header)
+                            copy_range(src, dst, max(begin, header), stop)
+                    except FileNotFoundError:
+                        continue  # evicted meanwhile
+            os.replace(tmp, path)
+        except OSError as e:
+            # e.g. disk full; the timer thread must not die with a partial clip
+            self.metrics.counter("writer_errors").inc()
+            print(f"[WARN] Event clip {path} failed: {e}")
+            try:
+                os.remove(tmp)
+            except FileNotFoundError:
+                pass
+            return
+        self.metrics.histogram("clip_ms").observe(1000 * (time.perf_counter() - tic))
+        if self.verbose == 2:
+            print(f"[INFO] Event clip {path} from {len(parts)} segments")
+
+    def close(self) -> None:
+        """Stop recording, cutting the clips still waiting for their post-roll."""
+        super().close()
+        for timer in self.timers:
+            timer.cancel()
+        for clip in list(self.pending):
+            self.make_clip(*clip)
+        with self.lock:
+            self.close_segment()
@@ -1,37 +1,46 @@
 """Compute the frames per second of a video."""
 
-import datetime
+import time
+
+from utils.metrics import Rate
 
 
 class FPS:
-    """FPS class."""
+    """FPS class.
+
+    The rate is measured on the monotonic clock over a sliding window of the
+    last `window` seconds, so it follows changes of the frame rate.
+    """
 
-    def __init__(self) -> None:
+    def __init__(self, window: int = 10) -> None:
         """Initialize the FPS context."""
-        # store the start time, end time, and total number of frames
-        # that were examined between the start and end intervals
-        self._start = datetime.datetime.now()
-        self._end = datetime.datetime.now()
+        self._start = time.monotonic()
+        self._end = self._start
         self._numFrames = 0
+        self._rate = Rate(window)
 
     def start(self) -> None:
         """Start the timer."""
-        self._start = datetime.datetime.now()
+        self._start = time.monotonic()
+        self._rate = Rate(self._rate.window)
 
     def stop(self) -> None:
         """Stop the timer."""
-        self._end = datetime.datetime.now()
+        self._end = time.monotonic()
 
     def update(self) -> None:
         """Update the FPS counter."""
-        # increment the total number of frames examined during the
-        # start and end intervals
         self._numFrames += 1
+        self._rate.mark()
 
-    def elapsed(self) -> int:
-        """Return the total number of seconds between the start and end."""
-        return int((datetime.datetime.now() - self._start).total_seconds())
+    def elapsed(self) -> float:
+        """Return the total number of seconds since the start."""
+        return time.monotonic() - self._start
 
     def fps(self) -> float:
-        """Compute the (approximate) frames per second."""
-        return self._numFrames / self.elapsed()
+        """Compute the frames per second over the sliding window."""
+        elapsed = self.elapsed()
+        if elapsed < self._rate.window:
+            # the window is not filled yet
+            return self._numFrames / elapsed if elapsed > 0 else 0.0
+        return self._rate.rate()
@@ -0,0 +1,59 @@
+"""Frames stacked into one array for batch inference."""
+
+from typing import List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import utils.frame_codec as codecs
+from utils.frame_header import FrameMeta
+from utils.frame_pool import FramePool
+
+
+class FrameBatch(NamedTuple):
+    """A `(k, h, w, c)` frame array and one metadata array per header field."""
+
+    frames: np.ndarray
+    seq: np.ndarray
+    mono_ns: np.ndarray
+    wall_ns: np.ndarray
+    pts_us: np.ndarray
+    metas: Tuple[FrameMeta, ...]
+
+    @property
+    def size(self) -> int:
+        """Return the number of frames in the batch."""
+        return self.frames.shape[0]
+
+
+def decode(
+    items: Sequence[Tuple[FrameMeta, Union[bytes, memoryview]]],
+    pool: FramePool,
+    n: int,
+) -> Tuple[Optional[FrameBatch], int]:
+    """Decode frame payloads into the next pooled `(n, h, w, c)` array.
+
+    The first frame sets the shape; frames of another shape (after a change of
+    resolution), and frames beyond `n`, are left out. Return the batch, a view
+    of its first `k` rows, and the number of frames left out.
+    """
+    if not items:
+        return None, 0
+    first = items[0][0]
+    shape = codecs.frame_shape(first)
+    buf = pool.next((n,) + shape, first.dtype)
+    metas: List[FrameMeta] = []
+    for meta, payload in items:
+        if len(metas) == buf.shape[0]:
+            break  # never more than the `n` frames the buffer holds
+        if codecs.frame_shape(meta) != shape or meta.dtype != first.dtype:
+            continue
+        codecs.decompress_into(payload, meta, buf[len(metas)])
+        metas.append(meta)
+    batch = FrameBatch(
+        buf[: len(metas)],
+        np.array([meta.seq for meta in metas], dtype=np.int64),
+        np.array([meta.mono_ns for meta in metas], dtype=np.int64),
+        np.array([meta.wall_ns for meta in metas], dtype=np.int64),
+        np.array([meta.pts_us for meta in metas], dtype=np.int64),
+        tuple(metas),
+    )
+    return batch, len(items) - len(metas)
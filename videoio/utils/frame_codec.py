@@ -0,0 +1,82 @@
+"""Frame payload codecs for the frame buffer."""
+
+import zlib
+from typing import Dict, Tuple, Union
+
+import cv2
+import numpy as np
+import utils.pixel_format as pixel_format
+from utils.frame_header import FrameMeta
+
+# codec tags stored in the frame header
+RAW = 0
+JPEG = 1
+LOSSLESS = 2
+
+CODECS: Dict[str, int] = {"raw": RAW, "jpeg": JPEG, "lossless": LOSSLESS}
+
+
+def codec_tag(name: str) -> int:
+    """Return the header tag of a codec name from the config."""
+    try:
+        return CODECS[name.lower()]
+    except KeyError:
+        raise ValueError(
+            f"unknown frame codec {name!r}, expected one of {sorted(CODECS)}"
+        ) from None
+
+
+def compress(img: np.ndarray, codec: int, quality: int = 90) -> bytes:
+    """Compress an image with the given codec.
+
+    `lossless` is zlib at its fastest level. Both OpenCV and zlib release the
+    GIL while compressing, so encoding parallelises across threads.
+    """
+    if codec == RAW:
+        return img.tobytes()
+    if codec == LOSSLESS:
+        return zlib.compress(np.ascontiguousarray(img).data, 1)
+    if codec != JPEG:
+        raise ValueError(f"unknown frame codec tag {codec}")
+    if img.dtype != np.uint8:
+        raise ValueError("the jpeg codec only supports uint8 frames")
+    ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("frame encoding failed")
+    return buf.tobytes()
+
+
+def frame_shape(meta: FrameMeta) -> Tuple[int, ...]:
+    """Return the array shape of the image described by `meta`."""
+    if meta.pixfmt == pixel_format.I420:
+        return (meta.h * 3 // 2, meta.w)
+    shape: Tuple[int, ...] = (meta.h, meta.w)
+    if meta.channels > 1:
+        shape += (meta.channels,)
+    return shape
+
+
+def decompress(data: Union[bytes, memoryview], meta: FrameMeta) -> np.ndarray:
+    """Decompress a payload back into the image described by `meta`."""
+    shape = frame_shape(meta)
+    if meta.codec == RAW:
+        return np.frombuffer(data, dtype=meta.dtype).reshape(shape)
+    if meta.codec == LOSSLESS:
+        return np.frombuffer(zlib.decompress(data), dtype=meta.dtype).reshape(shape)
+    if meta.codec != JPEG:
+        raise ValueError(f"unknown frame codec tag {meta.codec}")
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise ValueError("frame decoding failed")
+    return img
+
+
+def decompress_into(
+    data: Union[bytes, memoryview], meta: FrameMeta, out: np.ndarray
+) -> None:
+    """Decompress a payload into `out`, e.g. one slot of a batch array.
+
+    Raw payloads are copied straight from the buffer; compressed ones are
+    copied from the decoder output.
+    """
+    np.copyto(out, decompress(data, meta).reshape(out.shape))
@@ -0,0 +1,166 @@
+"""Fixed-size binary frame header shared by the frame buffers."""
+
+import datetime
+import struct
+import time
+from typing import Dict, NamedTuple, Tuple, Union
+
+import numpy as np
+import utils.pixel_format as pixel_format
+
+MAGIC = b"VF"
+VERSION = 1
+
+PREFIX = struct.Struct(">2sB")
+# magic, version, codec, dtype, channels, flags, pixel format, seq,
+# monotonic ns, wall-clock ns, height, width, stream pts in microseconds
+# (-1 if unknown), change score [0-1] (-1 if not scored)
+HEADER = struct.Struct(">2sBBBBBBQQQIIqf")
+
+# flags
+TRACED = 1
+# published by the change gate although the scene did not change
+HEARTBEAT = 2
+
+DTYPES: Dict[int, np.dtype] = {
+    0: np.dtype(np.uint8),
+    1: np.dtype(np.uint16),
+    2: np.dtype(np.float32),
+}
+DTYPE_CODES: Dict[np.dtype, int] = {dtype: code for code, dtype in DTYPES.items()}
+
+
+class FrameMeta(NamedTuple):
+    """Metadata carried in front of every buffered frame."""
+
+    seq: int
+    mono_ns: int
+    wall_ns: int
+    h: int
+    w: int
+    channels: int
+    dtype: np.dtype
+    codec: int
+    pts_us: int = -1
+    flags: int = 0
+    pixfmt: int = pixel_format.BGR
+    score: float = -1.0
+
+    @property
+    def timestamp(self) -> str:
+        """Return the wall-clock capture time as a string."""
+        wall = datetime.datetime.fromtimestamp(self.wall_ns / 1e9)
+        return wall.strftime("%Y-%m-%d %H:%M:%S,%f")
+
+    def age_ms(self) -> float:
+        """Return milliseconds since capture (same host clocks only)."""
+        return (time.monotonic_ns() - self.mono_ns) / 1e6
+
+
+def frame_meta(
+    img: np.ndarray,
+    seq: int,
+    codec: int,
+    pts_us: int = -1,
+    grab_ns: int = 0,
+    flags: int = 0,
+    pixfmt: int = pixel_format.BGR,
+    score: float = -1.0,
+) -> FrameMeta:
+    """Describe an image grabbed at monotonic time `grab_ns` (default now).
+
+    `img` is stored in the pixel format `pixfmt`; h and w are its image size.
+    """
+    h, w = pixel_format.image_size(img, pixfmt)
+    channels = img.shape[2] if img.ndim == 3 else 1
+    if img.dtype not in DTYPE_CODES:
+        raise ValueError(f"unsupported frame dtype {img.dtype}")
+    mono_ns = time.monotonic_ns()
+    wall_ns = time.time_ns()
+    if grab_ns:
+        wall_ns -= mono_ns - grab_ns
+        mono_ns = grab_ns
+    return FrameMeta(
+        seq,
+        mono_ns,
+        wall_ns,
+        h,
+        w,
+        channels,
+        img.dtype,
+        codec,
+        pts_us,
+        flags,
+        pixfmt,
+        score,
+    )
+
+
+def _fields(meta: FrameMeta) -> tuple:
+    return (
+        MAGIC,
+        VERSION,
+        meta.codec,
+        DTYPE_CODES[meta.dtype],
+        meta.channels,
+        meta.flags,
+        meta.pixfmt,
+        meta.seq,
+        meta.mono_ns,
+        meta.wall_ns,
+        meta.h,
+        meta.w,
+        meta.pts_us,
+        meta.score,
+    )
+
+
+def pack(meta: FrameMeta) -> bytes:
+    """Pack frame metadata into a header."""
+    return HEADER.pack(*_fields(meta))
+
+
+def pack_into(meta: FrameMeta, buf: Union[bytearray, memoryview], offset: int) -> None:
+    """Pack frame metadata into a writable buffer at `offset`."""
+    HEADER.pack_into(buf, offset, *_fields(meta))
+
+
+def unpack(buf: Union[bytes, memoryview], offset: int = 0) -> Tuple[FrameMeta, int]:
+    """Unpack the header at `offset` of a buffered frame.
+
+    Return the metadata and the header size, i.e. where the payload starts.
+    """
+    magic, version = PREFIX.unpack_from(buf, offset)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"unsupported frame header {magic!r} v{version}")
+    (
+        _,
+        _,
+        codec,
+        dtype,
+        channels,
+        flags,
+        pixfmt,
+        seq,
+        mono_ns,
+        wall_ns,
+        h,
+        w,
+        pts_us,
+        score,
+    ) = HEADER.unpack_from(buf, offset)
+    meta = FrameMeta(
+        seq,
+        mono_ns,
+        wall_ns,
+        h,
+        w,
+        channels,
+        DTYPES[dtype],
+        codec,
+        pts_us,
+        flags,
+        pixfmt,
+        score,
+    )
+    return meta, HEADER.size
@@ -0,0 +1,40 @@
+"""Preallocated frame buffers for an allocation-free capture loop."""
+
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+class FramePool:
+    """Bounded round-robin pool of reusable buffers.
+
+    `next` hands out the buffers in turn, so a buffer is overwritten `size`
+    calls after it was handed out. Callers must be done with it by then.
+    New memory is only allocated when the requested shape changes, and each
+    allocation is counted.
+    """
+
+    def __init__(self, size: int) -> None:
+        """Initialize an empty pool of `size` buffers."""
+        self.size = max(1, size)
+        self.buffers: List[Optional[np.ndarray]] = [None] * self.size
+        self.index = 0
+        self.allocations = 0
+
+    def next(
+        self, shape: Tuple[int, ...], dtype: np.dtype = np.dtype(np.uint8)
+    ) -> np.ndarray:
+        """Return the next buffer, reallocated only if `shape` or `dtype` changed."""
+        self.index = (self.index + 1) % self.size
+        buf = self.buffers[self.index]
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = self.buffers[self.index] = np.empty(shape, dtype)
+            self.allocations += 1
+        return buf
+
+    def adopt(self, buf: Optional[np.ndarray], frame: np.ndarray) -> np.ndarray:
+        """Keep `frame` in the pool if OpenCV allocated it instead of filling `buf`."""
+        if frame is not buf:
+            self.buffers[self.index] = frame
+            self.allocations += 1
+        return frame
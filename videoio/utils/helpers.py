@@ -1,9 +1,13 @@
 """VideoIO helper functions."""
 
 import os
-import time
+import random
+from typing import Dict, Optional, Tuple
 
+import cv2
+import numpy as np
 import redis  # type: ignore
+import redis.asyncio  # type: ignore
 from redis.client import Redis  # type: ignore
 
 
@@ -13,15 +17,46 @@ def write_pid_file(pid_file: str) -> None:
         f.write(str(os.getpid()))
 
 
-def connect_redis(redis_host: str, redis_port: int) -> Redis:
-    """Connect to redis server."""
-    return redis.Redis(host=redis_host, port=redis_port, db=0)
+_pools: Dict[Tuple[int, str, int], redis.ConnectionPool] = {}
 
 
-def sleep_fps(start: float, fpsTime: float) -> None:
-    """Sleep elapsed time based on fps."""
-    curTime = time.time()
-    elapsed = curTime - start
-    # Try to keep FPS for files consistent otherwise frameBufMax will be reached
-    if elapsed < fpsTime:
-        time.sleep(fpsTime - elapsed)
+def connect_redis(redis_host: str, redis_port: int) -> Redis:
+    """Connect to redis server.
+
+    All connections of a process to one server share a connection pool, so
+    the cameras of a worker process do not open a socket set each.
+    """
+    key = (os.getpid(), redis_host, redis_port)
+    if key not in _pools:
+        _pools[key] = redis.ConnectionPool(host=redis_host, port=redis_port, db=0)
+    return redis.Redis(connection_pool=_pools[key])
+
+
+def backoff(attempt: int, max_delay: float) -> float:
+    """Return a jittered exponential delay in seconds before the given retry."""
+    return random.uniform(0.5, 1.0) * min(max_delay, 2.0**attempt)
+
+
+def connect_redis_async(
+    redis_host: str,
+    redis_port: int,
+    pool: Optional[redis.asyncio.ConnectionPool] = None,
+) -> redis.asyncio.Redis:
+    """Connect to redis server from asyncio, over a shared `pool` if given."""
+    if pool is not None:
+        return redis.asyncio.Redis(connection_pool=pool)
+    return redis.asyncio.Redis(host=redis_host, port=redis_port, db=0)
+
+
+def resize(
+    frame: np.ndarray, resolution: Tuple[int, int], dst: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Resize frame to resolution, into `dst` if given.
+
+    A frame already at the resolution is returned as is, without a copy.
+    """
+    if frame.shape[1::-1] == resolution:
+        return frame
+    if dst is None:
+        return cv2.resize(frame, resolution)
+    return cv2.resize(frame, resolution, dst=dst)
@@ -0,0 +1,140 @@
+"""Keyframe-only video reader based on ffmpeg-python."""
+
+import math
+import os
+import re
+import threading
+from queue import Empty, Queue
+from typing import Any, Optional, Tuple
+
+import cv2
+import ffmpeg
+import numpy as np
+
+PTS_TIME = re.compile(rb"pts_time:\s*(-?[\d.]+)")
+
+
+class KeyframeCapture:
+    """Decode only the I-frames of a stream.
+
+    FFmpeg runs with `-skip_frame nokey` and hands back scaled BGR frames on
+    a pipe. Their PTS are read from the `showinfo` filter on stderr. The class
+    mimics the parts of `cv2.VideoCapture` used by `RedisVideoCapture`, so it
+    can replace it as the capture stream.
+    """
+
+    def __init__(
+        self, src: str, resolution: Tuple[int, int], timeout_ms: int = 0
+    ) -> None:
+        """Start the ffmpeg decoder; an RTSP source fails after `timeout_ms`.
+
+        The timeout bounds each socket operation, not the wait for a frame,
+        which may be a long GOP away; 0 keeps ffmpeg's default.
+        """
+        self.width, self.height = resolution
+        self.frame_size = self.width * self.height * 3
+        # a file is decoded in real time, like a camera
+        self.is_file = os.path.exists(src)
+        input_args = {"skip_frame": "nokey"}
+        if self.is_file:
+            input_args["re"] = None  # type: ignore
+        elif src.startswith("rtsp://"):
+            input_args["rtsp_transport"] = "tcp"
+            if timeout_ms:
+                input_args["timeout"] = str(timeout_ms * 1000)  # µs
+        self.process = (
+            ffmpeg.input(src, **input_args)
+            .filter("scale", self.width, self.height)
+            .filter("showinfo")
+            .output("pipe:", format="rawvideo", pix_fmt="bgr24", vsync="0")
+            .global_args("-hide_banner", "-nostats", "-loglevel", "info")
+            .run_async(pipe_stdout=True, pipe_stderr=True)
+        )
+        self.pts: Queue[float] = Queue()
+        # frames grabbed and PTS taken off the queue; they pair up in order
+        self.frames = 0
+        self.pts_read = 0
+        self.pos_msec = 0.0
+        # frames are read from the pipe into one reused buffer
+        self.buffer = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        self.grabbed = False
+        self.thread = threading.Thread(target=self.read_pts, daemon=True)
+        self.thread.start()
+
+    def read_pts(self) -> None:
+        """Collect frame timestamps from ffmpeg's log."""
+        for line in self.process.stderr:
+            match = PTS_TIME.search(line)
+            if match is not None:
+                self.pts.put(float(match.group(1)) * 1000)
+
+    def isOpened(self) -> bool:
+        """Return True while ffmpeg is running."""
+        return self.process.poll() is None
+
+    def grab(self) -> bool:
+        """Read the next keyframe from the pipe."""
+        view = self.buffer.reshape(-1).data
+        size = 0
+        while size < self.frame_size:
+            count = self.process.stdout.readinto(view[size:])
+            if not count:
+                self.grabbed = False
+                return False
+            size += count
+        self.grabbed = True
+        self.pos_msec = self.frame_pts()
+        return True
+
+    def frame_pts(self, timeout: float = 1) -> float:
+        """Return the PTS (ms) of the frame just grabbed, or NaN if it is late.
+
+        The PTS of frames that were returned without theirs are skipped, so a
+        late log line does not shift the PTS of the later frames.
+        """
+        self.frames += 1
+        try:
+            while self.pts_read < self.frames:
+                pts = self.pts.get(timeout=timeout)
+                self.pts_read += 1
+        except Empty:
+            return math.nan
+        return pts
+
+    def retrieve(
+        self, image: Optional[np.ndarray] = None
+    ) -> Tuple[bool, Optional[np.ndarray]]:
+        """Return a copy of the last grabbed keyframe, into `image` if it fits."""
+        if not self.grabbed:
+            return False, None
+        if image is None or image.shape != self.buffer.shape:
+            return True, self.buffer.copy()
+        np.copyto(image, self.buffer)
+        return True, image
+
+    def read(
+        self, image: Optional[np.ndarray] = None
+    ) -> Tuple[bool, Optional[np.ndarray]]:
+        """Grab and return the next keyframe."""
+        self.grab()
+        return self.retrieve(image)
+
+    def get(self, prop: int) -> Any:
+        """Return a capture property, like `cv2.VideoCapture.get`."""
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            return self.pos_msec
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.width
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.height
+        # files are already paced by ffmpeg (-re)
+        return 0
+
+    def release(self) -> None:
+        """Stop ffmpeg."""
+        # nobody reads the pipe anymore; closing it lets ffmpeg exit on EPIPE
+        self.process.stdout.close()
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.wait()
+        self.thread.join(timeout=1)
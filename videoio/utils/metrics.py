@@ -0,0 +1,271 @@
+"""Low-overhead per-camera performance metrics."""
+
+import bisect
+import http.server
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Union
+
+# latency histogram bucket upper bounds in milliseconds
+LATENCY_BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class Counter:
+    """Monotonic counter.
+
+    Metrics are updated from several threads (e.g. the recording workers)
+    and read by the exporter, so updates take an uncontended lock; a gauge
+    is a single assignment and needs none.
+    """
+
+    def __init__(self) -> None:
+        """Initialize the counter at zero."""
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, n: int = 1) -> None:
+        """Add `n` to the counter."""
+        with self.lock:
+            self.value += n
+
+
+class Gauge:
+    """Last observed value."""
+
+    def __init__(self) -> None:
+        """Initialize the gauge at zero."""
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        """Set the gauge."""
+        self.value = value
+
+
+class Rate:
+    """Events per second, as an EWMA and over a sliding window.
+
+    Events are counted in one-second buckets of a fixed ring, so the cost of
+    `mark` does not depend on the event rate or the window length. Reading
+    the rate closes the elapsed seconds too, under the same lock as `mark`.
+    """
+
+    def __init__(self, window: int = 10, alpha: float = 0.3) -> None:
+        """Initialize a rate over the last `window` seconds."""
+        self.window = window
+        self.alpha = alpha
+        self.buckets = [0] * (window + 1)
+        self.second = int(time.monotonic())
+        self.started = self.second
+        self.total = 0
+        self.ewma = 0.0
+        self.lock = threading.Lock()
+
+    def _advance(self, now: int) -> None:
+        while self.second < now:
+            # close the current second and clear the bucket of the new one
+            done = self.buckets[self.second % len(self.buckets)]
+            self.ewma += self.alpha * (done - self.ewma)
+            self.second += 1
+            self.buckets[self.second % len(self.buckets)] = 0
+            if now - self.second > len(self.buckets):
+                # idle for longer than the ring; fast-forward
+                self.buckets = [0] * len(self.buckets)
+                self.ewma = 0.0
+                self.second = now
+
+    def mark(self, n: int = 1) -> None:
+        """Count `n` events now."""
+        with self.lock:
+            self._advance(int(time.monotonic()))
+            self.buckets[self.second % len(self.buckets)] += n
+            self.total += n
+
+    def rate(self) -> float:
+        """Return events per second over the completed seconds of the window."""
+        with self.lock:
+            self._advance(int(time.monotonic()))
+            seconds = min(self.window, self.second - self.started)
+            current = self.buckets[self.second % len(self.buckets)]
+            if seconds <= 0:
+                return float(current)
+            return (sum(self.buckets) - current) / seconds
+
+    def ewma_rate(self) -> float:
+        """Return the exponentially weighted events per second."""
+        with self.lock:
+            self._advance(int(time.monotonic()))
+            return self.ewma
+
+
+class Histogram:
+    """Fixed-bucket histogram, e.g. of stage latencies in milliseconds."""
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS_MS) -> None:
+        """Initialize an empty histogram with the given bucket upper bounds."""
+        self.bounds = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        """Add an observation."""
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def percentile(self, q: float) -> float:
+        """Return the upper bound of the bucket holding the `q` quantile."""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return float(bound)
+        return float("inf")
+
+
+Metric = Union[Counter, Gauge, Rate, Histogram]
+
+
+class MetricsRegistry:
+    """Named metrics of one camera."""
+
+    def __init__(self, camera: str) -> None:
+        """Initialize an empty registry."""
+        self.camera = camera
+        self.metrics: Dict[str, Metric] = {}
+        self.lock = threading.Lock()
+
+    def _get(self, name: str, kind: type) -> Metric:
+        metric = self.metrics.get(name)
+        if metric is None:
+            # two threads may ask for a new metric at once
+            with self.lock:
+                metric = self.metrics.setdefault(name, kind())
+        return metric
+
+    def counter(self, name: str) -> Counter:
+        """Return the counter `name`, creating it if needed."""
+        return self._get(name, Counter)  # type: ignore
+
+    def gauge(self, name: str) -> Gauge:
+        """Return the gauge `name`, creating it if needed."""
+        return self._get(name, Gauge)  # type: ignore
+
+    def rate(self, name: str) -> Rate:
+        """Return the rate `name`, creating it if needed."""
+        return self._get(name, Rate)  # type: ignore
+
+    def histogram(self, name: str) -> Histogram:
+        """Return the histogram `name`, creating it if needed."""
+        return self._get(name, Histogram)  # type: ignore
+
+    def render(self) -> str:
+        """Render the metrics in the Prometheus text format."""
+        label = f'camera="{self.camera}"'
+        lines: List[str] = []
+        for name, metric in sorted(list(self.metrics.items())):
+            name = "videoio_" + name
+            if isinstance(metric, (Counter, Gauge)):
+                lines.append(f"{name}{{{label}}} {metric.value}")
+            elif isinstance(metric, Rate):
+                lines.append(f"{name}_total{{{label}}} {metric.total}")
+                lines.append(f"{name}_per_second{{{label}}} {metric.rate():.3f}")
+                lines.append(f"{name}_ewma{{{label}}} {metric.ewma_rate():.3f}")
+            else:
+                with metric.lock:
+                    counts, total, sum_ = list(metric.counts), metric.count, metric.sum
+                seen = 0
+                for bound, count in zip(metric.bounds, counts):
+                    seen += count
+                    lines.append(f'{name}_bucket{{{label},le="{bound}"}} {seen}')
+                lines.append(f'{name}_bucket{{{label},le="+Inf"}} {total}')
+                lines.append(f"{name}_sum{{{label}}} {sum_:.3f}")
+                lines.append(f"{name}_count{{{label}}} {total}")
+        return "\n".join(lines) + "\n"
+
+
+_registries: Dict[str, MetricsRegistry] = {}
+
+
+def registry(camera: str) -> MetricsRegistry:
+    """Return the metrics registry of a camera."""
+    if camera not in _registries:
+        _registries[camera] = MetricsRegistry(camera)
+    return _registries[camera]
+
+
+def render_all() -> str:
+    """Render the metrics of every camera in this process."""
+    return "".join(reg.render() for _, reg in sorted(list(_registries.items())))
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        body = render_all().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args: object) -> None:
+        pass
+
+
+class MetricsExporter:
+    """Serve metrics on a local HTTP endpoint and/or dump them to a file."""
+
+    def __init__(
+        self, port: int = 0, dump_path: str = "", dump_sec: float = 10
+    ) -> None:
+        """Initialize the exporter; a `port` of 0 and no `dump_path` disable it."""
+        self.port = port
+        self.dump_path = dump_path
+        self.dump_sec = dump_sec
+        self.server: Optional[http.server.ThreadingHTTPServer] = None
+        self.stopped = threading.Event()
+
+    def start(self) -> None:
+        """Start the endpoint and dump threads."""
+        if self.port:
+            self.server = http.server.ThreadingHTTPServer(
+                ("127.0.0.1", self.port), _Handler
+            )
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        if self.dump_path:
+            threading.Thread(target=self.dump_loop, daemon=True).start()
+
+    def dump(self) -> None:
+        """Write the metrics to `dump_path`, atomically replacing the old dump."""
+        tmp = self.dump_path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(render_all())
+        os.replace(tmp, self.dump_path)
+
+    def dump_loop(self) -> None:
+        """Dump the metrics every `dump_sec` seconds."""
+        while not self.stopped.wait(self.dump_sec):
+            self.dump()
+
+    def stop(self) -> None:
+        """Stop exporting."""
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+
+
+def exporter_from_config(cfg: Dict[str, Dict[str, str]]) -> MetricsExporter:
+    """Create an exporter from the `[metrics]` config section."""
+    section = cfg.get("metrics", {})
+    return MetricsExporter(
+        port=int(section.get("port", 0)),
+        dump_path=section.get("dump_path", ""),
+        dump_sec=float(section.get("dump_sec", 10)),
+    )
@@ -0,0 +1,82 @@
+"""Drift-free loop pacing on absolute monotonic deadlines."""
+
+import time
+from typing import Optional
+
+CATCH_UP = "catchup"
+SKIP = "skip"
+
+
+class Pacer:
+    """Pace a loop to a target FPS.
+
+    Deadlines lie on a fixed grid, `period` apart, on the monotonic clock.
+    Sleep overshoot and slow iterations therefore do not add up, and wall-clock
+    jumps have no effect. When an iteration overruns its deadline, the `skip`
+    policy drops the grid slots already missed. The `catchup` policy runs the
+    late iterations back to back until the loop is on schedule again.
+    """
+
+    def __init__(self, fps: float, policy: str = SKIP) -> None:
+        """Initialize the pacer; `fps` of 0 disables pacing."""
+        if policy not in (CATCH_UP, SKIP):
+            raise ValueError(f"unknown pacing policy {policy!r}")
+        self.period_ns = int(1e9 / fps) if fps > 0 else 0
+        self.policy = policy
+        self.deadline = 0
+        self.missed = 0
+        self.skipped = 0
+
+    def start(self) -> None:
+        """Put the first deadline one period from now."""
+        self.deadline = time.monotonic_ns() + self.period_ns
+
+    def wait(self) -> None:
+        """Sleep until the current deadline, then move on to the next one."""
+        if self.period_ns == 0:
+            return
+        now = time.monotonic_ns()
+        if self.deadline == 0:
+            self.deadline = now + self.period_ns
+        if now < self.deadline:
+            time.sleep((self.deadline - now) / 1e9)
+            self.deadline += self.period_ns
+            return
+        self.missed += 1
+        if self.policy == SKIP:
+            late = (now - self.deadline) // self.period_ns
+            self.skipped += late
+            self.deadline += (late + 1) * self.period_ns
+        else:
+            self.deadline += self.period_ns
+
+    def stats(self) -> dict:
+        """Return the missed deadlines and skipped slots."""
+        return {"missed": self.missed, "skipped": self.skipped}
+
+
+class Cadence:
+    """Resample frames taken at arbitrary times to a fixed frame rate.
+
+    Output frames lie on a grid, `period` apart, on the stream clock. A frame
+    arriving before the next grid slot is skipped. A frame arriving after
+    several missed slots fills them all, repeated at most one second's worth,
+    so a slow capture keeps its duration without replaying an outage.
+    """
+
+    def __init__(self, fps: float) -> None:
+        """Initialize the cadence of `fps` frames per second."""
+        self.period = 1000.0 / fps
+        self.max_repeat = max(1, int(fps))
+        self.next_due: Optional[float] = None
+
+    def due(self, pos: float) -> int:
+        """Return the number of output frames the frame at `pos` (ms) stands for."""
+        if self.next_due is None or pos < self.next_due - 2 * self.period:
+            # first frame, or stream timestamps went backwards (source restarted)
+            self.next_due = pos
+        if pos < self.next_due:
+            return 0
+        count = int((pos - self.next_due) // self.period) + 1
+        self.next_due += count * self.period
+        return min(count, self.max_repeat)
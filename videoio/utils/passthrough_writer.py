@@ -0,0 +1,250 @@
+"""Passthrough video writer remuxing the compressed source stream."""
+
+import os
+import threading
+import time
+from abc import abstractmethod
+from collections import deque
+from datetime import datetime
+from typing import Any, BinaryIO, Deque, Dict, List, Optional, Tuple, Union
+
+import ffmpeg
+import numpy as np
+import utils.helpers as hvio
+from utils.video_writer import BaseWriter
+
+TS_PACKET = 188
+# MPEG-TS packets read from the source process at once
+READ_PACKETS = 64
+
+
+def packet_pids(data: bytes) -> np.ndarray:
+    """Return the PID of every MPEG-TS packet of `data`."""
+    packets = np.frombuffer(data, dtype=np.uint8).reshape(-1, TS_PACKET)
+    return (packets[:, 1].astype(np.int32) & 0x1F) << 8 | packets[:, 2]
+
+
+def keyframe_packets(data: bytes) -> np.ndarray:
+    """Return the indices of the MPEG-TS packets of `data` starting a keyframe.
+
+    FFmpeg's muxer sets the random access indicator of the adaptation field
+    on the first packet of every keyframe.
+    """
+    packets = np.frombuffer(data, dtype=np.uint8).reshape(-1, TS_PACKET)
+    adaptation = (packets[:, 3] & 0x20 != 0) & (packets[:, 4] > 0)
+    return np.flatnonzero(adaptation & (packets[:, 5] & 0x40 != 0))
+
+
+class SourceWriter(BaseWriter):
+    """Base of the writers recording the compressed source stream.
+
+    An ffmpeg process copies the video of `--src` into MPEG-TS on a pipe,
+    without decoding or encoding it, and the packets are handed to
+    `keyframe` and `packets` split at keyframes. Recordings keep the source
+    resolution, frame rate and quality; frames passed to `update` are not
+    used. The source is opened a second time, and reopened with a backoff
+    when it ends. Subclasses set up their state before calling `__init__`,
+    which starts reading.
+    """
+
+    def __init__(self, cfg: Dict[str, Dict[str, str]]) -> None:
+        """Start reading the source stream."""
+        super().__init__(cfg)
+        self.file_ext = "ts"
+        self.src = cfg["defaultArgs"]["--src"]
+        self.bufSec = float(cfg["record"]["rec_buf_sec"])
+        self.max_backoff = float(cfg.get("reconnect", {}).get("max_backoff", 30))
+        self.lock = threading.Lock()
+        # tables (PAT, PMT, ...) sent before the first keyframe of the source
+        self.preamble = bytearray()
+        self.header = b""
+        self.synced = False
+        self.source: Optional[Any] = None
+        self.closed = threading.Event()
+        self.reader = threading.Thread(target=self.read_source, daemon=True)
+        self.reader.start()
+
+    def open_source(self) -> Any:
+        """Start copying the source video into MPEG-TS on a pipe."""
+        input_args: Dict[str, Any] = {}
+        if os.path.exists(self.src):
+            input_args["re"] = None  # a file is read in real time, like a camera
+        elif self.src.startswith("rtsp://"):
+            input_args["rtsp_transport"] = "tcp"
+        return (
+            ffmpeg.input(self.src, **input_args)["v:0"]
+            .output("pipe:", format="mpegts", vcodec="copy")
+            .global_args("-hide_banner", "-nostats", "-loglevel", "error")
+            .run_async(pipe_stdout=True)
+        )
+
+    def read_source(self) -> None:
+        """Buffer the source packets, reopening the source when it ends."""
+        attempt = 0
+        while not self.closed.is_set():
+            source = self.open_source()
+            with self.lock:
+                if self.closed.is_set():
+                    source.terminate()
+                    break
+                self.source = source
+                self.restart()
+            while True:
+                data = source.stdout.read(TS_PACKET * READ_PACKETS)
+                if len(data) < TS_PACKET:
+                    break
+                attempt = 0
+                self.feed(data[: len(data) - len(data) % TS_PACKET])
+            source.wait()
+            delay = hvio.backoff(attempt, self.max_backoff)
+            if self.verbose == 2 and not self.closed.is_set():
+                print(f"[INFO] Reopening the passthrough source in {delay:.1f} s")
+            if self.closed.wait(delay):
+                break
+            attempt += 1
+
+    def restart(self) -> None:
+        """Forget the stream of the previous source process."""
+        self.preamble = bytearray()
+        self.header = b""
+        self.synced = False
+
+    def feed(self, data: bytes) -> None:
+        """Split source packets at keyframes."""
+        now = time.monotonic()
+        starts: List[int] = (keyframe_packets(data) * TS_PACKET).tolist()
+        with self.lock:
+            pos = 0
+            for start in starts + [len(data)]:
+                if start > pos:
+                    if self.synced:
+                        self.packets(data[pos:start])
+                    else:
+                        self.preamble.extend(data[pos:start])
+                if start == len(data):
+                    break
+                if not self.synced:
+                    # keep the tables, not the video of a partial first GOP
+                    end = start + TS_PACKET
+                    video_pid = packet_pids(data[start:end])[0]
+                    preamble = bytes(self.preamble)
+                    packets = np.frombuffer(preamble, dtype=np.uint8)
+                    packets = packets.reshape(-1, TS_PACKET)
+                    tables = packet_pids(preamble) != video_pid
+                    self.header = packets[tables].tobytes()
+                    self.synced = True
+                self.keyframe(now)
+                pos = start
+
+    @abstractmethod
+    def keyframe(self, now: float) -> None:
+        """Start a GOP at monotonic time `now`; `header` holds the tables."""
+
+    @abstractmethod
+    def packets(self, data: bytes) -> None:
+        """Take the packets of the current GOP."""
+
+    def update(self, frame: np.ndarray) -> None:
+        """Ignore decoded frames; the recording copies the source stream."""
+
+    def close(self) -> None:
+        """Stop recording and stop reading the source."""
+        super().close()
+        with self.lock:
+            self.closed.set()
+            if self.source is not None:
+                self.source.terminate()
+        self.reader.join()
+
+
+class PassthroughWriter(SourceWriter):
+    """Record the compressed source stream from a pre-event buffer in RAM.
+
+    The last `Rec_Buf_Sec` seconds are kept as packets, in whole GOPs so
+    that a recording starts on a keyframe. `recStart` writes them, then the
+    live packets, to a `.ts` file, which stays playable if the process dies
+    mid-recording. Events with different names may overlap, each recorded
+    to its own file.
+    """
+
+    def __init__(self, cfg: Dict[str, Dict[str, str]]) -> None:
+        """Start buffering the source stream."""
+        # pre-event buffer: (monotonic start time, packets) of every GOP
+        self.gops: Deque[Tuple[float, bytearray]] = deque()
+        # files of the recordings in progress, by event name
+        self.files: Dict[str, BinaryIO] = {}
+        super().__init__(cfg)
+
+    def qsize(self) -> int:
+        """Return the number of buffered GOPs."""
+        return len(self.gops)
+
+    def restart(self) -> None:
+        """Forget the GOPs of the previous source process."""
+        super().restart()
+        self.gops.clear()
+
+    def keyframe(self, now: float) -> None:
+        """Start a GOP in the pre-event buffer."""
+        if not self.gops:
+            self.write(self.header)  # tables of a new source process
+        self.gops.append((now, bytearray()))
+        # keep the GOPs covering the last Rec_Buf_Sec seconds
+        while len(self.gops) > 1 and self.gops[1][0] <= now - self.bufSec:
+            self.gops.popleft()
+
+    def packets(self, data: bytes) -> None:
+        """Add packets to the current GOP, and write them if recording."""
+        self.gops[-1][1].extend(data)
+        self.write(data)
+
+    def write(self, data: Union[bytes, bytearray]) -> None:
+        """Write packets to the recordings in progress, if any."""
+        for name, f in list(self.files.items()):
+            try:
+                f.write(data)
+            except OSError:
+                # e.g. disk full; end this recording
+                self.metrics.counter("writer_errors").inc()
+                f.close()
+                del self.files[name]
+                continue
+            self.metrics.rate("bytes_written").mark(len(data))
+        self.recStarted = bool(self.files)
+
+    def recStart(self, timestamp: datetime, name: str) -> None:
+        """Start recording the event `name`, from the first buffered keyframe."""
+        if name in self.files:
+            return
+        if self.verbose == 2:
+            print(f"[INFO] Starting recording {name}")
+
+        self.videoFileName = self.makeFileName(timestamp, name)
+        f = open(self.videoFileName, "wb")
+        with self.lock:
+            # without a keyframe yet, the header is written along with it
+            buffered = (
+                [self.header] + [gop for _, gop in self.gops] if self.gops else []
+            )
+            try:
+                for data in buffered:
+                    f.write(data)
+                    self.metrics.rate("bytes_written").mark(len(data))
+            except OSError:
+                self.metrics.counter("writer_errors").inc()
+                f.close()
+                return
+            self.files[name] = f
+            self.recStarted = True
+
+    def recStop(self, name: Optional[str] = None) -> None:
+        """Stop recording the event `name` (default: all)."""
+        if self.verbose == 2:
+            print(f"[INFO] Stopping recording {name or ''}")
+
+        with self.lock:
+            names = list(self.files) if name is None else [name]
+            files = [self.files.pop(n) for n in names if n in self.files]
+            self.recStarted = bool(self.files)
+        for f in files:
+            f.close()
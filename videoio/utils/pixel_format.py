@@ -0,0 +1,90 @@
+"""Pixel formats of the buffered frames."""
+
+from typing import Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+
+# pixel format tags stored in the frame header
+BGR = 0
+# luma only, 1 byte per pixel
+GRAY = 1
+# planar YUV 4:2:0, the Y plane then the U and V planes, as one
+# (h * 3 / 2, w) array of 1.5 bytes per pixel
+I420 = 2
+
+PIXEL_FORMATS: Dict[str, int] = {"bgr": BGR, "gray": GRAY, "i420": I420}
+# ffmpeg rawvideo names, for writers fed with buffered frames
+FFMPEG_PIX_FMTS: Dict[int, str] = {BGR: "bgr24", GRAY: "gray", I420: "yuv420p"}
+
+
+def pixel_format_tag(name: str) -> int:
+    """Return the header tag of a pixel format name from the config."""
+    try:
+        return PIXEL_FORMATS[name.lower()]
+    except KeyError:
+        raise ValueError(
+            f"unknown pixel format {name!r}, expected one of {sorted(PIXEL_FORMATS)}"
+        ) from None
+
+
+def image_size(img: np.ndarray, pixfmt: int) -> Tuple[int, int]:
+    """Return the `(h, w)` of the image stored in `img`."""
+    h, w = img.shape[:2]
+    if pixfmt == I420:
+        h = h * 2 // 3
+    return h, w
+
+
+def from_bgr(
+    img: np.ndarray, pixfmt: int, dst: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Convert a BGR image to `pixfmt`, into `dst` if given.
+
+    A BGR image is returned as is. I420 needs even sizes: an odd last row or
+    column is cropped.
+    """
+    if pixfmt == BGR:
+        return img
+    if pixfmt == GRAY:
+        return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=dst)
+    if pixfmt != I420:
+        raise ValueError(f"unknown pixel format tag {pixfmt}")
+    h, w = img.shape[:2]
+    if h % 2 or w % 2:
+        img = img[: h & ~1, : w & ~1]
+    return cv2.cvtColor(img, cv2.COLOR_BGR2YUV_I420, dst=dst)
+
+
+def converted_shape(h: int, w: int, pixfmt: int) -> Tuple[int, ...]:
+    """Return the array shape of a `h` x `w` BGR image converted to `pixfmt`."""
+    if pixfmt == GRAY:
+        return (h, w)
+    if pixfmt == I420:
+        return (h // 2 * 3, w & ~1)
+    return (h, w, 3)
+
+
+def to_bgr(
+    img: np.ndarray, pixfmt: int, dst: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Convert a buffered image to BGR, into `dst` if given."""
+    if pixfmt == BGR:
+        return img
+    if pixfmt == GRAY:
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR, dst=dst)
+    if pixfmt != I420:
+        raise ValueError(f"unknown pixel format tag {pixfmt}")
+    return cv2.cvtColor(img, cv2.COLOR_YUV2BGR_I420, dst=dst)
+
+
+def luma(img: np.ndarray, pixfmt: int) -> np.ndarray:
+    """Return the luma plane of a buffered image.
+
+    For GRAY and I420 frames this is a view, without conversion.
+    """
+    if pixfmt == GRAY:
+        return img
+    if pixfmt == I420:
+        return img[: image_size(img, pixfmt)[0]]
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
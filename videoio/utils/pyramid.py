@@ -0,0 +1,120 @@
+"""Extra frame sizes and crops published from the same decoded frame."""
+
+import copy
+import re
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import cv2
+import numpy as np
+import utils.backpressure as backpressure
+from utils.frame_pool import FramePool
+
+# WxH (resized frame) or WxH+X+Y (crop of the decoded frame at X,Y, clipped)
+GEOMETRY = re.compile(r"^(\d+)x(\d+)(?:\+(\d+)\+(\d+))?$")
+
+
+class Output(NamedTuple):
+    """An extra frame buffer of the capture."""
+
+    name: str
+    size: Tuple[int, int]
+    offset: Optional[Tuple[int, int]] = None
+
+
+def outputs(cfg: Dict[str, Dict[str, str]]) -> List[Output]:
+    """Return the outputs of the `[outputs]` section of the config."""
+    result = []
+    for name, geometry in cfg.get("outputs", {}).items():
+        match = GEOMETRY.match(geometry.strip())
+        if match is None:
+            raise ValueError(
+                f"output {name!r}: expected WxH or WxH+X+Y, got {geometry!r}"
+            )
+        w, h, x, y = match.groups()
+        offset = None if x is None else (int(x), int(y))
+        result.append(Output(name, (int(w), int(h)), offset))
+    return result
+
+
+def output_config(cfg: Dict[str, Dict[str, str]], name: str) -> Dict:
+    """Return the config of the frame buffer of output `name`.
+
+    Its camera name is `<cam_name>:<name>`, so it has its own buffer key and
+    metrics, and consumers pass it to `RedisShmem`, `ShmRing` or `aio.reader`
+    to read frames of that size. An output never makes the capture wait for
+    its readers: a `block` capture policy becomes `drop-oldest`.
+    """
+    output = next((o for o in outputs(cfg) if o.name == name), None)
+    if output is None:
+        raise ValueError(f"unknown output {name!r}")
+    out_cfg = copy.deepcopy(cfg)
+    out_cfg["APP"]["cam_name"] = f"{cfg['APP']['cam_name']}:{name}"
+    out_cfg["defaultArgs"]["--width"] = str(output.size[0])
+    out_cfg["defaultArgs"]["--height"] = str(output.size[1])
+    if backpressure.capture_policy(cfg) == backpressure.BLOCK:
+        out_cfg["Analysis"]["capture_policy"] = backpressure.DROP_OLDEST
+    return out_cfg
+
+
+def scale(
+    src: np.ndarray, size: Tuple[int, int], dst: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Resize `src` to `size` the cheapest way that does not alias.
+
+    A frame already at the size is returned as is. Area interpolation is
+    fast for integer factors (e.g. halving, faster than pyrDown) and needed
+    beyond a factor of two; smaller reductions and enlargements are bilinear.
+    """
+    h, w = src.shape[:2]
+    if (w, h) == size:
+        return src
+    if w % size[0] == 0 and h % size[1] == 0 or w > 2 * size[0] or h > 2 * size[1]:
+        return cv2.resize(src, size, dst=dst, interpolation=cv2.INTER_AREA)
+    return cv2.resize(src, size, dst=dst)
+
+
+class Pyramid:
+    """Compute the outputs of a decoded frame.
+
+    Every resized output is computed from the smallest frame computed so far
+    that is at least as large, largest outputs first, so a chain of sizes
+    costs little more than its largest level.
+    """
+
+    def __init__(self, outputs: List[Output], pool_size: int) -> None:
+        """Initialize the outputs, each with its own pool of buffers."""
+        self.outputs = sorted(
+            outputs, key=lambda o: (o.offset is None, -o.size[0] * o.size[1])
+        )
+        self.pools = {o.name: FramePool(pool_size) for o in outputs}
+
+    def compute(
+        self, frame: np.ndarray, levels: List[np.ndarray]
+    ) -> Dict[str, np.ndarray]:
+        """Return the outputs of the decoded `frame`, by name.
+
+        `levels` are frames already computed from it, e.g. the published one.
+        Crops are views of `frame`, clipped to its size; crops entirely
+        outside it are left out.
+        """
+        levels = [frame] + levels
+        result = {}
+        for o in self.outputs:
+            w, h = o.size
+            if o.offset is not None:
+                x, y = o.offset
+                right, bottom = x + w, y + h
+                crop = frame[y:bottom, x:right]
+                if crop.size:
+                    result[o.name] = crop
+                continue
+            larger = [lvl for lvl in levels if lvl.shape[1] >= w and lvl.shape[0] >= h]
+            src = min(
+                larger, key=lambda lvl: lvl.shape[0] * lvl.shape[1], default=frame
+            )
+            pool = self.pools[o.name]
+            dst = pool.next((h, w) + frame.shape[2:])
+            img = scale(src, o.size, dst)
+            result[o.name] = img if img is src else pool.adopt(dst, img)
+            levels.append(result[o.name])
+        return result
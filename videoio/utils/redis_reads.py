@@ -0,0 +1,161 @@
+"""Frame buffer reads shared by the blocking and the asyncio Redis readers.
+
+The read logic is written once, as generators that yield the Redis round
+trips they need and are sent the replies. `RedisShmem` runs them with `run`
+on a blocking client, `AsyncRedisShmem` with `run_async` on redis.asyncio.
+"""
+
+from typing import (
+    Any,
+    Dict,
+    Generator,
+    List,
+    NamedTuple,
+    Optional,
+    TypeVar,
+    Union,
+)
+
+import utils.backpressure as backpressure
+import utils.metrics as metrics
+
+T = TypeVar("T")
+
+
+class Call(NamedTuple):
+    """A Redis command sent on its own."""
+
+    name: str
+    args: tuple = ()
+    kwargs: Optional[Dict[str, Any]] = None
+
+
+class Pipeline(NamedTuple):
+    """Redis commands sent in one round trip; the reply is the list of theirs."""
+
+    calls: List[Call]
+    transaction: bool = True
+
+
+Steps = Generator[Union[Call, Pipeline], Any, T]
+
+
+def run(db: Any, steps: Steps[T]) -> T:
+    """Run the round trips of `steps` on a blocking Redis client."""
+    try:
+        request = next(steps)
+        while True:
+            if isinstance(request, Pipeline):
+                pipe = db.pipeline(transaction=request.transaction)
+                for call in request.calls:
+                    getattr(pipe, call.name)(*call.args, **(call.kwargs or {}))
+                reply = pipe.execute()
+            else:
+                reply = getattr(db, request.name)(
+                    *request.args, **(request.kwargs or {})
+                )
+            request = steps.send(reply)
+    except StopIteration as done:
+        return done.value
+
+
+async def run_async(db: Any, steps: Steps[T]) -> T:
+    """Run the round trips of `steps` on a redis.asyncio client."""
+    try:
+        request = next(steps)
+        while True:
+            if isinstance(request, Pipeline):
+                async with db.pipeline(transaction=request.transaction) as pipe:
+                    for call in request.calls:
+                        getattr(pipe, call.name)(*call.args, **(call.kwargs or {}))
+                    reply = await pipe.execute()
+            else:
+                method = getattr(db, request.name)
+                reply = await method(*request.args, **(request.kwargs or {}))
+            request = steps.send(reply)
+    except StopIteration as done:
+        return done.value
+
+
+def max_lag(reader: Any) -> int:
+    """Return how many frames `reader` may lag behind before skipping."""
+    return 0 if reader.read_policy == backpressure.LATEST else reader.max_lag
+
+
+def list_batch(reader: Any, n: int, timeout: Optional[float]) -> Steps[List[bytes]]:
+    """Pop up to `n` frames of the list `reader.key` in one atomic round trip.
+
+    An empty queue is waited on with `BLPOP`, then the frames published
+    along with the popped one are taken too, up to `n`. Unless the read
+    policy is `block`, a reader lagging behind gets the newest `n` frames
+    instead and the others are skipped through `reader.skip`.
+    """
+    key = reader.key
+    items, _, left = yield Pipeline(
+        [
+            Call("lrange", (key, 0, n - 1)),
+            Call("ltrim", (key, n, -1)),
+            Call("llen", (key,)),
+        ]
+    )
+    if not items:
+        item = yield Call("blpop", (key,), {"timeout": timeout})
+        if item is None:
+            return []
+        if n == 1:
+            return [item[1]]
+        rest, _ = yield Pipeline(
+            [Call("lrange", (key, 0, n - 2)), Call("ltrim", (key, n - 1, -1))]
+        )
+        return [item[1]] + rest
+    if reader.read_policy != backpressure.BLOCK and left > max_lag(reader):
+        newest, _ = yield Pipeline(
+            [Call("lrange", (key, -n, -1)), Call("delete", (key,))]
+        )
+        if newest:
+            reader.skip(len(items) + left - len(newest))
+            items = newest
+    return items
+
+
+def stream_batch(reader: Any, n: int, timeout: Optional[float]) -> Steps[List[bytes]]:
+    """Read up to `n` frames of the stream `reader.key` after the reader's cursor.
+
+    The previous cursor is saved alongside the read, not in a round trip of
+    its own. Unless the read policy is `block`, a reader lagging behind skips
+    to the newest `n` frames, never going back to frames it read before.
+    Updates `reader.cursor`, `reader.lag` and `reader.last_seq`.
+    """
+    if reader.cursor is None:
+        cursor = yield Call("hget", (reader.cursor_key, reader.consumer))
+        reader.cursor = "0-0" if cursor is None else cursor.decode()
+    _, entries, head = yield Pipeline(
+        [
+            Call("hset", (reader.cursor_key, reader.consumer, reader.cursor)),
+            Call(
+                "xread",
+                ({reader.key: reader.cursor},),
+                {"count": n, "block": int((timeout or 0) * 1000)},
+            ),
+            Call("get", (reader.head_key,)),
+        ],
+        transaction=False,
+    )
+    if not entries:
+        return []
+    entries = entries[0][1]
+    first = int(entries[0][1][b"n"])
+    seq = int(entries[-1][1][b"n"])
+    reader.lag = max(int(head) - seq, 0) if head is not None else 0
+    if reader.read_policy != backpressure.BLOCK and reader.lag > max_lag(reader):
+        newest = yield Call("xrevrange", (reader.key,), {"count": n})
+        newest = [entry for entry in newest if int(entry[1][b"n"]) >= first]
+        if newest:
+            entries = newest[::-1]
+            reader.skip(max(int(entries[0][1][b"n"]) - first, 0))
+            seq = int(entries[-1][1][b"n"])
+            reader.lag = 0
+    metrics.registry(reader.Q_name).gauge("consumer_lag").set(reader.lag)
+    reader.cursor = entries[-1][0].decode()
+    reader.last_seq = seq
+    return [fields[b"f"] for _, fields in entries]
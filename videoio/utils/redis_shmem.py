@@ -1,91 +1,510 @@
 """Redis Shared memory video capture module."""
 
-import datetime
-import struct
-from typing import Dict, Optional, Tuple
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Deque, Dict, List, Optional, Tuple, Union, cast
 
-import cv2
 import numpy as np
+import utils.backpressure as backpressure
+import utils.frame_batch as frame_batch
+import utils.frame_codec as codecs
+import utils.frame_header as header
 import utils.helpers as hvio
+import utils.metrics as metrics
+import utils.pixel_format as pixel_format
+import utils.redis_reads as redis_reads
+import utils.tracing as tracing
+from utils.frame_batch import FrameBatch
+from utils.frame_header import FrameMeta
+from utils.frame_pool import FramePool
+from utils.tracing import FrameTrace
+
+
+def queue_key(cfg: Dict[str, Dict[str, str]]) -> str:
+    """Return the Redis key of the configured camera's frame queue."""
+    key = "%s:%s" % ("namespace", cfg["APP"]["cam_name"])
+    if cfg["redis"].get("mode", "list") == "stream":
+        key += ":stream"
+    return key
 
 
 class RedisShmem(object):
     """RedisShmem class."""
 
-    def __init__(self, cfg: Dict[str, Dict[str, str]]) -> None:
-        """Initialize the RedisShmem context."""
+    def __init__(
+        self,
+        cfg: Dict[str, Dict[str, str]],
+        consumer: Optional[str] = None,
+        producer: bool = False,
+    ) -> None:
+        """Initialize the RedisShmem context.
+
+        In `stream` mode frames are kept in a Redis stream and every `consumer`
+        reads them through its own cursor, so several analytics processes can
+        share one capture. Waits on a `producer` context are served in-process;
+        other processes are woken through a Redis pub/sub channel.
+        """
         self.__db = hvio.connect_redis(cfg["redis"]["host"], int(cfg["redis"]["port"]))
         self.Q_name = cfg["APP"]["cam_name"]
-        self.key = "%s:%s" % ("namespace", self.Q_name)
+        self.stream = cfg["redis"].get("mode", "list") == "stream"
+        self.key = queue_key(cfg)
+        self.head_key = self.key + ":head"
+        self.notify_channel = self.key + ":notify"
+        self.producer = producer
+        self.cond = threading.Condition()
+        self.pubsub = None
+        self.cursor_key = self.key + ":consumers"
+        self.consumer = consumer or cfg["redis"].get("consumer", "default")
+        # drop unread frames once the consumer is more than max_lag behind
+        self.max_lag = int(cfg["redis"].get("max_lag", 0))
+        self.capture_policy = backpressure.capture_policy(cfg)
+        self.read_policy = backpressure.read_policy(cfg)
+        if self.stream and self.capture_policy in (
+            backpressure.BLOCK,
+            backpressure.DROP_NEWEST,
+        ):
+            # reading does not remove stream entries, so the stream is never "full"
+            raise ValueError(
+                f"capture policy {self.capture_policy!r} needs the list mode"
+            )
+        self.cursor = "0-0"
+        self.last_seq: Optional[int] = None
+        self.lag = 0
+        self.dropped = 0
+        if self.stream:
+            cursor = self.__db.hget(self.cursor_key, self.consumer)
+            if cursor is not None:
+                self.cursor = cast(bytes, cursor).decode()
         self.fps_van = (
             int(cfg["Analysis"]["fps_van"])
             if int(cfg["Analysis"]["fps_van"]) != 0
             else 12
         )
         self.q_size = int(cfg["Analysis"]["buf_sec"]) * self.fps_van
+        self.poll = 1.0 / (self.fps_van * 4)
+        # max frames per publish round trip while the reader is behind; a
+        # latest or drop-oldest reader is behind by design, and needs the
+        # newest frame published at once. Only a blocking capture holds frames
+        # back: otherwise a batch evicts unread frames from the full queue,
+        # and a reader waiting on it gets one new frame per batch
+        self.pub_batch = max(1, int(cfg["redis"].get("pub_batch", 1)))
+        if (
+            self.read_policy != backpressure.BLOCK
+            or self.capture_policy != backpressure.BLOCK
+        ):
+            self.pub_batch = 1
+        self.pending: List[Union[bytes, memoryview]] = []
+        self.behind = False
+        # frame payload codec, optionally encoded on a pool of threads
+        self.codec = codecs.codec_tag(cfg["redis"].get("codec", "raw"))
+        # frames are stored in the pixel format the capture converts them to
+        self.pixfmt = pixel_format.pixel_format_tag(
+            cfg["Analysis"].get("pixel_format", "bgr")
+        )
+        self.quality = int(cfg["redis"].get("jpeg_quality", 90))
+        self.encode_workers = int(cfg["redis"].get("encode_workers", 0))
+        self.encoder = (
+            ThreadPoolExecutor(self.encode_workers, thread_name_prefix="encode")
+            if self.encode_workers > 0 and self.codec != codecs.RAW
+            else None
+        )
+        self.encoding: Deque[Future] = deque()
+        self.seq = 0
+        # raw payloads are built in place; one spare buffer beyond a full batch
+        self.payloads = FramePool(self.pub_batch + 1)
+        self.batches = FramePool(2)
+        # publish counters
+        self.round_trips = 0
+        self.frames_published = 0
+        self.bytes_published = 0
+        self.raw_bytes = 0
+        self.encode_time = 0.0
+        self.metrics = metrics.registry(self.Q_name)
+        self.tracer = tracing.tracer(cfg)
+        self.traces: Deque[FrameTrace] = deque()
 
     def qsize(self) -> int:
-        """Return the approximate size of the queue."""
-        return self.__db.llen(self.key)
+        """Return the approximate size of the queue.
+
+        For a stream consumer this is the number of frames it has not read yet.
+        """
+        if not self.stream:
+            return self.__db.llen(self.key)
+        pipe = self.__db.pipeline(transaction=False)
+        pipe.xlen(self.key)
+        pipe.get(self.head_key)
+        length, head = pipe.execute()
+        if self.last_seq is None or head is None:
+            return length
+        return min(length, max(int(head) - self.last_seq, 0))
 
     def empty(self) -> bool:
         """Return True if the queue is empty, False otherwise."""
         return self.qsize() == 0
 
-    def put_Q(self, frame: np.ndarray) -> None:
-        """Put item into the queue."""
-        encoded = self.encodeFrame(frame)
-        self.__db.rpush(self.key, encoded)
-        if self.qsize() > self.q_size:
-            self.__db.lpop(self.key)
+    def put_Q(
+        self,
+        frame: np.ndarray,
+        pts_us: int = -1,
+        grab_ns: int = 0,
+        trace: Optional[FrameTrace] = None,
+        score: float = -1.0,
+        flags: int = 0,
+    ) -> None:
+        """Put item into the queue, with its change score and header flags.
+
+        While the reader keeps up every frame is published at once. Once the
+        queue is full, a blocking capture holds up to `pub_batch` frames back
+        and publishes them together in a single round trip.
+        """
+        self.raw_bytes += frame.nbytes
+        if trace is not None:
+            trace.seq = self.seq
+            self.traces.append(trace)
+            flags |= header.TRACED
+        meta = header.frame_meta(
+            frame, self.seq, self.codec, pts_us, grab_ns, flags, self.pixfmt, score
+        )
+        self.seq += 1
+        if self.encoder is None:
+            self.pending.append(self._encode(frame, meta, trace))
+        else:
+            # frames are encoded in parallel and published in capture order
+            self.encoding.append(self.encoder.submit(self._encode, frame, meta, trace))
+            while self.encoding and (
+                self.encoding[0].done() or len(self.encoding) > self.encode_workers
+            ):
+                self.pending.append(self.encoding.popleft().result())
+            if not self.pending:
+                return
+        if self.behind and len(self.pending) < self.pub_batch:
+            return
+        self.flush()
+
+    def _encode(
+        self, frame: np.ndarray, meta: FrameMeta, trace: Optional[FrameTrace] = None
+    ) -> Union[bytes, memoryview]:
+        tic = time.perf_counter()
+        encoded: Union[bytes, memoryview]
+        if self.codec == codecs.RAW:
+            encoded = self.encodeFrameInto(frame, meta, self.payloads)
+        else:
+            encoded = self.encodeFrame(frame, self.codec, self.quality, meta)
+        elapsed = time.perf_counter() - tic
+        self.encode_time += elapsed
+        self.metrics.histogram("encode_ms").observe(1000 * elapsed)
+        if trace is not None:
+            trace.stamp("encode")
+        return encoded
+
+    def flush(self) -> None:
+        """Append pending frames and cap the queue in one atomic round trip."""
+        while self.encoding:
+            self.pending.append(self.encoding.popleft().result())
+        if not self.pending:
+            return
+        if self.stream:
+            self.flush_stream()
+            return
+        keep = 1 if self.capture_policy == backpressure.LATEST else self.q_size
+        tic = time.perf_counter()
+        pipe = self.__db.pipeline(transaction=True)
+        pipe.rpush(self.key, *self.pending)
+        if self.capture_policy == backpressure.DROP_NEWEST:
+            pipe.ltrim(self.key, 0, keep - 1)
+        else:
+            pipe.ltrim(self.key, -keep, -1)
+        pipe.publish(self.notify_channel, len(self.pending))
+        length, _, _ = pipe.execute()
+        self.metrics.histogram("publish_ms").observe(1000 * (time.perf_counter() - tic))
+        # frames pushed past the cap were trimmed before anyone read them
+        self.metrics.counter("frames_dropped").inc(max(length - keep, 0))
+        self.metrics.gauge("queue_depth").set(min(length, keep))
+        self.published()
+        self.behind = keep > 1 and length >= keep
+
+    def flush_stream(self) -> None:
+        """Append pending frames to the stream in one round trip.
+
+        Each entry carries its sequence number `n`. The newest one is kept
+        under `head_key` so consumers can measure their lag.
+        """
+        keep = 1 if self.capture_policy == backpressure.LATEST else self.q_size
+        tic = time.perf_counter()
+        pipe = self.__db.pipeline(transaction=True)
+        for i, item in enumerate(self.pending, self.frames_published):
+            pipe.xadd(self.key, {"n": i, "f": item}, maxlen=keep)
+        pipe.set(self.head_key, self.frames_published + len(self.pending) - 1)
+        pipe.publish(self.notify_channel, len(self.pending))
+        pipe.execute()
+        self.metrics.histogram("publish_ms").observe(1000 * (time.perf_counter() - tic))
+        self.published()
+
+    def published(self) -> None:
+        """Count the frames just published and wake up waiting readers."""
+        size = sum(len(item) for item in self.pending)
+        self.round_trips += 1
+        self.frames_published += len(self.pending)
+        self.bytes_published += size
+        self.metrics.rate("frames_published").mark(len(self.pending))
+        self.metrics.counter("bytes_published").inc(size)
+        while self.traces and self.traces[0].seq < self.frames_published:
+            trace = self.traces.popleft()
+            trace.stamp("publish")
+            self.tracer.finish(trace)
+        self.pending = []
+        self.notify()
+
+    def notify(self) -> None:
+        """Wake up in-process waiters, e.g. to re-check an abort condition."""
+        with self.cond:
+            self.cond.notify_all()
+
+    def wait_qsize(
+        self,
+        size: int,
+        timeout: Optional[float] = None,
+        abort: Optional[Callable[[], bool]] = None,
+    ) -> bool:
+        """Block until the queue holds at least `size` frames.
+
+        The size is only re-checked when a frame is published, instead of
+        polling. Return False on timeout or once `abort()` is true.
+        """
+
+        def ready() -> bool:
+            return (abort is not None and abort()) or self.qsize() >= size
+
+        if self.producer:
+            with self.cond:
+                done = self.cond.wait_for(ready, timeout)
+        else:
+            done = self.wait_published(ready, timeout)
+        return done and not (abort is not None and abort())
+
+    def wait_space(
+        self,
+        timeout: Optional[float] = None,
+        abort: Optional[Callable[[], bool]] = None,
+    ) -> bool:
+        """Block until a reader has made room for another frame (`block` policy).
 
-    def get_Q(self, timeout: Optional[int] = None) -> bytes:
+        Frames held back for batching are published first, so that readers
+        waiting on a full queue can proceed. Reads through this object and
+        `notify` wake the wait; readers in other processes do not announce
+        their reads, so the queue length is also re-checked every `poll`
+        seconds. Return False on timeout or once `abort()` is true.
+        """
+        if self.qsize() + len(self.pending) + len(self.encoding) < self.q_size:
+            return True
+        self.flush()
+
+        def ready() -> bool:
+            return (abort is not None and abort()) or self.qsize() < self.q_size
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while not ready():
+                remaining = (
+                    self.poll if deadline is None else deadline - time.monotonic()
+                )
+                if remaining <= 0:
+                    return False
+                self.cond.wait(min(remaining, self.poll))
+        return not (abort is not None and abort())
+
+    def wait_published(
+        self, ready: Callable[[], bool], timeout: Optional[float] = None
+    ) -> bool:
+        """Wait on the notify channel of a producer in another process."""
+        if self.pubsub is None:
+            # subscribe before the first check so that no publish is missed
+            self.pubsub = self.__db.pubsub(ignore_subscribe_messages=True)
+            self.pubsub.subscribe(self.notify_channel)  # type: ignore
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not ready():
+            remaining = 1.0 if deadline is None else deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            # wake up at least every second to re-check the abort condition
+            self.pubsub.get_message(timeout=min(remaining, 1.0))  # type: ignore
+        return True
+
+    def stats(self) -> Dict[str, float]:
+        """Return the publish counters (round trips and bytes per frame)."""
+        frames = max(self.frames_published, 1)
+        return {
+            "round_trips": self.round_trips,
+            "frames_published": self.frames_published,
+            "bytes_per_frame": self.bytes_published / frames,
+            "round_trips_per_frame": self.round_trips / frames,
+            "compression_ratio": self.raw_bytes / max(self.bytes_published, 1),
+            "encode_ms_per_frame": 1000 * self.encode_time / frames,
+        }
+
+    def get_Q(self, timeout: Optional[int] = None) -> Optional[bytes]:
         """Get item from the queue."""
-        key, item_bytes = self.__db.blpop(self.key, timeout=timeout)
-        return item_bytes
+        if self.stream:
+            frame = self.read_stream(timeout)
+        elif self.read_policy != backpressure.BLOCK:
+            frame = self.read_list(timeout)
+        else:
+            item = self.__db.blpop(self.key, timeout=timeout)
+            frame = None if item is None else cast(bytes, item[1])
+        if frame is not None:
+            self.notify()  # a producer waiting for room in the queue
+        return frame
+
+    def read_list(self, timeout: Optional[int] = None) -> Optional[bytes]:
+        """Pop the next frame, skipping to the newest one if the reader lags.
+
+        Under `latest` every read skips to the newest frame, under
+        `drop-oldest` only once more than `max_lag` frames are waiting.
+        The skipped frames are removed from the queue and counted.
+        """
+        oldest = None
+        if self.read_policy == backpressure.DROP_OLDEST:
+            pipe = self.__db.pipeline(transaction=True)
+            pipe.lpop(self.key)
+            pipe.llen(self.key)
+            oldest, left = pipe.execute()
+            if oldest is None:
+                item = self.__db.blpop(self.key, timeout=timeout)
+                return None if item is None else cast(bytes, item[1])
+            if left <= self.max_lag:
+                return oldest
+        # take the newest frame and discard the rest in one atomic round trip
+        pipe = self.__db.pipeline(transaction=True)
+        pipe.rpop(self.key)
+        pipe.llen(self.key)
+        pipe.delete(self.key)
+        newest, left, _ = pipe.execute()
+        if newest is None:
+            if oldest is not None:
+                return oldest
+            item = self.__db.brpop(self.key, timeout=timeout)
+            return None if item is None else cast(bytes, item[1])
+        self.skip(left + (oldest is not None))
+        return newest
+
+    def skip(self, count: int) -> None:
+        """Count frames this reader skipped."""
+        self.dropped += count
+        self.metrics.counter("consumer_dropped").inc(count)
+
+    def read_stream(self, timeout: Optional[int] = None) -> Optional[bytes]:
+        """Read the next frame after this consumer's cursor.
+
+        The stream is left untouched, so other consumers still see the frame.
+        """
+        items = self.read_stream_batch(1, timeout)
+        return items[0] if items else None
+
+    def read_stream_batch(self, n: int, timeout: Optional[int] = None) -> List[bytes]:
+        """Read up to `n` frames after this consumer's cursor in one round trip."""
+        return redis_reads.run(self.__db, redis_reads.stream_batch(self, n, timeout))
+
+    def read_list_batch(self, n: int, timeout: Optional[int] = None) -> List[bytes]:
+        """Pop up to `n` frames in one atomic round trip.
+
+        An empty queue is waited on with `BLPOP`. Unless the read policy is
+        `block`, a reader lagging behind gets the newest `n` frames instead
+        and the others are skipped.
+        """
+        items = redis_reads.run(self.__db, redis_reads.list_batch(self, n, timeout))
+        if items:
+            self.notify()  # a producer waiting for room in the queue
+        return items
+
+    def read_batch(self, n: int, timeout: Optional[int] = None) -> Optional[FrameBatch]:
+        """Read up to `n` frames, stacked into one `(k, h, w, c)` array.
+
+        The frames are fetched in one round trip and decoded straight into a
+        preallocated batch array, which is reused two calls later. Return
+        None on timeout.
+        """
+        if self.stream:
+            encoded = self.read_stream_batch(n, timeout)
+        else:
+            encoded = self.read_list_batch(n, timeout)
+        items = []
+        for item in encoded:
+            meta, size = header.unpack(item)
+            items.append((meta, memoryview(item)[size:]))
+        batch, mismatched = frame_batch.decode(items, self.batches, n)
+        if batch is None:
+            return None
+        self.skip(mismatched)
+        self.metrics.rate("frames_consumed").mark(batch.size)
+        for meta in batch.metas:
+            self.tracer.read(meta)
+        return batch
+
+    def consumer_stats(self) -> Dict[str, Union[str, int]]:
+        """Return the read position, lag and drops of this consumer."""
+        return {"cursor": self.cursor, "lag": self.lag, "dropped": self.dropped}
 
     def resizeFrame(
-        self, frame: np.ndarray, resolution: Tuple[int, int] = (860, 480)
+        self,
+        frame: np.ndarray,
+        resolution: Tuple[int, int] = (860, 480),
+        dst: Optional[np.ndarray] = None,
     ) -> np.ndarray:
-        """Resize frame to resolution."""
-        return cv2.resize(frame, resolution)
+        """Resize frame to resolution, into `dst` if given."""
+        return hvio.resize(frame, resolution, dst)
 
     @staticmethod
-    def separate_image_timestamp(image_byte: bytes) -> Tuple[str, bytes, bool]:
-        """Separate image timestamp from image bytes."""
-        timestamp = ""
-        s = False if image_byte is None else True
-        if s:
-            timestamp = image_byte[:26].decode()
-            image_byte = image_byte[26:]
-        return timestamp, image_byte, s
+    def encodeFrame(
+        img: np.ndarray,
+        codec: int = codecs.RAW,
+        quality: int = 90,
+        meta: Optional[FrameMeta] = None,
+    ) -> bytes:
+        """Encode frame to bytes, prefixed with the binary frame header."""
+        if meta is None:
+            meta = header.frame_meta(img, 0, codec)
+        return header.pack(meta) + codecs.compress(img, codec, quality)
 
     @staticmethod
-    def encodeFrame(img: np.ndarray) -> bytes:
-        """Encode frame to bytes."""
-        h, w = img.shape[:2]
-        shape = struct.pack(">II", h, w)
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S,%f")
-        img_tobytes = img.tobytes()
-        encoded = str(timestamp).encode() + shape + img_tobytes
-        return encoded
+    def encodeFrameInto(
+        img: np.ndarray, meta: FrameMeta, pool: FramePool
+    ) -> memoryview:
+        """Encode a raw frame into the next pooled payload buffer, without allocating."""
+        payload = pool.next((header.HEADER.size + img.nbytes,))
+        header.pack_into(meta, payload, 0)  # type: ignore
+        np.ndarray(img.shape, img.dtype, buffer=payload, offset=header.HEADER.size)[
+            ...
+        ] = img
+        return payload.data
+
+    @staticmethod
+    def decodeFrameMeta(encoded: bytes) -> Tuple[np.ndarray, FrameMeta]:
+        """Decode frame and its metadata from bytes."""
+        meta, size = header.unpack(encoded)
+        frame = codecs.decompress(memoryview(encoded)[size:], meta)
+        return frame, meta
 
     @staticmethod
     def decodeFrame(encoded: bytes) -> np.ndarray:
         """Decode frame from bytes."""
-        h, w = struct.unpack(">II", encoded[:8])
-        decoded_image = np.frombuffer(encoded, dtype=np.uint8, offset=8).reshape(
-            h, w, 3
-        )
-        return decoded_image
+        return RedisShmem.decodeFrameMeta(encoded)[0]
 
-    def getFrame(self) -> Tuple[Optional[np.ndarray], bool, str]:
-        """Get frame from the queue."""
-        time_img_bytes = self.get_Q(1)
-        timestamp, img_bytes, grabbed = self.separate_image_timestamp(time_img_bytes)
+    def getFrame(self) -> Tuple[Optional[np.ndarray], bool, Optional[FrameMeta]]:
+        """Get frame and its metadata from the queue."""
+        encoded = self.get_Q(1)
+        if encoded is None:
+            return None, False, None
+        frame, meta = self.decodeFrameMeta(encoded)
+        self.metrics.rate("frames_consumed").mark()
+        self.tracer.read(meta)
+        return frame, True, meta
 
-        if grabbed:
-            frame = self.decodeFrame(img_bytes)
-        else:
-            frame = None
-        return frame, grabbed, timestamp
+    def close(self) -> None:
+        """Release the encoder threads and the Redis connection."""
+        if self.encoder is not None:
+            self.encoder.shutdown()
+        if self.pubsub is not None:
+            self.pubsub.close()
+        self.__db.close()
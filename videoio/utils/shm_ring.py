@@ -0,0 +1,406 @@
+"""Shared memory ring buffer frame storage (same host, no Redis)."""
+
+import struct
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+import utils.backpressure as backpressure
+import utils.frame_batch as frame_batch
+import utils.frame_codec as codecs
+import utils.frame_header as header
+import utils.helpers as hvio
+import utils.metrics as metrics
+import utils.pixel_format as pixel_format
+import utils.tracing as tracing
+from utils.frame_batch import FrameBatch
+from utils.frame_header import HEADER, FrameMeta
+from utils.frame_pool import FramePool
+from utils.tracing import FrameTrace
+
+# control block: head (next sequence to write; the producer's), tail (next
+# sequence to read; the readers'), floor (oldest sequence still readable, set
+# by a `latest` producer; the producer's)
+CTRL = struct.Struct("=QQQ")
+# slot stamp: sequence + 1 of the frame in the slot, 0 while it is written
+STAMP = struct.Struct("=Q")
+# serializes segment creation and attaching, which swaps a process-wide hook
+TRACKER_LOCK = threading.Lock()
+
+
+def attach_shm(name: str) -> shared_memory.SharedMemory:
+    """Attach to an existing segment without handing it to the resource tracker.
+
+    Otherwise the tracker of a reader process unlinks the writer's segment when
+    the reader exits. Before Python 3.13 the tracker hook is swapped, under
+    `TRACKER_LOCK` so that concurrent captures of one process do not lose it.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, track=False)
+    with TRACKER_LOCK:
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args: None  # type: ignore
+        try:
+            return shared_memory.SharedMemory(name)
+        finally:
+            resource_tracker.register = register
+
+
+class ShmRing(object):
+    """Fixed-slot frame ring over `multiprocessing.shared_memory`.
+
+    Exposes the same `qsize/empty/put_Q/getFrame` surface as `RedisShmem`.
+    There is one writer per camera. The writer overwrites the oldest slot when
+    the ring is full. Readers get `np.ndarray` views straight into the shared
+    segment. A view stays valid until the writer wraps around onto its slot,
+    i.e. for about `q_size` frames. Each slot is stamped with the sequence of
+    its frame, cleared while the writer rewrites it: a reader checks it before
+    and after copying a frame, and skips a frame overwritten meanwhile.
+    """
+
+    def __init__(
+        self,
+        cfg: Dict[str, Dict[str, str]],
+        producer: bool = False,
+        timeout: Optional[float] = None,
+    ) -> None:
+        """Create the camera's ring as its `producer`, or attach to it.
+
+        Only the producer creates the ring and removes it on `close`. A reader
+        waits up to `timeout` seconds (default: forever) for it to exist, then
+        raises `FileNotFoundError`. Waits on a `producer` context are woken by
+        `put_Q` in-process; readers in other processes poll the control block.
+        """
+        self.Q_name = cfg["APP"]["cam_name"]
+        # the resource tracker splits its messages on ":", as in output names
+        self.key = "%s_%s" % ("videoio", self.Q_name.replace(":", "."))
+        self.fps_van = (
+            int(cfg["Analysis"]["fps_van"])
+            if int(cfg["Analysis"]["fps_van"]) != 0
+            else 12
+        )
+        self.q_size = int(cfg["Analysis"]["buf_sec"]) * self.fps_van
+        width = int(cfg["defaultArgs"]["--width"])
+        height = int(cfg["defaultArgs"]["--height"])
+        # frames are stored in the pixel format the capture converts them to
+        self.pixfmt = pixel_format.pixel_format_tag(
+            cfg["Analysis"].get("pixel_format", "bgr")
+        )
+        self.frame_bytes = int(
+            np.prod(pixel_format.converted_shape(height, width, self.pixfmt))
+        )
+        self.slot_size = STAMP.size + HEADER.size + self.frame_bytes
+        size = CTRL.size + self.q_size * self.slot_size
+        self.poll = 1.0 / (self.fps_van * 4)
+        self.shm = self.create(size) if producer else self.attach(timeout)
+        if self.shm.size < size:
+            self.shm.close()
+            raise ValueError(
+                f"shared memory {self.key} is too small for {width}x{height} frames"
+            )
+        self.buf: memoryview = self.shm.buf  # type: ignore
+        self.owner = producer
+        self.producer = producer
+        self.cond = threading.Condition()
+        self.frames_published = 0
+        self.capture_policy = backpressure.capture_policy(cfg)
+        self.read_policy = backpressure.read_policy(cfg)
+        self.max_lag = int(cfg["redis"].get("max_lag", 0))
+        self.dropped = 0
+        self.batches = FramePool(2)
+        self.metrics = metrics.registry(self.Q_name)
+        self.tracer = tracing.tracer(cfg)
+
+    def create(self, size: int) -> shared_memory.SharedMemory:
+        """Create the segment, or reuse the one left by a previous producer.
+
+        A reused segment starts over empty, as its frames may have another
+        geometry; readers still attached to it keep reading from it. One too
+        small for the frames is replaced.
+        """
+        with TRACKER_LOCK:
+            try:
+                shm = shared_memory.SharedMemory(self.key, create=True, size=size)
+            except FileExistsError:
+                # tracked, like a created one: the producer removes it
+                shm = shared_memory.SharedMemory(self.key)
+                if shm.size < size:
+                    shm.close()
+                    shm.unlink()
+                    shm = shared_memory.SharedMemory(self.key, create=True, size=size)
+        buf: memoryview = shm.buf  # type: ignore
+        CTRL.pack_into(buf, 0, 0, 0, 0)
+        for seq in range(self.q_size):
+            STAMP.pack_into(buf, self._slot(seq), 0)
+        return shm
+
+    def attach(self, timeout: Optional[float]) -> shared_memory.SharedMemory:
+        """Attach to the segment, polling until the producer has created it."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                return attach_shm(self.key)
+            except FileNotFoundError:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+            time.sleep(self.poll)
+
+    def _ctrl(self) -> Tuple[int, int]:
+        """Return the head and the oldest unread sequence."""
+        head, tail, floor = CTRL.unpack_from(self.buf, 0)
+        return head, max(tail, floor)
+
+    def _slot(self, seq: int) -> int:
+        return CTRL.size + (seq % self.q_size) * self.slot_size
+
+    def qsize(self) -> int:
+        """Return the approximate size of the queue."""
+        head, tail = self._ctrl()
+        return min(head - tail, self.q_size)
+
+    def empty(self) -> bool:
+        """Return True if the queue is empty, False otherwise."""
+        return self.qsize() == 0
+
+    def put_Q(
+        self,
+        frame: np.ndarray,
+        pts_us: int = -1,
+        grab_ns: int = 0,
+        trace: Optional[FrameTrace] = None,
+        score: float = -1.0,
+        flags: int = 0,
+    ) -> None:
+        """Copy the frame into the next slot, overwriting the oldest one.
+
+        Its change score and header flags are stored with it.
+
+        Any frame up to the bytes of a `width x height` frame in the pixel
+        format fits, whatever its dtype and number of channels.
+        """
+        if frame.nbytes > self.frame_bytes:
+            raise ValueError(f"frame {frame.shape} does not fit the ring slots")
+        tic = time.perf_counter()
+        head, tail = self._ctrl()
+        if head - tail >= self.q_size:
+            self.metrics.counter("frames_dropped").inc()
+            if self.capture_policy == backpressure.DROP_NEWEST:
+                return
+            # otherwise the oldest unread frame is overwritten
+        offset = self._slot(head)
+        if trace is not None:
+            flags |= header.TRACED
+        meta = header.frame_meta(
+            frame, head, codecs.RAW, pts_us, grab_ns, flags, self.pixfmt, score
+        )
+        # readers of the frame being overwritten see the cleared stamp
+        STAMP.pack_into(self.buf, offset, 0)
+        offset += STAMP.size
+        view = np.ndarray(
+            frame.shape, dtype=frame.dtype, buffer=self.buf, offset=offset + HEADER.size
+        )
+        view[...] = frame
+        header.pack_into(meta, self.buf, offset)
+        STAMP.pack_into(self.buf, offset - STAMP.size, head + 1)
+        if trace is not None:
+            # the copy into the slot is this backend's encode stage
+            trace.seq = head
+            trace.stamp("encode")
+            trace.stamp("publish")
+            self.tracer.finish(trace)
+        # publish the slot only once it is fully written
+        struct.pack_into("=Q", self.buf, 0, head + 1)
+        if self.capture_policy == backpressure.LATEST and head > tail:
+            # only the new frame stays readable; readers own the tail
+            self.metrics.counter("frames_dropped").inc(min(head - tail, self.q_size))
+            struct.pack_into("=Q", self.buf, 16, head)
+            tail = head
+        self.frames_published += 1
+        self.metrics.histogram("publish_ms").observe(1000 * (time.perf_counter() - tic))
+        self.metrics.rate("frames_published").mark()
+        self.metrics.gauge("queue_depth").set(min(head + 1 - tail, self.q_size))
+        self.notify()
+
+    def notify(self) -> None:
+        """Wake up in-process waiters, e.g. to re-check an abort condition."""
+        with self.cond:
+            self.cond.notify_all()
+
+    def wait_for(self, ready: Callable[[], bool], timeout: Optional[float]) -> bool:
+        """Wait until `ready()` is true; return False on timeout."""
+        if self.producer:
+            with self.cond:
+                return self.cond.wait_for(ready, timeout)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not ready():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self.poll)
+        return True
+
+    def wait_qsize(
+        self,
+        size: int,
+        timeout: Optional[float] = None,
+        abort: Optional[Callable[[], bool]] = None,
+    ) -> bool:
+        """Block until the ring holds at least `size` frames.
+
+        Return False on timeout or once `abort()` is true.
+        """
+        done = self.wait_for(
+            lambda: (abort is not None and abort()) or self.qsize() >= size, timeout
+        )
+        return done and not (abort is not None and abort())
+
+    def wait_space(
+        self,
+        timeout: Optional[float] = None,
+        abort: Optional[Callable[[], bool]] = None,
+    ) -> bool:
+        """Block until a reader has made room for another frame (`block` policy).
+
+        Return False on timeout or once `abort()` is true.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.qsize() >= self.q_size:
+            if abort is not None and abort():
+                return False
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self.poll)
+        return True
+
+    def flush(self) -> None:
+        """Frames are visible as soon as `put_Q` returns; nothing to flush."""
+
+    def stats(self) -> Dict[str, float]:
+        """Return the publish counters."""
+        return {
+            "round_trips": 0,
+            "frames_published": self.frames_published,
+            "bytes_per_frame": self.frame_bytes,
+            "round_trips_per_frame": 0,
+        }
+
+    def resizeFrame(
+        self,
+        frame: np.ndarray,
+        resolution: Tuple[int, int] = (860, 480),
+        dst: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """Resize frame to resolution, into `dst` if given."""
+        return hvio.resize(frame, resolution, dst)
+
+    def getFrame(
+        self, timeout: float = 1, copy: bool = False
+    ) -> Tuple[Optional[np.ndarray], bool, Optional[FrameMeta]]:
+        """Get the next unread frame, waiting up to `timeout` seconds.
+
+        That is the oldest one, or the newest one if the read policy skips
+        stale frames. Unless `copy` is set the frame is a zero-copy view into
+        the ring.
+        """
+        deadline = time.monotonic() + timeout
+        while self.wait_for(
+            lambda: self.qsize() > 0, max(deadline - time.monotonic(), 0)
+        ):
+            seq, _ = self._next_unread(1)
+            item = self._read_slot(seq)
+            frame = None
+            if item is not None:
+                meta, payload = item
+                frame = codecs.decompress(payload, meta)
+                if copy:
+                    frame = frame.copy()
+            struct.pack_into("=Q", self.buf, 8, seq + 1)
+            if frame is None or not self._intact(seq):
+                self.skip(1)  # overwritten while it was read
+                continue
+            self.metrics.rate("frames_consumed").mark()
+            self.tracer.read(meta)
+            return frame, True, meta
+        return None, False, None
+
+    def read_batch(self, n: int, timeout: float = 1) -> Optional[FrameBatch]:
+        """Read up to `n` unread frames, stacked into one `(k, h, w, c)` array.
+
+        The frames are copied from the ring straight into a preallocated batch
+        array, which is reused two calls later. Return None on timeout.
+        """
+        if not self.wait_for(lambda: self.qsize() > 0, timeout):
+            return None
+        first, end = self._next_unread(n)
+        items = [self._read_slot(seq) for seq in range(first, end)]
+        found = [item for item in items if item is not None]
+        batch, mismatched = frame_batch.decode(found, self.batches, n)
+        struct.pack_into("=Q", self.buf, 8, end)
+        overwritten = len(items) - len(found)
+        if batch is not None:
+            # the writer overwrites the oldest frames first
+            torn = next(
+                (i for i, meta in enumerate(batch.metas) if self._intact(meta.seq)),
+                batch.size,
+            )
+            batch = FrameBatch._make(field[torn:] for field in batch)
+            overwritten += torn
+        self.skip(overwritten + mismatched)
+        if batch is None or batch.size == 0:
+            return None
+        self.metrics.rate("frames_consumed").mark(batch.size)
+        for meta in batch.metas:
+            self.tracer.read(meta)
+        return batch
+
+    def _next_unread(self, n: int) -> Tuple[int, int]:
+        """Return the range of up to `n` frames to read next, counting skips.
+
+        That is the oldest unread ones, or the newest ones if the read policy
+        skips stale frames.
+        """
+        head, tail = self._ctrl()
+        max_lag = 0 if self.read_policy == backpressure.LATEST else self.max_lag
+        if self.read_policy != backpressure.BLOCK and head - tail > max_lag + n:
+            first = head - n
+        else:
+            # skip frames the writer has already overwritten
+            first = max(tail, head - self.q_size)
+        if first > tail:
+            self.skip(first - tail)
+        return first, min(first + n, head)
+
+    def _read_slot(self, seq: int) -> Optional[Tuple[FrameMeta, memoryview]]:
+        """Return the header and payload of frame `seq`, or None if overwritten."""
+        offset = self._slot(seq)
+        end = offset + STAMP.size + HEADER.size
+        # a copy of the header, consistent if the stamp is still the frame's
+        fields = bytes(self.buf[offset:end])
+        if STAMP.unpack_from(fields)[0] != seq + 1 or not self._intact(seq):
+            return None
+        meta, size = header.unpack(fields, STAMP.size)
+        start = offset + STAMP.size + size
+        end = start + int(np.prod(codecs.frame_shape(meta))) * meta.dtype.itemsize
+        return meta, self.buf[start:end]
+
+    def _intact(self, seq: int) -> bool:
+        """Return True while the slot of frame `seq` holds it, fully written."""
+        return STAMP.unpack_from(self.buf, self._slot(seq))[0] == seq + 1
+
+    def skip(self, count: int) -> None:
+        """Count frames this reader skipped."""
+        self.dropped += count
+        self.metrics.counter("consumer_dropped").inc(count)
+
+    def close(self) -> None:
+        """Detach from the ring, and remove it if this is its producer."""
+        del self.buf
+        try:
+            self.shm.close()
+        except BufferError:
+            # frame views are still alive; the mapping goes away with them
+            pass
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,136 @@
+"""Sampled per-frame latency tracing from grab to consumer read."""
+
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Optional
+
+import utils.metrics as metrics
+from utils.frame_header import TRACED, FrameMeta
+
+# producer stages, in pipeline order; each is timed from the previous stamp
+STAGES = ("retrieve", "resize", "encode", "publish")
+
+
+class FrameTrace:
+    """Monotonic stamps of one sampled frame."""
+
+    __slots__ = ("grab_ns", "seq", "stamps")
+
+    def __init__(self, grab_ns: int) -> None:
+        """Start a trace at grab time."""
+        self.grab_ns = grab_ns
+        self.seq = -1
+        self.stamps: Dict[str, int] = {}
+
+    def stamp(self, stage: str) -> None:
+        """Record that `stage` finished now."""
+        self.stamps[stage] = time.monotonic_ns()
+
+
+class Tracer:
+    """Trace one frame out of `sample` and aggregate the latencies per camera.
+
+    Stage latencies go to the `trace_<stage>_ms` histograms of the camera's
+    metrics registry. The `read` stage (queue wait, transfer and decode) is
+    only known when producer and consumer share the process. The `total`,
+    from grab to read, only needs a shared host, since it is computed from the
+    monotonic grab time in the frame header. Frames slower than `slow_ms` in
+    total are kept in `slow_frames` and appended to `slow_log`.
+    """
+
+    def __init__(
+        self, camera: str, sample: int = 0, slow_ms: float = 0, slow_log: str = ""
+    ) -> None:
+        """Initialize the tracer; a `sample` of 0 disables tracing."""
+        self.camera = camera
+        self.sample = sample
+        self.slow_ms = slow_ms
+        self.slow_log = slow_log
+        self.metrics = metrics.registry(camera)
+        self.count = 0
+        self.lock = threading.Lock()
+        self.published: "OrderedDict[int, FrameTrace]" = OrderedDict()
+        self.slow_frames: Deque[Dict[str, float]] = deque(maxlen=100)
+
+    def begin(self, grab_ns: int) -> Optional[FrameTrace]:
+        """Return a trace for the frame grabbed at `grab_ns` if it is sampled."""
+        if not self.sample:
+            return None
+        self.count += 1
+        if self.count % self.sample:
+            return None
+        return FrameTrace(grab_ns)
+
+    def finish(self, trace: FrameTrace) -> None:
+        """Record the producer stages of a published frame."""
+        previous = trace.grab_ns
+        for stage in STAGES:
+            stamp = trace.stamps.get(stage)
+            if stamp is not None:
+                ms = (stamp - previous) / 1e6
+                self.metrics.histogram(f"trace_{stage}_ms").observe(ms)
+                previous = stamp
+        with self.lock:
+            self.published[trace.seq] = trace
+            if len(self.published) > 64:
+                self.published.popitem(last=False)
+
+    def read(self, meta: FrameMeta) -> None:
+        """Record the read and total latency of a traced frame."""
+        if not meta.flags & TRACED:
+            return
+        now = time.monotonic_ns()
+        total = (now - meta.mono_ns) / 1e6
+        self.metrics.histogram("trace_total_ms").observe(total)
+        with self.lock:
+            trace = self.published.pop(meta.seq, None)
+        stages: Dict[str, float] = {}
+        if trace is not None:
+            previous = trace.grab_ns
+            for stage in STAGES:
+                stamp = trace.stamps.get(stage)
+                if stamp is not None:
+                    stages[stage] = (stamp - previous) / 1e6
+                    previous = stamp
+            stages["read"] = (now - previous) / 1e6
+            self.metrics.histogram("trace_read_ms").observe(stages["read"])
+        if self.slow_ms and total > self.slow_ms:
+            self.slow_frame(meta.seq, total, stages)
+
+    def slow_frame(self, seq: int, total: float, stages: Dict[str, float]) -> None:
+        """Keep and log a frame whose total latency is above `slow_ms`."""
+        record = {"seq": seq, "total_ms": total, **stages}
+        self.slow_frames.append(record)
+        if self.slow_log:
+            line = " ".join(f"{key}={value:.1f}" for key, value in record.items())
+            with open(self.slow_log, "a") as f:
+                f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {self.camera} {line}\n")
+
+    def percentiles(self) -> Dict[str, Dict[str, float]]:
+        """Return the p50/p90/p99 of every traced stage in milliseconds."""
+        result = {}
+        for stage in STAGES + ("read", "total"):
+            hist = self.metrics.metrics.get(f"trace_{stage}_ms")
+            if isinstance(hist, metrics.Histogram) and hist.count:
+                result[stage] = {
+                    f"p{int(q * 100)}": hist.percentile(q) for q in (0.5, 0.9, 0.99)
+                }
+        return result
+
+
+_tracers: Dict[str, Tracer] = {}
+
+
+def tracer(cfg: Dict[str, Dict[str, str]]) -> Tracer:
+    """Return the tracer of the configured camera, set up from `[trace]`."""
+    camera = cfg["APP"]["cam_name"]
+    if camera not in _tracers:
+        section = cfg.get("trace", {})
+        _tracers[camera] = Tracer(
+            camera,
+            sample=int(section.get("sample", 0)),
+            slow_ms=float(section.get("slow_ms", 0)),
+            slow_log=section.get("slow_log", ""),
+        )
+    return _tracers[camera]
@@ -1,30 +1,50 @@
 """Video writer class."""
 
 import os
+import re
 import threading
 import time
+import uuid
+from abc import ABC, abstractmethod
 from collections import deque  # efficient queue data structure
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from queue import Queue  # thread safe queue
-from typing import Deque, Dict
+from queue import Full, Queue  # thread safe queue
+from typing import Any, Callable, Deque, Dict, List, Optional, Union
 
 import ffmpeg
 import numpy as np
+import utils.frame_codec as codecs
+import utils.frame_header as header
+import utils.metrics as metrics
+import utils.pixel_format as pixel_format
+
+# frames a recording worker writes to one clip before serving the next clip
+DRAIN_FRAMES = 16
+# hidden temporary file of a pooled writer, renamed when its recording stops
+TEMP_FILE = re.compile(r"^\.[0-9a-f]{32}\.\w+$")
 
 
 class ffmpegwriter:
     """Video writer based on ffmpeg-python."""
 
     def __init__(
-        self, fileName: str, vcodec: str, fps: int, frameWidth: int, frameHeight: int
+        self,
+        fileName: str,
+        vcodec: str,
+        fps: int,
+        frameWidth: int,
+        frameHeight: int,
+        pix_fmt: str = "bgr24",
     ) -> None:
-        """Initialize the ffmpeg writer."""
+        """Initialize the ffmpeg writer, fed with `pix_fmt` raw frames."""
+        self.fileName = fileName
         self.process = (
             ffmpeg.input(
                 "pipe:",
                 framerate=f"{fps}",
                 format="rawvideo",
-                pix_fmt="bgr24",
+                pix_fmt=pix_fmt,
                 s=f"{frameWidth}x{frameHeight}",
             )
             .output(
@@ -37,40 +57,153 @@ class ffmpegwriter:
 
     def write(self, image: np.ndarray) -> None:
         """Convert raw image format to something ffmpeg understands."""
-        self.process.stdin.write(image.astype(np.uint8).tobytes())
+        self.process.stdin.write(np.ascontiguousarray(image, dtype=np.uint8).data)
 
     def close(self) -> None:
         """Clean up resources."""
         self.process.stdin.close()
         self.process.wait()
 
+    def discard(self) -> None:
+        """Stop an unused writer and remove its file."""
+        self.close()
+        if os.path.exists(self.fileName):
+            os.remove(self.fileName)
+
+
+class WriterPool:
+    """Idle ffmpeg writers, spawned ahead of the recordings that use them.
+
+    An idle writer waits on its stdin, which costs no CPU, so `recStart` only
+    hands one out, and a replacement is spawned in the background. Writers
+    write to a hidden temporary file, renamed when the recording stops.
+    Nothing is spawned until `start`.
+    """
+
+    def __init__(self, size: int, spawn: Callable[[], ffmpegwriter]) -> None:
+        """Initialize a pool of `size` writers made by `spawn`; 0 disables it."""
+        self.size = size
+        self.spawn = spawn
+        self.idle: Deque[ffmpegwriter] = deque()
+        self.spawning = 0
+        self.started = False
+        self.closed = False
+        self.lock = threading.Lock()
+        self.fillers: List[threading.Thread] = []
+
+    def start(self) -> None:
+        """Spawn the idle writers, the first time only."""
+        if self.started:
+            return
+        self.started = True
+        if self.size:
+            self.fill()
+
+    def fill(self) -> None:
+        """Spawn the missing idle writers in the background."""
+        filler = threading.Thread(target=self.fill_idle, daemon=True)
+        filler.start()
+        self.fillers = [t for t in self.fillers if t.is_alive()] + [filler]
+
+    def fill_idle(self) -> None:
+        """Spawn writers until `size` of them are idle."""
+        while True:
+            with self.lock:
+                if self.closed or len(self.idle) + self.spawning >= self.size:
+                    return
+                self.spawning += 1
+            writer = self.spawn()
+            with self.lock:
+                self.spawning -= 1
+                if not self.closed:
+                    self.idle.append(writer)
+                    continue
+            writer.discard()
+            return
+
+    def acquire(self) -> ffmpegwriter:
+        """Return an idle writer, or a new one if none is ready."""
+        writer = None
+        dead = []
+        with self.lock:
+            while self.idle and writer is None:
+                writer = self.idle.popleft()
+                if writer.process.poll() is not None:
+                    dead.append(writer)  # died while idle
+                    writer = None
+        for idle in dead:
+            idle.discard()  # remove its temporary file
+        if self.size and self.started:
+            self.fill()
+        return writer if writer is not None else self.spawn()
+
+    def close(self) -> None:
+        """Stop the idle writers."""
+        with self.lock:
+            self.closed = True
+        for filler in self.fillers:
+            filler.join()
+        with self.lock:
+            idle = list(self.idle)
+            self.idle.clear()
+        for writer in idle:
+            writer.discard()
 
-class video_writer:
-    """Video writer class."""
+
+class Recording:
+    """A clip being recorded, and the compressed frames waiting for it."""
+
+    def __init__(self, name: str, fileName: str, writer: ffmpegwriter) -> None:
+        """Initialize a clip written by `writer`, renamed `fileName` when done."""
+        self.name = name
+        self.fileName = fileName
+        self.writer = writer
+        self.start_ns = time.monotonic_ns()
+        self.stop_ns = 0
+        # pre-event frames, oldest first, then the live frames and None at the end
+        self.backlog: Deque[bytes] = deque()
+        self.live: Deque[Optional[bytes]] = deque()
+        self.queued_bytes = 0
+        # the oldest backlog frames, already evicted from the pre-event buffer,
+        # are held by this clip alone
+        self.orphans = 0
+        self.orphan_bytes = 0
+        self.scheduled = False
+        self.failed = False
+        self.frames_written = 0
+        self.dropped = 0
+        self.done = threading.Event()
+
+    def backlog_size(self) -> int:
+        """Return the number of frames not written yet."""
+        return len(self.backlog) + len(self.live)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait until the clip is written and renamed."""
+        return self.done.wait(timeout)
+
+
+class BaseWriter(ABC):
+    """Recording settings, file names and metrics shared by the writers.
+
+    Subclasses are given the decoded frames by `update`, and record the
+    events started by `recStart` until `recStop`.
+    """
 
     def __init__(self, cfg: Dict[str, Dict[str, str]]) -> None:
-        """Initialize video writer."""
+        """Read the recording settings."""
         self.cfg = cfg
-        self.fps = int(self.cfg["record"]["fps_rec"])
-        self.frameWidth = int(cfg["defaultArgs"]["--width"])
-        self.frameHeight = int(cfg["defaultArgs"]["--height"])
         self.recDir = cfg["record"]["rec_dir"]
         self.cam_name = cfg["APP"]["cam_name"]
         self.file_ext = cfg["record"]["rec_file_ext"]
-        self.vcodec = cfg["record"]["vcodec"]
-        self.bufSize = int(cfg["record"]["rec_buf_sec"]) * self.fps
         self.verbose = int(cfg["defaultArgs"]["--verbose"])
-        self.timeout = 0.01
-        self.frame_Q: Deque[np.ndarray] = deque(maxlen=self.bufSize)
-        self.Q: Queue[np.ndarray] = Queue()
         self.videoFileName = ""
-        self.writer = None
-        self.thread = None
         self.recStarted = False
+        self.metrics = metrics.registry(self.cam_name)
 
+    @abstractmethod
     def qsize(self) -> int:
-        """Return the approximate size of the queue."""
-        return len(self.frame_Q)
+        """Return the size of the pre-event buffer."""
 
     def makeFileName(self, timestamp: datetime, name: str) -> str:
         """Create file name based on image timestamp."""
@@ -89,82 +222,380 @@ class video_writer:
         fileName = "%s-%s.%s" % (name, timestamp.strftime("%H-%M-%S"), self.file_ext)
         return "%s/%s" % (fileDir, fileName)
 
+    @abstractmethod
     def update(self, frame: np.ndarray) -> None:
-        """Write frames to video file."""
-        self.frame_Q.appendleft(frame)
+        """Buffer a decoded frame, and record it if recording."""
 
-        # if we are recording, update the queue as well
+    @abstractmethod
+    def recStart(self, timestamp: datetime, name: str) -> Any:
+        """Start recording the event `name`."""
+
+    @abstractmethod
+    def recStop(self, name: Optional[str] = None) -> None:
+        """Stop recording the event `name` (default: all)."""
+
+    def close(self) -> None:
+        """Stop the recordings in progress."""
         if self.recStarted:
-            self.Q.put(frame)
+            self.recStop()
+
+
+class NullWriter(BaseWriter):
+    """Writer of a camera not permitted to record; it records nothing.
+
+    The real writers are not built, so no source is opened, no thread runs
+    and nothing is written to disk.
+    """
+
+    def qsize(self) -> int:
+        """Return 0; nothing is buffered."""
+        return 0
+
+    def update(self, frame: np.ndarray) -> None:
+        """Ignore the frame."""
 
     def recStart(self, timestamp: datetime, name: str) -> None:
-        """Start recording video."""
-        if self.verbose == 2:
-            print("[INFO] Starting recording")
+        """Ignore the event."""
+
+    def recStop(self, name: Optional[str] = None) -> None:
+        """Ignore the event."""
+
+
+class video_writer(BaseWriter):
+    """Video writer class.
+
+    The pre-event buffer and the frames queued for the encoder are kept
+    compressed with `Buf_Codec`, by a thread off the capture loop, and are
+    decoded when written. `Buf_Max_MB` caps both, along with the pre-event
+    frames the recordings still have to write: the oldest buffered frames
+    make room for new ones, and live frames are dropped while the frames
+    held by a recording alone fill the cap.
 
-        # Start recording
-        self.recStarted = True
-        self.Q = Queue()
+    Events with different names are recorded as separate, possibly
+    overlapping clips. They share the compressed frames, and `Rec_Workers`
+    threads write them a slice at a time, so a burst of events waits in the
+    queues instead of blocking `update`.
+    """
 
-        # Create file name
-        self.videoFileName = self.makeFileName(timestamp, name)
+    def __init__(self, cfg: Dict[str, Dict[str, str]]) -> None:
+        """Initialize video writer."""
+        super().__init__(cfg)
+        self.fps = int(self.cfg["record"]["fps_rec"])
+        self.frameWidth = int(cfg["defaultArgs"]["--width"])
+        self.frameHeight = int(cfg["defaultArgs"]["--height"])
+        self.vcodec = cfg["record"]["vcodec"]
+        self.bufSize = int(cfg["record"]["rec_buf_sec"]) * self.fps
+        # frames are given in the pixel format of the frame buffer
+        self.pixfmt = pixel_format.pixel_format_tag(
+            cfg["Analysis"].get("pixel_format", "bgr")
+        )
+        self.codec = codecs.codec_tag(cfg["record"].get("buf_codec", "raw"))
+        self.quality = int(cfg["record"].get("buf_jpeg_quality", 90))
+        self.buf_max_bytes = int(float(cfg["record"].get("buf_max_mb", 0)) * 2**20)
+        # compressed frames, newest first, and their size
+        self.frame_Q: Deque[bytes] = deque()
+        self.buffered_bytes = 0
+        # live frames waiting for the encoder; more are dropped, not waited for
+        self.queue_size = int(cfg["record"].get("writer_queue", 0)) or self.bufSize
+        self.buf_lock = threading.Lock()
+        # recordings in progress by event name
+        self.clips: Dict[str, Recording] = {}
+        self.stopping: List[Recording] = []
+        self.workers = ThreadPoolExecutor(
+            max(1, int(cfg["record"].get("rec_workers", 2))),
+            thread_name_prefix=f"rec-{self.cam_name}",
+        )
+        # writers are spawned with the first frame, i.e. if recording is
+        # permitted; temporary files of a previous run are removed
+        self.pool = WriterPool(
+            int(cfg["record"].get("writer_pool", 1)), self.spawnWriter
+        )
+        self.removeTempFiles()
+        # at most a second of raw frames waits to be compressed; recStop queues
+        # an event, set once the frames before it are buffered
+        self.raw_Q: Queue[Union[np.ndarray, threading.Event, None]] = Queue(
+            maxsize=max(1, self.fps)
+        )
+        self.compressor: Optional[threading.Thread] = threading.Thread(
+            target=self.compressFrames, daemon=True
+        )
+        self.compressor.start()
+
+    def qsize(self) -> int:
+        """Return the approximate size of the queue."""
+        return len(self.frame_Q)
 
-        # Create video writer
-        self.writer = ffmpegwriter(
-            fileName=self.videoFileName,
+    def removeTempFiles(self) -> None:
+        """Remove the temporary files left in the camera directory.
+
+        A process that died, or a writer that was not closed, leaves the
+        files of its idle writers behind. One writer records each camera.
+        """
+        fileDir = "%s/%s" % (os.path.expanduser(self.recDir), self.cam_name)
+        if not os.path.isdir(fileDir):
+            return
+        for name in os.listdir(fileDir):
+            if TEMP_FILE.match(name):
+                try:
+                    os.remove(os.path.join(fileDir, name))
+                except OSError:
+                    pass  # removed meanwhile
+
+    def spawnWriter(self) -> ffmpegwriter:
+        """Start an ffmpeg writer on a hidden temporary file."""
+        tic = time.perf_counter()
+        fileDir = "%s/%s" % (os.path.expanduser(self.recDir), self.cam_name)
+        os.makedirs(fileDir, exist_ok=True)
+        writer = ffmpegwriter(
+            fileName="%s/.%s.%s" % (fileDir, uuid.uuid4().hex, self.file_ext),
             vcodec=self.vcodec,
             fps=self.fps,
             frameWidth=self.frameWidth,
             frameHeight=self.frameHeight,
-        )  # type: ignore
+            pix_fmt=pixel_format.FFMPEG_PIX_FMTS[self.pixfmt],
+        )
+        self.metrics.histogram("writer_spawn_ms").observe(
+            1000 * (time.perf_counter() - tic)
+        )
+        return writer
 
-        # loop over the frames in the deque structure and add them
-        # to the queue
-        for i in range(len(self.frame_Q), 0, -1):
-            self.Q.put(self.frame_Q[i - 1])
+    @staticmethod
+    def encodeFrame(
+        img: np.ndarray,
+        codec: int = codecs.RAW,
+        quality: int = 90,
+        pixfmt: int = pixel_format.BGR,
+    ) -> bytes:
+        """Encode frame to bytes, prefixed with the binary frame header."""
+        meta = header.frame_meta(img, 0, codec, pixfmt=pixfmt)
+        return header.pack(meta) + codecs.compress(img, codec, quality)
 
-        # Start thread to write frames
-        self.thread = threading.Thread(target=self.writeFrames)  # type: ignore
-        # like the garbage collection task
-        self.thread.daemon = True  # type: ignore
-        self.thread.start()  # type: ignore
+    @staticmethod
+    def decodeFrame(encoded: Union[bytes, memoryview]) -> np.ndarray:
+        """Decode frame from bytes."""
+        meta, size = header.unpack(encoded)
+        return codecs.decompress(memoryview(encoded)[size:], meta)
 
-    def writeFrames(self) -> None:
-        """Write frames to video file."""
+    def update(self, frame: np.ndarray) -> None:
+        """Hand a copy of the frame to the compressing thread.
+
+        The frame may be a view of a buffer slot, e.g. of the shm ring, which
+        the capture overwrites before the frame is compressed.
+        """
+        self.pool.start()
+        try:
+            self.raw_Q.put_nowait(frame.copy())
+        except Full:
+            self.metrics.counter("writer_dropped").inc()
+
+    def compressFrames(self) -> None:
+        """Compress frames into the buffers, until close queues None."""
+        while True:
+            frame = self.raw_Q.get()
+            try:
+                if frame is None:
+                    break
+                if isinstance(frame, threading.Event):
+                    frame.set()
+                    continue
+                tic = time.perf_counter()
+                encoded = self.encodeFrame(frame, self.codec, self.quality, self.pixfmt)
+                self.metrics.histogram("buffer_encode_ms").observe(
+                    1000 * (time.perf_counter() - tic)
+                )
+                self.buffer(encoded)
+            except Exception:  # keep buffering the next frames
+                self.metrics.counter("writer_errors").inc()
+            finally:
+                self.raw_Q.task_done()
+
+    def buffer(self, encoded: bytes) -> None:
+        """Add a compressed frame to the pre-event buffer and the recordings."""
+        size = len(encoded)
+        with self.buf_lock:
+            # if we are recording, queue the same frame to every clip
+            for clip in self.clips.values():
+                if len(clip.live) >= self.queue_size or (
+                    self.buf_max_bytes
+                    and clip.queued_bytes + clip.orphan_bytes + size
+                    > self.buf_max_bytes
+                ):
+                    clip.dropped += 1
+                    self.metrics.counter("writer_dropped").inc()
+                    continue
+                clip.live.append(encoded)
+                clip.queued_bytes += size
+                self.schedule(clip)
+            if self.clips:
+                self.metrics.gauge("writer_backlog").set(
+                    max(clip.backlog_size() for clip in self.clips.values())
+                )
+
+            self.frame_Q.appendleft(encoded)
+            self.buffered_bytes += size
+            while len(self.frame_Q) > self.bufSize:
+                self.evict()
+            # the clips queue the same frames, so the longest queue is what they use
+            queued_bytes = max(
+                [clip.queued_bytes for clip in self.clips.values()], default=0
+            )
+            while (
+                self.buf_max_bytes
+                and self.frame_Q
+                and self.buffered_bytes + queued_bytes + self.orphanBytes()
+                > self.buf_max_bytes
+            ):
+                self.evict()
+                self.metrics.counter("writer_buffer_evicted").inc()
+            self.metrics.gauge("writer_buffer_bytes").set(
+                self.buffered_bytes + queued_bytes + self.orphanBytes()
+            )
+
+    def evict(self) -> None:
+        """Drop the oldest buffered frame; hold `buf_lock`.
+
+        A clip whose backlog has yet to write it now holds it alone.
+        """
+        encoded = self.frame_Q.pop()
+        self.buffered_bytes -= len(encoded)
+        for clip in list(self.clips.values()) + self.stopping:
+            # backlogs and the buffer both drop frames oldest first
+            if clip.orphans < len(clip.backlog) and (
+                clip.backlog[clip.orphans] is encoded
+            ):
+                clip.orphans += 1
+                clip.orphan_bytes += len(encoded)
+
+    def orphanBytes(self) -> int:
+        """Return the bytes of backlog frames held by the clips alone."""
+        return sum(
+            clip.orphan_bytes for clip in list(self.clips.values()) + self.stopping
+        )
+
+    def schedule(self, clip: Recording) -> None:
+        """Have a worker write the pending frames of a clip; hold `buf_lock`."""
+        if not clip.scheduled:
+            clip.scheduled = True
+            self.workers.submit(self.writeFrames, clip)
+
+    def recStart(self, timestamp: datetime, name: str) -> Recording:
+        """Start recording the event `name`, unless it is being recorded."""
+        if name in self.clips:
+            return self.clips[name]
         if self.verbose == 2:
-            print("[INFO] Writing frames")
-
-        while self.recStarted:
-            # check to see if there are entries in the queue
-            if self.Q.qsize() >= self.bufSize:
-                # grab the next frame
-                frame = self.Q.get()
-                self.writer.write(frame)  # type: ignore
-            # otherwise, wait for a bit (not wasting CPU cycles)
-            else:
-                time.sleep(self.timeout)
-
-    def flush(self) -> None:
-        """Flush frames in queue."""
+            print(f"[INFO] Starting recording {name}")
+
+        # Start recording, with a writer spawned ahead of time
+        clip = Recording(name, self.makeFileName(timestamp, name), self.pool.acquire())
+        self.videoFileName = clip.fileName
+        with self.buf_lock:
+            # the buffered frames, oldest first, are written before the live ones
+            clip.backlog.extend(reversed(self.frame_Q))
+            self.clips[name] = clip
+            self.recStarted = True
+            if clip.backlog:
+                self.schedule(clip)
+        self.metrics.gauge("recordings").set(len(self.clips))
+        return clip
+
+    def writeFrames(self, clip: Recording) -> None:
+        """Write a slice of the pending frames of a clip to its video file."""
         if self.verbose == 2:
-            print(f"[INFO] Flushing {self.Q.qsize()} frames")
+            print(f"[INFO] Writing frames of {clip.name}")
+
+        frames_written = self.metrics.rate("frames_written")
+        encoded: Optional[bytes]
+        for _ in range(DRAIN_FRAMES):
+            with self.buf_lock:
+                if clip.backlog:
+                    encoded = clip.backlog.popleft()
+                    if clip.orphans:
+                        clip.orphans -= 1
+                        clip.orphan_bytes -= len(encoded)
+                elif clip.live:
+                    encoded = clip.live.popleft()
+                    if encoded is None:
+                        break
+                    clip.queued_bytes -= len(encoded)
+                else:
+                    clip.scheduled = False
+                    return
+            if clip.failed:
+                continue
+            try:
+                clip.writer.write(self.decodeFrame(encoded))
+            except OSError:
+                # ffmpeg died (e.g. disk full); later frames are dropped
+                self.metrics.counter("writer_errors").inc()
+                clip.failed = True
+                continue
+            frames_written.mark()
+            clip.frames_written += 1
+            if clip.frames_written == 1:
+                # recStart to the first frame taken by the ffmpeg pipe; the
+                # file gets its first bytes later, once ffmpeg has encoded
+                self.metrics.histogram("rec_first_write_ms").observe(
+                    (time.monotonic_ns() - clip.start_ns) / 1e6
+                )
+        else:
+            # more frames are pending; let the other clips have a turn
+            self.workers.submit(self.writeFrames, clip)
+            return
+        self.finish(clip)
 
-        # empty the queue by flushing all remaining frames to file
-        while not self.Q.empty():
-            frame = self.Q.get()
-            self.writer.write(frame)  # type: ignore
+    def finish(self, clip: Recording) -> None:
+        """Close the writer of a stopped clip and give the file its name."""
+        try:
+            clip.writer.close()
+            os.replace(clip.writer.fileName, clip.fileName)
+        except OSError:
+            self.metrics.counter("writer_errors").inc()
+        finally:
+            with self.buf_lock:
+                self.stopping.remove(clip)
+            self.metrics.rate("clips_recorded").mark()
+            self.metrics.histogram("clip_drain_ms").observe(
+                (time.monotonic_ns() - clip.stop_ns) / 1e6
+            )
+            clip.done.set()
+            if self.verbose == 2:
+                print(f"[INFO] Recorded {clip.fileName}")
+
+    def recStop(self, name: Optional[str] = None) -> None:
+        """Stop recording the event `name`, or every event.
 
-    def recStop(self) -> None:
-        """Stop recording video."""
+        The clips are written and renamed in the background; `Recording.wait`
+        waits for one.
+        """
         if self.verbose == 2:
-            print("[INFO] Stopping recording")
-
-        # indicating that we have completed our recording,
-        # Join the thread, then flush all remaining frames
-        # in the queue to file and free the writer pointer.
-        self.recStarted = False  # reset flag to stop recording thread
-        if self.thread is not None:
-            self.thread.join()
-        if self.writer is not None:
-            self.flush()
-            self.writer.close()
+            print(f"[INFO] Stopping recording {name or ''}")
+
+        if self.compressor is not None:
+            # the frames given before recStop are recorded; not waiting for
+            # the queue to drain, which frames given meanwhile may never let it
+            buffered = threading.Event()
+            self.raw_Q.put(buffered)
+            buffered.wait()
+        with self.buf_lock:
+            names = list(self.clips) if name is None else [name]
+            for clip in [self.clips.pop(n) for n in names if n in self.clips]:
+                clip.stop_ns = time.monotonic_ns()
+                clip.live.append(None)
+                self.stopping.append(clip)
+                self.schedule(clip)
+            self.recStarted = bool(self.clips)  # stop queueing frames
+        self.metrics.gauge("recordings").set(len(self.clips))
+        if not self.clips:
+            self.metrics.gauge("writer_backlog").set(0)
+
+    def close(self) -> None:
+        """Stop the recordings in progress and release the writers."""
+        super().close()
+        for clip in list(self.stopping):
+            clip.wait()
+        self.workers.shutdown()
+        self.pool.close()
+        if self.compressor is not None:
+            self.raw_Q.put(None)
+            self.compressor.join()
+            self.compressor = None
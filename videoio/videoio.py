@@ -1,15 +1,31 @@
 """Perfect video Capture module."""
 
+import math
 import threading
 import time
-from typing import Dict, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 import cv2
 import numpy as np
+import utils.aio as aio
+import utils.backpressure as backpressure
 import utils.helpers as hvio
-from utils.fps import FPS
+import utils.metrics as metrics
+import utils.pixel_format as pixel_format
+import utils.pyramid as pyramid
+import utils.tracing as tracing
+from utils.change_gate import ChangeGate
+from utils.dvr_writer import DvrWriter
+from utils.frame_batch import FrameBatch
+from utils.frame_header import HEARTBEAT, FrameMeta
+from utils.frame_pool import FramePool
+from utils.keyframe_reader import KeyframeCapture
+from utils.pacing import Cadence, Pacer
+from utils.passthrough_writer import PassthroughWriter
 from utils.redis_shmem import RedisShmem
-from utils.video_writer import video_writer
+from utils.shm_ring import ShmRing
+from utils.tracing import FrameTrace
+from utils.video_writer import BaseWriter, NullWriter, video_writer
 
 
 class RedisVideoCapture:
@@ -19,34 +35,137 @@ class RedisVideoCapture:
         """Initialize the video capture context."""
         if int(cfg["defaultArgs"]["--verbose"]) == 1:
             print("\n[INFO] Initializing VideoCapture context")
+        self.cfg = cfg
         self.src = cfg["defaultArgs"]["--src"]
-        self.stream = cv2.VideoCapture(self.src, cv2.CAP_FFMPEG)
-        self.shmem = RedisShmem(cfg)
+        self.resolution = int(cfg["defaultArgs"]["--width"]), int(
+            cfg["defaultArgs"]["--height"]
+        )
+        # keyframes: decode only the I-frames of the stream
+        self.keyframes = int(cfg["defaultArgs"].get("--keyframes", 0)) == 1
+        # a lost stream is reopened in the capture thread
+        reconnect = cfg.get("reconnect", {})
+        self.open_timeout_ms = int(reconnect.get("open_timeout_ms", 5000))
+        self.read_timeout_ms = int(reconnect.get("read_timeout_ms", 5000))
+        self.max_backoff = float(reconnect.get("max_backoff", 30))
+        self.max_retries = int(reconnect.get("max_retries", 0))
+        self.reconnecting = False
+        self.reconnect_attempts = 0
+        self.reconnect_ns = 0
+        self.outage_ns = 0
+        self.stopping = threading.Event()
+        self.stream: Union[cv2.VideoCapture, KeyframeCapture] = self.open_stream()
+        self.shmem = self.open_buffer(cfg)
         self.verbose = int(cfg["defaultArgs"]["--verbose"])
-        self.writer = video_writer(cfg)
-        self.rec_permit = cfg["record"]["rec_permit"]
+        # passthrough and dvr record the compressed source stream, not the frames
+        writers: Dict[str, Callable[[Dict], BaseWriter]] = {
+            "encode": video_writer,
+            "passthrough": PassthroughWriter,
+            "dvr": DvrWriter,
+        }
+        rec_mode = cfg["record"].get("mode", "encode")
+        if rec_mode not in writers:
+            raise ValueError(f"unknown record mode: {rec_mode}")
+        self.rec_permit = str(cfg["record"]["rec_permit"]).lower() in (
+            "1",
+            "true",
+            "yes",
+        )
+        # without permission, no source is reopened and no segment is written
+        self.writer = writers[rec_mode](cfg) if self.rec_permit else NullWriter(cfg)
         self.fps_rdg = int(cfg["defaultArgs"]["--fps_rdg"])
-        self.fpsTime_rdg = 1 / float(self.fps_rdg) if self.fps_rdg != 0 else 0
         self.fps_van = (
             int(cfg["Analysis"]["fps_van"])
             if int(cfg["Analysis"]["fps_van"]) != 0
             else 12
         )
-        self.fpsTime_van = 1 / float(self.fps_van) if self.fps_van != 0 else 0
-        self.resolution = int(cfg["defaultArgs"]["--width"]), int(
-            cfg["defaultArgs"]["--height"]
-        )
+        # deadline policy of the reader and consumer loops {skip, catchup}
+        self.pace_policy = cfg["Analysis"].get("pace_policy", "skip")
+        self.pacer = Pacer(self.fps_rdg, self.pace_policy)
+        # decimation: grab() every frame, retrieve() only the published ones
+        self.decimate = int(cfg["defaultArgs"].get("--decimate", 0)) == 1
+        self.decimate_period = 1000.0 / (self.fps_rdg or self.fps_van)
+        self.next_due = 0.0
+        self.stream_start = 0.0
+        self.pos_msec = 0.0
         self.frame_fail_cnt = 0
         self.frame_fail_cnt_limit = 10
         self.capture_failed = False
         self.thread = None
         self.started = False
+        self.grabbed: bool
+        self.frame: Optional[np.ndarray]
         self.grabbed, self.frame = self.stream.read()
+        self.read_shape = None if self.frame is None else self.frame.shape
+        # reuse read and resize buffers; frames may still wait on encoder threads
+        pool_size = max(
+            int(cfg["Analysis"].get("pool_size", 4)),
+            int(cfg["redis"].get("encode_workers", 0)) + 2,
+        )
+        self.read_pool = FramePool(pool_size)
+        self.resize_pool = FramePool(pool_size)
+        # extra sizes and crops of the decoded frames, each in its own buffer
+        self.pyramid = pyramid.Pyramid(pyramid.outputs(cfg), pool_size)
+        self.outputs = {
+            o.name: self.open_buffer(pyramid.output_config(cfg, o.name))
+            for o in self.pyramid.outputs
+        }
+        # frames are converted once, here, to the pixel format of the buffers
+        self.pixfmt = pixel_format.pixel_format_tag(
+            cfg["Analysis"].get("pixel_format", "bgr")
+        )
+        self.convert_pools = {
+            name: FramePool(pool_size) for name in ["", *self.outputs]
+        }
+        # frames of a static scene are not published, but for a heartbeat
+        gate = cfg.get("gate", {})
+        self.gate = ChangeGate(gate) if int(gate.get("enabled", 0)) == 1 else None
+        # a gated capture feeds the writer itself, static frames included,
+        # resampled to FPS_REC so that recordings keep the real time
+        self.gate_records = self.gate is not None and self.rec_permit
+        self.rec_cadence = Cadence(int(cfg["record"]["fps_rec"]))
+        self.frames_read = 0
+        self.metrics = metrics.registry(cfg["APP"]["cam_name"])
+        self.tracer = tracing.tracer(cfg)
+        self.grab_ns = 0
 
     def __str__(self) -> str:
         """Print the video capture context."""
         return str(self.__class__) + ": " + str(self.__dict__)
 
+    @staticmethod
+    def open_buffer(cfg: Dict) -> Union[RedisShmem, ShmRing]:
+        """Open the producer side of the frame buffer of the configured backend."""
+        if cfg["Analysis"].get("backend", "redis") == "shm":
+            return ShmRing(cfg, producer=True)
+        return RedisShmem(cfg, producer=True)
+
+    def buffers(self) -> List[Union[RedisShmem, ShmRing]]:
+        """Return the frame buffer and the buffers of the extra outputs."""
+        return [self.shmem, *self.outputs.values()]
+
+    def open_stream(self) -> Union[cv2.VideoCapture, KeyframeCapture]:
+        """Open the video source, giving up after `open_timeout_ms`.
+
+        A dead RTSP server then fails in seconds instead of the default
+        30 s FFmpeg timeouts, and so does a read from a stalled stream.
+        """
+        if self.keyframes:
+            return KeyframeCapture(
+                self.src,
+                self.resolution,
+                max(self.open_timeout_ms, self.read_timeout_ms),
+            )
+        return cv2.VideoCapture(
+            self.src,
+            cv2.CAP_FFMPEG,
+            [
+                cv2.CAP_PROP_OPEN_TIMEOUT_MSEC,
+                self.open_timeout_ms,
+                cv2.CAP_PROP_READ_TIMEOUT_MSEC,
+                self.read_timeout_ms,
+            ],
+        )
+
     def start(self) -> None:
         """Start the thread to read frames from the video stream."""
         if self.verbose == 2:
@@ -57,58 +176,285 @@ class RedisVideoCapture:
         self.thread.start()  # type: ignore
 
     def waitOnFrameBuf(self) -> None:
-        """Wait until the frame buffer is full."""
-        while not self.capture_failed and (self.shmem.qsize() < self.shmem.q_size):
-            # 1/4 of FPS sleep
-            time.sleep(1.0 / (self.fps_van * 4)) if self.fps_van != 0 else time.sleep(
-                0.1
-            )
+        """Wait until the frame buffer is full, or the capture fails.
 
-    def update_grabbed(self, frame: np.ndarray) -> None:
+        With a `latest` policy the buffer only ever holds one fresh frame, so
+        there is no point in waiting for more; nor with a change gate, which
+        publishes a static scene once per `Heartbeat_Sec`. A `drop-oldest`
+        reader skips the frames beyond `Max_Lag`, so it waits for `Max_Lag`
+        + 1 frames only.
+        """
+        size = self.shmem.q_size
+        if self.gate is not None or backpressure.LATEST in (
+            self.shmem.capture_policy,
+            self.shmem.read_policy,
+        ):
+            size = 1
+        elif self.shmem.read_policy == backpressure.DROP_OLDEST:
+            size = min(self.shmem.max_lag + 1, size)
+        self.shmem.wait_qsize(
+            size, abort=lambda: self.capture_failed or not self.started
+        )
+
+    def update_grabbed(
+        self, frame: np.ndarray, trace: Optional[FrameTrace] = None
+    ) -> None:
         """Update context if the frame is grabbed."""
         # resize frame to resolution
-        self.frame = self.shmem.resizeFrame(frame, self.resolution)
-
-        # put frame into buffer
-        self.shmem.put_Q(self.frame)
+        tic = time.perf_counter()
+        dst = self.resize_pool.next(self.resolution[::-1] + frame.shape[2:])
+        resized = self.shmem.resizeFrame(frame, self.resolution, dst)
+        if resized is not frame:
+            resized = self.resize_pool.adopt(dst, resized)
+        self.metrics.histogram("resize_ms").observe(1000 * (time.perf_counter() - tic))
+        if trace is not None:
+            trace.stamp("resize")
 
         if self.frame_fail_cnt > 0:
             self.frame_fail_cnt = 0  # reset counter
 
+        # skip the frames of a static scene
+        score, flags = -1.0, 0
+        converted = None
+        if self.gate is not None:
+            tic = time.perf_counter()
+            publish, score = self.gate.admit(resized, self.grab_ns)
+            self.metrics.histogram("gate_ms").observe(
+                1000 * (time.perf_counter() - tic)
+            )
+            self.metrics.gauge("change_score").set(score)
+            if self.gate_records:
+                converted = self.record(resized)
+            if not publish:
+                self.metrics.counter("frames_gated").inc()
+                return
+            if score < self.gate.threshold:
+                flags = HEARTBEAT
+        self.frame = converted if converted is not None else self.convert(resized, "")
+
+        # put frame into buffer, once a reader made room if the policy blocks
+        if self.shmem.capture_policy == backpressure.BLOCK:
+            self.shmem.wait_space(abort=lambda: not self.started)
+        self.shmem.put_Q(self.frame, self.pts_us(), self.grab_ns, trace, score, flags)
+        if self.outputs:
+            self.publish_outputs(frame, resized, score, flags)
+
         if not self.capture_failed:
             self.capture_failed = False
 
+    def pts_us(self) -> int:
+        """Return the stream time of the frame in µs, 0 if it is unknown."""
+        return 0 if math.isnan(self.pos_msec) else int(self.pos_msec * 1000)
+
+    def record(self, resized: np.ndarray) -> Optional[np.ndarray]:
+        """Feed the writer the frames due at FPS_REC; return the converted frame.
+
+        The cadence follows stream timestamps, or the grab time without them.
+        """
+        pos = self.pos_msec if self.pos_msec > 0 else self.grab_ns / 1e6
+        repeat = self.rec_cadence.due(pos)
+        if repeat == 0:
+            return None
+        converted = self.convert(resized, "")
+        for _ in range(repeat):
+            self.writer.update(converted)
+        return converted
+
+    def convert(self, img: np.ndarray, name: str) -> np.ndarray:
+        """Convert a BGR frame of output `name` ("": the published frame)."""
+        if self.pixfmt == pixel_format.BGR:
+            return img
+        pool = self.convert_pools[name]
+        dst = pool.next(
+            pixel_format.converted_shape(img.shape[0], img.shape[1], self.pixfmt)
+        )
+        return pool.adopt(dst, pixel_format.from_bgr(img, self.pixfmt, dst))
+
+    def publish_outputs(
+        self, frame: np.ndarray, resized: np.ndarray, score: float, flags: int
+    ) -> None:
+        """Publish the extra sizes and crops of a decoded frame.
+
+        Each size is resized from the smallest larger level already computed,
+        starting with the published frame, so no consumer resizes again.
+        """
+        tic = time.perf_counter()
+        levels = self.pyramid.compute(frame, [resized])
+        self.metrics.histogram("pyramid_ms").observe(1000 * (time.perf_counter() - tic))
+        for name, img in levels.items():
+            self.outputs[name].put_Q(
+                self.convert(img, name),
+                self.pts_us(),
+                self.grab_ns,
+                score=score,
+                flags=flags,
+            )
+
     def update_failed(self) -> bool:
         """Update the video capture context if the frame is failed."""
         break_flag = False
         # if the frame is failed, increment the counter
         self.frame_fail_cnt += 1
-        # if the frame is failed for more than 10 times, stop the video capture
+        self.metrics.counter("read_failures").inc()
+        # if the frame is failed for more than 10 times, reopen the stream,
+        # and stop the video capture if that fails too
         if self.frame_fail_cnt > self.frame_fail_cnt_limit:
             self.frame_fail_cnt = 0
+            if self.reconnect():
+                return break_flag
             self.capture_failed = True
+            for buffer in self.buffers():
+                buffer.notify()  # wake up readers waiting on the buffer
             break_flag = True
             if self.verbose == 2:
                 print("[INFO] Capture failed, exiting")
         return break_flag
 
+    def reconnect(self) -> bool:
+        """Reopen the stream with a jittered exponential backoff.
+
+        This runs in the capture thread, so the frame buffer, its connections
+        and the writer (with a recording in progress) outlive the outage.
+        The backoff keeps growing until a frame is read again. Return False
+        if the capture is stopped or `max_retries` opens failed in a row.
+        """
+        self.reconnecting = True
+        for buffer in self.buffers():
+            buffer.flush()  # publish frames held back by batching
+        if self.outage_ns == 0:
+            self.outage_ns = time.monotonic_ns()
+        self.stream.release()
+        while self.started and (
+            self.max_retries == 0 or self.reconnect_attempts < self.max_retries
+        ):
+            delay = hvio.backoff(self.reconnect_attempts, self.max_backoff)
+            if self.verbose == 2:
+                print(f"[INFO] Reconnecting to the video source in {delay:.1f} s")
+            if self.stopping.wait(delay):
+                break
+            self.reconnect_attempts += 1
+            self.reconnect_ns = time.monotonic_ns()
+            self.stream = self.open_stream()
+            if self.stream.isOpened():
+                self.metrics.counter("reconnects").inc()
+                self.stream_start = 0.0  # files restart from the beginning
+                self.reconnecting = False
+                return True
+            self.stream.release()
+        self.reconnecting = False
+        return False
+
+    def reconnected(self) -> None:
+        """Record the time to the first frame after a reconnect."""
+        now = time.monotonic_ns()
+        self.metrics.histogram("reconnect_ttff_ms").observe(
+            (now - self.reconnect_ns) / 1e6
+        )
+        self.metrics.histogram("outage_ms").observe((now - self.outage_ns) / 1e6)
+        if self.verbose == 2:
+            print(f"[INFO] Stream back after {(now - self.outage_ns) / 1e9:.1f} s")
+        self.reconnect_attempts = 0
+        self.reconnect_ns = self.outage_ns = 0
+
+    def frame_due(self, pos: float) -> bool:
+        """Return True if the frame at stream time `pos` (ms) is to be published."""
+        if pos < self.next_due - 2 * self.decimate_period:
+            # stream timestamps went backwards (source restarted)
+            self.next_due = pos
+        if pos < self.next_due:
+            return False
+        self.next_due += self.decimate_period
+        if self.next_due <= pos:
+            # fell behind by more than one period, do not burst to catch up
+            self.next_due = pos + self.decimate_period
+        return True
+
+    def grab_decimated(self) -> Tuple[bool, Optional[np.ndarray]]:
+        """Grab the next frame and decode it only if it is due for publishing.
+
+        Skipped frames are demuxed but never converted to BGR or resized.
+        The cadence follows stream timestamps; files are paced to real time.
+        """
+        if not self.stream.grab():
+            return False, None
+        self.grab_ns = time.monotonic_ns()
+        pos = self.pos_msec = self.stream.get(cv2.CAP_PROP_POS_MSEC)
+        if not pos > 0:
+            # no stream timestamps, fall back to the local clock
+            pos = time.monotonic() * 1000
+        elif self.stream.get(cv2.CAP_PROP_FRAME_COUNT) > 0:
+            # a file is read faster than real time; wait for its timestamp
+            if self.stream_start == 0:
+                self.stream_start = time.monotonic() * 1000 - pos
+            delay = self.stream_start + pos - time.monotonic() * 1000
+            if delay > 0:
+                time.sleep(delay / 1000)
+                self.grab_ns = time.monotonic_ns()
+        if not self.frame_due(pos):
+            return True, None
+        buf = self.next_read_buffer()
+        grabbed, frame = self.stream.retrieve(buf)
+        if not grabbed or frame is None:
+            return False, None
+        self.read_shape = frame.shape
+        return True, self.read_pool.adopt(buf, frame)
+
+    def next_read_buffer(self) -> Optional[np.ndarray]:
+        """Return the pooled buffer the next frame is decoded into."""
+        self.frames_read += 1
+        if self.read_shape is None:
+            return None
+        return self.read_pool.next(self.read_shape)
+
+    def allocations_per_frame(self) -> float:
+        """Return the frame buffer allocations per captured frame."""
+        allocations = self.read_pool.allocations + self.resize_pool.allocations
+        if isinstance(self.shmem, RedisShmem):
+            allocations += self.shmem.payloads.allocations
+        return allocations / max(self.frames_read, 1)
+
     def update(self) -> None:
         """Update the video capture context."""
-        # start the FPS timer
-        fps_log = FPS()
-        fps_log.start()
+        read_ms = self.metrics.histogram("read_ms")
+        frames_read = self.metrics.rate("frames_read")
+        allocations = self.metrics.gauge("allocations_per_frame")
+
+        # keep FPS consistent, unless decimation already paces the loop
+        if self.decimate:
+            self.pacer = Pacer(0)
+        self.pacer.start()
 
         # loop over some frames and estimate the FPS
         while self.started:
-            # get timestamp
-            tic = time.time()
-
             # Get frame from the video source
-            self.grabbed, frame = self.stream.read()
+            tic = time.perf_counter()
+            if self.decimate:
+                self.grabbed, frame = self.grab_decimated()
+            else:
+                # grab and retrieve apart, so a trace can tell waiting from decoding
+                buf = self.next_read_buffer()
+                self.grabbed = self.stream.grab()
+                self.grab_ns = time.monotonic_ns()
+                frame = None
+                if self.grabbed:
+                    self.grabbed, frame = self.stream.retrieve(buf)
+                if self.grabbed and frame is not None:
+                    self.read_shape = frame.shape
+                    frame = self.read_pool.adopt(buf, frame)
+                self.pos_msec = self.stream.get(cv2.CAP_PROP_POS_MSEC)
+            read_ms.observe(1000 * (time.perf_counter() - tic))
 
             # If we have successfully grabbed a frame.
             if self.grabbed:
-                self.update_grabbed(frame)
+                if self.reconnect_ns:
+                    self.reconnected()
+                if frame is not None:
+                    trace = self.tracer.begin(self.grab_ns)
+                    if trace is not None:
+                        trace.stamp("retrieve")
+                    self.update_grabbed(frame, trace)
+                else:
+                    self.frame_fail_cnt = 0  # frame skipped by decimation
 
             # If we failed to grab a frame
             else:
@@ -117,28 +463,61 @@ class RedisVideoCapture:
                     break
 
             # Try to keep FPS consistent
-            if self.fps_rdg != 0:
-                hvio.sleep_fps(tic, self.fpsTime_rdg)
+            self.pacer.wait()
 
             # update FPS counter
-            fps_log.update()
+            frames_read.mark()
+            allocations.set(self.allocations_per_frame())
 
             if self.verbose == 1 and self.frame is not None:
-                print(f"[INFO] approx. stream reader  FPS: {fps_log.fps():.2f}")
+                print(f"[INFO] approx. stream reader  FPS: {frames_read.rate():.2f}")
         # end while
 
-        # stop the FPS timer
-        fps_log.stop()
+        # publish frames still held back by batching
+        for buffer in self.buffers():
+            buffer.flush()
 
     # get the frame from the buffer
-    def read(self) -> Tuple[Optional[np.ndarray], bool, str]:
-        """Get the frame from the buffer."""
+    def read(self) -> Tuple[Optional[np.ndarray], bool, Optional[FrameMeta]]:
+        """Get the frame and its metadata from the buffer."""
         return self.shmem.getFrame()
 
+    def read_batch(self, n: int, timeout: int = 1) -> Optional[FrameBatch]:
+        """Get up to `n` frames from the buffer, stacked for batch inference."""
+        return self.shmem.read_batch(n, timeout)
+
+    def async_reader(
+        self,
+        consumer: Optional[str] = None,
+        pool: Optional[aio.ConnectionPool] = None,
+    ) -> Union[aio.AsyncRedisShmem, aio.AsyncShmRing]:
+        """Return an asyncio reader of this capture's frame buffer.
+
+        It offers `await read()`, `await read_batch()` and `async for` over
+        the frames, which ends when the capture is stopped.
+        """
+        return aio.reader(self.cfg, consumer, pool, until=lambda: not self.started)
+
+    def __aiter__(self) -> aio.AsyncReader:
+        """Iterate over `(frame, meta)` from an asyncio event loop."""
+        return self.async_reader()
+
     def stop(self) -> None:
         """Stop the video capture context."""
         if self.verbose == 2:
             print("[INFO] Stopping threaded video capturing")
         self.started = False  # set flag to stop thread
+        self.stopping.set()  # interrupt a reconnect backoff
+        for buffer in self.buffers():
+            buffer.notify()  # wake up readers waiting on the buffer
         self.thread.join()  # type: ignore # wait for thread to finish
         self.stream.release()  # release video stream
+        self.writer.close()  # stop recording and release the writer
+        if self.verbose == 2:
+            print(f"[INFO] Frame buffer publish stats: {self.shmem.stats()}")
+            print(f"[INFO] Allocations per frame: {self.allocations_per_frame():.3f}")
+            print(f"[INFO] Stream reader pacing: {self.pacer.stats()}")
+            if self.tracer.sample:
+                print(f"[INFO] Frame latency (ms): {self.tracer.percentiles()}")
+        for buffer in self.buffers():
+            buffer.close()  # release the frame buffers